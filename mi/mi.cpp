@@ -20,17 +20,23 @@
 #include <time.h>
 #include <stdarg.h>
 #include <string.h>
+#include <ctype.h>
 #include <execinfo.h>
 #include <cxxabi.h>
+#include <stdint.h>
+#include <unistd.h>
+#include <link.h>
 
 #include <vector>
-#include <algorithm>
+#include <string>
+#include <map>
 using namespace std;
 
 
 #include <pthread.h>
 
 #include "mitime.hpp"
+#include "micompress.hpp"
 
 typedef int (*mutex_function)( pthread_mutex_t * );
 
@@ -40,7 +46,231 @@ static const char *    defaultLogfile = "mi.log";
 
 
 static pthread_mutex_t     outputLock = PTHREAD_MUTEX_INITIALIZER;
-static pthread_mutex_t     inLock = PTHREAD_MUTEX_INITIALIZER;
+
+// The backtrace() locks a mutex internally so the thread which is capturing
+// a stack trace must not be instrumented
+static __thread bool       inProcess = false;
+
+// The mutexes the thread has locked with the recorded operations when only
+// some operations are recorded, so their unlocks are recorded too
+static const size_t         maxSelected = 64;
+static __thread pthread_mutex_t *   selectedMutexes[ maxSelected ];
+static __thread size_t      selectedCount = 0;
+
+// The per mutex operation counters for the 1-in-N sampling. The mutexes
+// are hashed by address so a few of them may share a counter.
+static const size_t         maxSampleSlots = 4096;
+static volatile uint32_t    sampleCounts[ maxSampleSlots ];
+
+
+enum OperationCode
+{
+    OpLock      = 0,
+    OpUnlock    = 1,
+    OpTrylock   = 2
+};
+
+static const char *    operationNames[] = { "lock", "unlock", "trylock" };
+
+
+// Binary log format (MI_OPTIONS=binary).
+// The file starts with the 8 bytes magic, a uint32 byte order mark and a
+// uint32 format version. Then records follow. Each record starts with one
+// byte record type:
+// 'E' - uint32 length, environment statement text (as of the Env: line)
+// 'L' - uint32 length, layout of the 'O' record fields after the type byte
+// 'F' - uint32 frame ID, uint32 length, backtrace frame text
+//       (0x<return address> if MI_OPTIONS=addresses)
+// 'S' - uint32 stack ID, uint32 number of frames, uint32 frame IDs
+// 'O' - fixed size operation record, see BinaryOperation
+static const char *    binaryMagic = "MIBINLOG";
+static const uint32_t  binaryByteOrder = 0x01020304;
+static const uint32_t  binaryVersion = 1;
+static const char *    binaryLayout = "op:B ret:i object:Q thread:Q "
+                                      "clocks:Q time:Q stack:I seq:Q";
+
+struct BinaryOperation
+{
+    unsigned char   type;           // 'O'
+    unsigned char   op;             // OperationCode
+    int32_t         ret;
+    uint64_t        object;
+    uint64_t        thread;
+    uint64_t        clocks;         // nanoseconds
+    uint64_t        time;           // nanoseconds since the log start
+    uint32_t        stack;          // 0 - no stack trace
+    uint64_t        seq;            // global sequence number
+} __attribute__(( packed ));
+
+
+// Per thread output buffers (MI_OPTIONS=buffered).
+// The records are collected in a thread local buffer which is written to the
+// log file in bulk when it is full, when its oldest record is older than the
+// flush interval, when the thread exits and at exit. The buffers of the idle
+// threads are written by the threads which flush their own ones, so a record
+// reaches the log file within about two flush intervals. statmi.py restores
+// the records order in a window derived from the interval.
+static const size_t     threadBufferSize = 64 * 1024;
+static const uint64_t   bufferFlushInterval = 100000000;    // ns
+
+struct ThreadBuffer
+{
+    ThreadBuffer *  prev;           // all the buffers list
+    ThreadBuffer *  next;
+    pthread_mutex_t lock;           // the owner or a flushing thread
+    uint64_t        firstTicks;     // the oldest record time
+    size_t          size;           // used bytes
+    char            data[ threadBufferSize ];
+};
+
+static __thread ThreadBuffer *  threadBuffer = 0;
+static pthread_key_t            threadBufferKey;
+static pthread_mutex_t          buffersLock = PTHREAD_MUTEX_INITIALIZER;
+static ThreadBuffer *           buffers = 0;
+
+// Global operations sequence number to restore the order of the records
+static volatile uint64_t        sequence = 0;
+
+static void  releaseThreadBuffer( void *  buffer );
+
+
+// Compressed log output (MI_OPTIONS=gzip, zstd or lz4 or the log file name
+// extension .gz, .zst or .lz4), see micompress.hpp. The records are
+// collected until a block is large enough and the block is compressed at
+// the next record boundary.
+static const size_t     compressedBlockSize = 1024 * 1024;
+
+
+// Loaded modules address ranges (MI_OPTIONS=addresses).
+// The ranges are only appended so the stack capturing threads read them
+// without a lock. Each module is written to the log once as an Env:
+// "module: <start> <end> <load bias> <path>" statement.
+static const size_t     maxModules = 1024;
+
+struct ModuleRange
+{
+    uintptr_t       start;
+    uintptr_t       end;
+};
+
+static ModuleRange              modules[ maxModules ];
+static volatile size_t          modulesCount = 0;
+static pthread_mutex_t          modulesLock = PTHREAD_MUTEX_INITIALIZER;
+static ModuleRange              libmiRange = { 0, 0 };
+
+// The maximum number of the stack trace frames
+static const int                maxFrames = 1024;
+
+
+// Provides the address range of the loaded module
+static ModuleRange  getModuleRange( const struct dl_phdr_info *  info )
+{
+    ModuleRange     range = { 0, 0 };
+
+    for ( int  k = 0; k < info->dlpi_phnum; ++k )
+    {
+        const ElfW(Phdr) &  header( info->dlpi_phdr[ k ] );
+        if ( header.p_type != PT_LOAD )     continue;
+
+        uintptr_t   start( info->dlpi_addr + header.p_vaddr );
+        uintptr_t   end( start + header.p_memsz );
+        if ( range.end == 0 || start < range.start )    range.start = start;
+        if ( end > range.end )                          range.end = end;
+    }
+    return range;
+}
+
+
+// dl_iterate_phdr() callback which finds the libmi.so address range
+static int  findLibmi( struct dl_phdr_info *  info, size_t  size, void * )
+{
+    ModuleRange     range( getModuleRange( info ) );
+    uintptr_t       address( (uintptr_t)&findLibmi );
+
+    if ( address < range.start || address >= range.end )    return 0;
+    libmiRange = range;
+    return 1;
+}
+
+
+// Checks if the given code address belongs to libmi.so
+static bool  isLibmiAddress( void *  address )
+{
+    if ( libmiRange.end == 0 )
+        dl_iterate_phdr( findLibmi, 0 );
+    return (uintptr_t)address >= libmiRange.start &&
+           (uintptr_t)address < libmiRange.end;
+}
+
+
+// Checks if the given code address belongs to a known module
+static bool  isKnownAddress( void *  address )
+{
+    size_t      count( modulesCount );
+
+    for ( size_t  k = 0; k < count; ++k )
+        if ( (uintptr_t)address >= modules[ k ].start &&
+             (uintptr_t)address < modules[ k ].end )
+            return true;
+    return false;
+}
+
+
+// Parses the 'name=value' option. Returns false if it is another option;
+// the value is 0 if it is not a number.
+static bool  getOptionValue( const string &  option, const char *  name,
+                             uint64_t &  value )
+{
+    size_t      length( strlen( name ) );
+    if ( option.size() <= length + 1 || option.compare( 0, length, name ) != 0 ||
+         option[ length ] != '=' )
+        return false;
+
+    const char *    begin( option.c_str() + length + 1 );
+    char *          end( 0 );
+    value = strtoull( begin, &end, 10 );
+    if ( *end != 0 || !isdigit( *begin ) )  value = 0;
+    return true;
+}
+
+
+// Checks the MI_CLOCK environment variable: 'tsc' (default) - the time
+// stamp counter if it is the invariant one, 'monotonic' - CLOCK_MONOTONIC
+// only, no 20 ms calibration at the start
+static bool  isTSCAllowed( void )
+{
+    const char *    value( getenv( "MI_CLOCK" ) );
+
+    if ( value == 0 || strlen( value ) == 0 || strcmp( value, "tsc" ) == 0 )
+        return true;
+    if ( strcmp( value, "monotonic" ) == 0 )
+        return false;
+    fprintf( stderr, "Unsupported value '%s' of the MI_CLOCK environment "
+                     "variable. Supported values: 'tsc', 'monotonic'.\n",
+             value );
+    exit( 1 );
+}
+
+
+// printf() like formatting into a string
+static string  formatString( const char *  format, ... )
+{
+    char        buffer[ 512 ];
+    va_list     l;
+
+    va_start( l, format );
+    int         length = vsnprintf( buffer, sizeof( buffer ), format, l );
+    va_end( l );
+
+    if ( length < 0 )                       return string();
+    if ( length < (int)sizeof( buffer ) )   return string( buffer, length );
+
+    vector<char>    bigBuffer( length + 1 );
+    va_start( l, format );
+    vsnprintf( &bigBuffer[0], length + 1, format, l );
+    va_end( l );
+    return string( &bigBuffer[0], length );
+}
 
 
 
@@ -53,43 +283,48 @@ class PthreadWrapper
         mutex_function      unlockFunction;     // pthread_mutex_unlock()
         mutex_function      trylockFunction;    // pthread_mutex_trylock()
         bool                putStackTrace;      // log the stack trace?
-        vector<pthread_t>   inProcess;          // The backtrace() locks a
-                                                // mutex internally so keep a
-                                                // track of what is processed
+        bool                stackAddresses;     // the return addresses only?
+        bool                binaryFormat;       // binary log format?
+        bool                bufferedOutput;     // per thread buffers?
+        bool                selective;          // some operations only?
+        uint64_t            sampleRate;         // 1-in-N locks per mutex
+        uint64_t            threshold;          // minimum lock duration, ns
+        uint64_t            stackThreshold;     // minimum duration for stacks
+        BlockCompressor             compressor; // compressed log output
+        BlockCompressor::Format     compression;
+        vector<char>        pending;            // not compressed yet records
+        vector<char>        block;              // compressed block
+        TickClock           clock;              // operations timing
+        uint64_t            startTicks;         // timestamps origin
+        map<string, uint32_t>           frameIDs;   // binary format frames
+        map<vector<uint32_t>, uint32_t> stackIDs;   // and stacks tables
+        map<void *, uint32_t>           addressIDs; // address only frames
 
     public:
-        // Checks if the process is in pthread_mutex_XXXlock() call
+        // Checks if the thread is in pthread_mutex_XXXlock() call
         bool  isProcessed( void ) const
         {
-            bool found;
-            this->lockFunction( &inLock );
-            found = inProcess.end() != find( inProcess.begin(), inProcess.end(),
-                                             pthread_self() );
-            this->unlockFunction( &inLock );
-            return found;
+            return inProcess;
         }
 
-        // Registers the process which is in pthread_mutex_XXXlock() call
+        // Registers the thread which is in pthread_mutex_XXXlock() call
         void  registerThread( void )
         {
-            this->lockFunction( &inLock );
-            inProcess.push_back( pthread_self() );
-            this->unlockFunction( &inLock );
+            inProcess = true;
         }
 
-        // Unregisters the process from the pthread_mutex_XXXlock() call
+        // Unregisters the thread from the pthread_mutex_XXXlock() call
         void  unregisterThread( void )
         {
-            this->lockFunction( &inLock );
-            vector<pthread_t>::iterator     candidate( find( inProcess.begin(),
-                                                             inProcess.end(),
-                                                             pthread_self() ) );
-            if ( candidate != inProcess.end() ) inProcess.erase( candidate );
-            this->unlockFunction( &inLock );
+            inProcess = false;
         }
 
         PthreadWrapper() :
-            handle( 0 ), outputFile( 0 ), putStackTrace( false )
+            handle( 0 ), outputFile( 0 ), putStackTrace( false ),
+            stackAddresses( false ), binaryFormat( false ), bufferedOutput( false ),
+            selective( false ), sampleRate( 1 ), threshold( 0 ),
+            stackThreshold( 0 ), compression( BlockCompressor::None ),
+            clock( isTSCAllowed() ), startTicks( clock.Ticks() )
         {
             char *          libpthreadPath( getenv( "MI_LIBPTHREAD" ) );
             char *          logfilePath( getenv( "MI_LOGFILE" ) );
@@ -150,6 +385,79 @@ class PthreadWrapper
                 exit( 1 );
             }
 
+            if ( options != 0 && strlen( options ) != 0 )
+            {
+                // Comma separated list of options
+                string      optionsList( options );
+                size_t      start( 0 );
+                while ( start <= optionsList.size() )
+                {
+                    size_t  end( optionsList.find( ',', start ) );
+                    if ( end == string::npos )  end = optionsList.size();
+                    string  option( optionsList.substr( start, end - start ) );
+                    uint64_t    value( 0 );
+
+                    if ( option == "stack" )
+                        putStackTrace = true;
+                    else if ( option == "addresses" )
+                    {
+                        putStackTrace = true;
+                        stackAddresses = true;
+                    }
+                    else if ( option == "binary" )
+                        binaryFormat = true;
+                    else if ( option == "buffered" )
+                        bufferedOutput = true;
+                    else if ( BlockCompressor::FromName( option ) !=
+                              BlockCompressor::None )
+                        compression = BlockCompressor::FromName( option );
+                    else if ( getOptionValue( option, "sample", value ) &&
+                              value > 0 )
+                        sampleRate = value;
+                    else if ( getOptionValue( option, "threshold", value ) &&
+                              value > 0 )
+                        threshold = value;
+                    else if ( getOptionValue( option, "stackthreshold",
+                                              value ) && value > 0 )
+                    {
+                        putStackTrace = true;
+                        stackThreshold = value;
+                    }
+                    else if ( !option.empty() )
+                    {
+                        dlclose( handle );
+                        fprintf( stderr,
+                                 "Unsupported option '%s' in the MI_OPTIONS "
+                                 "environment variable. Supported values: "
+                                 "'stack', 'addresses', 'binary', "
+                                 "'buffered', 'sample=N', 'threshold=NS', "
+                                 "'stackthreshold=NS', 'gzip', 'zstd', "
+                                 "'lz4'.",
+                                 option.c_str() );
+                        exit( 1 );
+                    }
+                    start = end + 1;
+                }
+            }
+            selective = sampleRate > 1 || threshold > 0;
+
+            if ( compression == BlockCompressor::None && logfilePath != 0 )
+                compression = BlockCompressor::FromPath( logfilePath );
+            if ( compression != BlockCompressor::None )
+            {
+                err = compressor.Open( compression );
+                if ( err )
+                {
+                    dlclose( handle );
+                    fprintf( stderr,
+                             "Cannot load %s for the %s log compression. "
+                             "dlopen: %s\n", compressor.Library(),
+                             compressor.Name(), err );
+                    exit( 1 );
+                }
+                pending.reserve( compressedBlockSize + threadBufferSize );
+            }
+
             if ( logfilePath == 0 || strlen( logfilePath ) == 0 )
                 outputFile = fopen( defaultLogfile, "w" );
             else
@@ -161,68 +469,442 @@ class PthreadWrapper
                 exit( 1 );
             }
 
+            if ( binaryFormat )
+            {
+                this->writeData( binaryMagic, strlen( binaryMagic ) );
+                this->writeData( &binaryByteOrder, sizeof( binaryByteOrder ) );
+                this->writeData( &binaryVersion, sizeof( binaryVersion ) );
+                this->writeString( 'L', binaryLayout );
+            }
+
             if ( elf == 0 )
-                this->write( "Env: application: unknown\n" );
+                this->writeEnv( "application: unknown" );
             else
-                this->write( "Env: application: %s\n", elf );
+                this->writeEnv( "application: %s", elf );
 
             if ( logfilePath == 0 )
-                this->write( "Env: log file: %s\n", defaultLogfile );
+                this->writeEnv( "log file: %s", defaultLogfile );
             else
-                this->write( "Env: log file: %s\n", logfilePath );
+                this->writeEnv( "log file: %s", logfilePath );
 
             if ( libpthreadPath == 0 )
-                this->write( "Env: libpthread.so path: %s\n",
-                             defaultLibpthreadPath );
+                this->writeEnv( "libpthread.so path: %s",
+                                defaultLibpthreadPath );
             else
-                this->write( "Env: libpthread.so path: %s\n",
-                             libpthreadPath );
+                this->writeEnv( "libpthread.so path: %s", libpthreadPath );
 
-            if ( options != 0 && strlen( options ) != 0 )
+            if ( stackAddresses )
+                this->writeEnv( "print stack trace addresses" );
+            else if ( putStackTrace )
+                this->writeEnv( "print stack trace" );
+            else
+                this->writeEnv( "do not print stack trace" );
+
+            if ( binaryFormat )
+                this->writeEnv( "binary log format" );
+            if ( compression != BlockCompressor::None )
+                this->writeEnv( "compressed log: %s", compressor.Name() );
+
+            this->writeEnv( "timestamps: monotonic nanoseconds since the log "
+                            "start" );
+            this->writeEnv( "clock: %s %.0f ticks per second",
+                            clock.Source(), clock.TicksPerSecond() );
+            if ( sampleRate > 1 )
+                this->writeEnv( "sampling: 1/%llu operations per mutex",
+                                (unsigned long long)sampleRate );
+            if ( threshold > 0 )
+                this->writeEnv( "threshold: %llu ns",
+                                (unsigned long long)threshold );
+            if ( stackThreshold > 0 )
+                this->writeEnv( "stack threshold: %llu ns",
+                                (unsigned long long)stackThreshold );
+
+            if ( bufferedOutput )
+            {
+                pthread_key_create( &threadBufferKey, releaseThreadBuffer );
+                this->writeEnv( "per thread buffered output" );
+                this->writeEnv( "buffer flush interval: %llu ns",
+                                (unsigned long long)bufferFlushInterval );
+            }
+
+            if ( stackAddresses )
+                this->registerModules( true );
+        }
+
+        ~PthreadWrapper()
+        {
+            if ( bufferedOutput )
             {
-                if ( strcmp( options, "stack" ) == 0 )
+                // Flush the buffers of the threads which are still alive
+                this->lockFunction( &buffersLock );
+                for ( ThreadBuffer *  buffer = buffers; buffer != 0;
+                      buffer = buffer->next )
                 {
-                    putStackTrace = true;
+                    this->lockFunction( &buffer->lock );
+                    this->flushBuffer( buffer );
+                    this->unlockFunction( &buffer->lock );
                 }
-                else
+                this->unlockFunction( &buffersLock );
+            }
+
+            if ( outputFile )
+            {
+                this->writeBlock();
+                fclose( outputFile );
+            }
+            if ( handle )     dlclose( handle );
+        }
+
+        // Provides the calling thread output buffer, creates it if needed
+        ThreadBuffer *  getThreadBuffer( void )
+        {
+            if ( threadBuffer != 0 )    return threadBuffer;
+
+            threadBuffer = (ThreadBuffer *) malloc( sizeof( ThreadBuffer ) );
+            if ( threadBuffer == 0 )    return 0;
+            pthread_mutex_init( &threadBuffer->lock, 0 );
+            threadBuffer->firstTicks = 0;
+            threadBuffer->size = 0;
+            threadBuffer->prev = 0;
+
+            this->lockFunction( &buffersLock );
+            threadBuffer->next = buffers;
+            if ( buffers != 0 )     buffers->prev = threadBuffer;
+            buffers = threadBuffer;
+            this->unlockFunction( &buffersLock );
+
+            pthread_setspecific( threadBufferKey, threadBuffer );
+            return threadBuffer;
+        }
+
+        // Writes the buffer content to the log file.
+        // The outputLock and the buffer lock must be locked.
+        void writeBuffer( ThreadBuffer *  buffer )
+        {
+            if ( buffer->size == 0 )    return;
+
+            this->writeData( buffer->data, buffer->size );
+            this->endRecord();
+            buffer->size = 0;
+        }
+
+        // Writes the buffer content and the stale buffers of the other
+        // threads to the log file. The buffer lock must be locked.
+        void flushBuffer( ThreadBuffer *  buffer )
+        {
+            if ( buffer->size == 0 )    return;
+
+            this->lockFunction( &outputLock );
+            this->writeBuffer( buffer );
+            this->flushIdleBuffers( buffer );
+            this->unlockFunction( &outputLock );
+        }
+
+        // Writes the buffers of the other threads which hold records older
+        // than the flush interval: an idle thread does not flush its buffer
+        // itself. The outputLock must be locked. The other locks are only
+        // tried so they could be taken in any order.
+        void flushIdleBuffers( ThreadBuffer *  current )
+        {
+            if ( this->trylockFunction( &buffersLock ) != 0 )   return;
+
+            uint64_t        now( clock.Ticks() );
+            for ( ThreadBuffer *  buffer = buffers; buffer != 0;
+                  buffer = buffer->next )
+            {
+                if ( buffer == current ||
+                     this->trylockFunction( &buffer->lock ) != 0 )
+                    continue;
+                if ( now > buffer->firstTicks &&
+                     clock.Nanoseconds( now - buffer->firstTicks ) >
+                                                        bufferFlushInterval )
+                    this->writeBuffer( buffer );
+                this->unlockFunction( &buffer->lock );
+            }
+            this->unlockFunction( &buffersLock );
+        }
+
+        // Flushes and frees the buffer of the exiting thread
+        void releaseBuffer( ThreadBuffer *  buffer )
+        {
+            this->lockFunction( &buffer->lock );
+            this->flushBuffer( buffer );
+            this->unlockFunction( &buffer->lock );
+
+            this->lockFunction( &buffersLock );
+            if ( buffer->prev != 0 )    buffer->prev->next = buffer->next;
+            else                        buffers = buffer->next;
+            if ( buffer->next != 0 )    buffer->next->prev = buffer->prev;
+            this->unlockFunction( &buffersLock );
+
+            if ( threadBuffer == buffer )   threadBuffer = 0;
+            pthread_mutex_destroy( &buffer->lock );
+            free( buffer );
+        }
+
+        // Writes the data to the buffer or to the log file if there is no
+        // buffer. The outputLock must be locked if there is no buffer.
+        void output( ThreadBuffer *  buffer, const void *  data, size_t  size )
+        {
+            if ( buffer == 0 )
+            {
+                this->writeData( data, size );
+                return;
+            }
+
+            if ( buffer->size + size > threadBufferSize )
+            {
+                this->flushBuffer( buffer );
+                if ( size > threadBufferSize )
                 {
-                    fprintf( stderr,
-                             "Unsupported option '%s' in the MI_OPTIONS "
-                             "environment variable. Supported values: 'stack'.",
-                             options );
-                    exit( 1 );
+                    this->lockFunction( &outputLock );
+                    this->writeData( data, size );
+                    this->endRecord();
+                    this->unlockFunction( &outputLock );
+                    return;
                 }
             }
+            memcpy( buffer->data + buffer->size, data, size );
+            buffer->size += size;
+        }
 
-            if ( putStackTrace )
-                this->write( "Env: print stack trace\n" );
-            else
-                this->write( "Env: do not print stack trace\n" );
+        // Writes a formatted string to the buffer or to the log file
+        void outputFormatted( ThreadBuffer *  buffer, const char *  format, ... )
+        {
+            char        local[ 512 ];
+            va_list     l;
+
+            va_start( l, format );
+            int         length = vsnprintf( local, sizeof( local ), format, l );
+            va_end( l );
+
+            if ( length < 0 )   return;
+            if ( length < (int)sizeof( local ) )
+            {
+                this->output( buffer, local, length );
+                return;
+            }
+
+            vector<char>    bigBuffer( length + 1 );
+            va_start( l, format );
+            vsnprintf( &bigBuffer[0], length + 1, format, l );
+            va_end( l );
+            this->output( buffer, &bigBuffer[0], length );
         }
 
-        ~PthreadWrapper()
+        // Decides if the operation is recorded when not all of them are.
+        // A lock or trylock is recorded if it took at least the threshold
+        // and it is the sampled one of its mutex; an unlock is recorded if
+        // the thread has recorded the lock of the mutex.
+        bool  isSelected( OperationCode  op, pthread_mutex_t *  m,
+                          int  retVal, uint64_t  clocks )
         {
-            if ( outputFile ) fclose( outputFile );
-            if ( handle )     dlclose( handle );
+            if ( op == OpUnlock )
+            {
+                for ( size_t  k = 0; k < selectedCount; ++k )
+                    if ( selectedMutexes[ k ] == m )
+                    {
+                        selectedMutexes[ k ] = selectedMutexes[ --selectedCount ];
+                        return true;
+                    }
+                return false;
+            }
+
+            if ( clocks < threshold )   return false;
+            if ( sampleRate > 1 )
+            {
+                size_t      slot( ( (uintptr_t)m >> 3 ) % maxSampleSlots );
+                if ( __sync_fetch_and_add( &sampleCounts[ slot ], 1 ) %
+                     sampleRate != 0 )
+                    return false;
+            }
+
+            if ( retVal != 0 )                  return true;
+            if ( selectedCount == maxSelected ) return false;
+            selectedMutexes[ selectedCount++ ] = m;
+            return true;
+        }
+
+        // Logs the operation. Serialises the output as required.
+        // The time is when the mutex is acquired for lock operations and
+        // when it is about to be released for unlock ones. The operation
+        // duration and the time are in ticks.
+        void logOperation( OperationCode  op, pthread_mutex_t *  m,
+                           int  retVal, uint64_t  ticks, uint64_t  when )
+        {
+            uint64_t    clocks( clock.Nanoseconds( ticks ) );
+            if ( selective && !this->isSelected( op, m, retVal, clocks ) )
+                return;
+
+            uint64_t    seq( __sync_fetch_and_add( &sequence, 1 ) );
+            uint64_t    time( clock.Nanoseconds( when - startTicks ) );
+            bool        stack( putStackTrace && clocks >= stackThreshold );
+
+            // The return addresses are collected before any lock is taken:
+            // backtrace() is slow and locks a mutex internally. A new module
+            // Env: statement is written here so it precedes the record.
+            void *      addresses[ maxFrames ];
+            int         count( 0 );
+            if ( stack && stackAddresses )
+                count = this->getAddresses( addresses, false );
+
+            if ( bufferedOutput )
+            {
+                ThreadBuffer *  buffer( this->getThreadBuffer() );
+                if ( buffer != 0 )
+                {
+                    this->lockFunction( &buffer->lock );
+                    if ( buffer->size == 0 )
+                        buffer->firstTicks = when;
+                    this->writeOperation( buffer, op, m, retVal, clocks, time,
+                                          seq, stack, addresses, count );
+                    if ( when > buffer->firstTicks &&
+                         clock.Nanoseconds( when - buffer->firstTicks ) >
+                                                        bufferFlushInterval )
+                        this->flushBuffer( buffer );
+                    this->unlockFunction( &buffer->lock );
+                    return;
+                }
+            }
+
+            this->lockFunction( &outputLock );
+            this->writeOperation( 0, op, m, retVal, clocks, time, seq,
+                                  stack, addresses, count );
+            this->endRecord();
+            this->unlockFunction( &outputLock );
+        }
+
+        // Writes the data to the log file or collects them for the
+        // compression. The outputLock must be locked.
+        void writeData( const void *  data, size_t  size )
+        {
+            if ( compression == BlockCompressor::None )
+            {
+                fwrite( data, 1, size, outputFile );
+                return;
+            }
+            pending.insert( pending.end(), (const char *)data,
+                            (const char *)data + size );
+        }
+
+        // Marks a records boundary: the collected records are compressed
+        // if there are enough of them. The outputLock must be locked.
+        void endRecord( void )
+        {
+            if ( pending.size() >= compressedBlockSize )
+                this->writeBlock();
+        }
+
+        // Compresses the collected records and writes the block
+        void writeBlock( void )
+        {
+            if ( pending.empty() )  return;
+
+            if ( compressor.Compress( &pending[0], pending.size(), block ) )
+                fwrite( &block[0], 1, block.size(), outputFile );
+            else
+                fprintf( stderr, "libmi.so: cannot %s compress %lu bytes of "
+                                 "the log\n", compressor.Name(),
+                         (unsigned long)pending.size() );
+            pending.clear();
         }
 
-        int write( const char * format, ... ) const
+        // Writes an environment statement
+        void writeEnv( const char * format, ... )
         {
-            int     ret;
+            char        buffer[ 4096 ];
+            va_list     l;
 
-            va_list l;
             va_start( l, format );
-            ret = vfprintf( outputFile, format, l );
+            vsnprintf( buffer, sizeof( buffer ), format, l );
             va_end( l );
 
-            return ret;
+            if ( binaryFormat )
+                this->writeString( 'E', buffer );
+            else
+            {
+                string  line( formatString( "Env: %s\n", buffer ) );
+                this->writeData( line.data(), line.size() );
+            }
+            this->endRecord();
         }
 
-        // Based on: http://idlebox.net/2008/0901-stacktrace-demangled/
-        void saveStack( void )
+        // Writes a binary format record which holds a string
+        void writeString( char  type, const string &  value )
         {
-            if ( !putStackTrace )   return;
+            uint32_t    length( value.size() );
 
+            this->writeData( &type, 1 );
+            this->writeData( &length, sizeof( length ) );
+            this->writeData( value.data(), length );
+        }
+
+        // Writes the operation and its stack trace if required to the buffer
+        // or to the log file if there is no buffer. The outputLock must be
+        // locked if there is no buffer. The return addresses are the
+        // collected ones in the addresses mode.
+        void writeOperation( ThreadBuffer *  buffer, OperationCode  op,
+                             pthread_mutex_t *  m, int  retVal,
+                             uint64_t  clocks, uint64_t  time, uint64_t  seq,
+                             bool  stack, void **  addresses, int  count )
+        {
+            if ( !binaryFormat )
+            {
+                if ( bufferedOutput )
+                    this->outputFormatted( buffer,
+                                           "Op: %s Object: %p Thread: %lu "
+                                           "RetCode: %d Clocks: %llu "
+                                           "Time: %llu Seq: %llu\n",
+                                           operationNames[ op ], m,
+                                           pthread_self(), retVal,
+                                           (unsigned long long)clocks,
+                                           (unsigned long long)time,
+                                           (unsigned long long)seq );
+                else
+                    this->outputFormatted( buffer,
+                                           "Op: %s Object: %p Thread: %lu "
+                                           "RetCode: %d Clocks: %llu "
+                                           "Time: %llu\n",
+                                           operationNames[ op ], m,
+                                           pthread_self(), retVal,
+                                           (unsigned long long)clocks,
+                                           (unsigned long long)time );
+                if ( stack && stackAddresses )
+                    this->saveAddresses( buffer, addresses, count );
+                else if ( stack )
+                    this->saveStack( buffer );
+                return;
+            }
+
+            BinaryOperation     record;
+
+            if ( !stack )
+                record.stack = 0;
+            else if ( buffer != 0 )
+            {
+                // The frames and stacks are written to the log file directly
+                // so they always precede the buffered records using them
+                this->lockFunction( &outputLock );
+                record.stack = this->saveBinaryStack( addresses, count );
+                this->unlockFunction( &outputLock );
+            }
+            else
+                record.stack = this->saveBinaryStack( addresses, count );
+
+            record.type = 'O';
+            record.op = op;
+            record.ret = retVal;
+            record.object = (uint64_t)(uintptr_t)m;
+            record.thread = (uint64_t)pthread_self();
+            record.clocks = clocks;
+            record.time = time;
+            record.seq = seq;
+            this->output( buffer, &record, sizeof( record ) );
+        }
+
+        // Based on: http://idlebox.net/2008/0901-stacktrace-demangled/
+        void getStack( vector<string> &  frames )
+        {
             this->registerThread();
 
             // storage array for stack trace address data
@@ -233,7 +915,8 @@ class PthreadWrapper
             int         addrlen = backtrace( addrlist, 1024 );
             if ( addrlen == 0 )
             {
-                this->write( "Bt:  <empty, possibly corrupt>\n" );
+                frames.push_back( "<empty, possibly corrupt>" );
+                this->unregisterThread();
                 return;
             }
 
@@ -245,10 +928,14 @@ class PthreadWrapper
             size_t      funcnamesize = 256;
             char *      funcname = (char*) malloc( funcnamesize );
 
-            // iterate over the returned symbol lines. skip the first, it is the
-            // address of this function. skip the second, it is the address of
-            // the pthread_mutex_zzz(...) from libmi.so
-            for ( int i = 2; i < addrlen; i++ )
+            // iterate over the returned symbol lines. skip the leading ones
+            // which are the addresses of this library functions including the
+            // pthread_mutex_zzz(...) from libmi.so
+            int         first( 0 );
+            while ( first < addrlen && isLibmiAddress( addrlist[ first ] ) )
+                ++first;
+
+            for ( int i = first; i < addrlen; i++ )
             {
                 char *  begin_name = 0;
                 char *  begin_offset = 0;
@@ -282,21 +969,23 @@ class PthreadWrapper
                     if ( status == 0 )
                     {
                         funcname = ret; // use possibly realloc()-ed string
-                        this->write( "Bt:  %s : %s+%s\n",
-                                     symbollist[i], funcname, begin_offset );
+                        frames.push_back( formatString( "%s : %s+%s",
+                                                        symbollist[i], funcname,
+                                                        begin_offset ) );
                     }
                     else
                     {
                         // demangling failed. Output function name as a C function
                         // with no arguments.
-                        this->write( "Bt:  %s : %s()+%s\n",
-                                     symbollist[i], begin_name, begin_offset );
+                        frames.push_back( formatString( "%s : %s()+%s",
+                                                        symbollist[i], begin_name,
+                                                        begin_offset ) );
                     }
                 }
                 else
                 {
                     // couldn't parse the line? print the whole line.
-                    this->write( "Bt:  %s\n", symbollist[i] );
+                    frames.push_back( symbollist[i] );
                 }
             }
 
@@ -305,6 +994,206 @@ class PthreadWrapper
             this->unregisterThread();
         }
 
+        void saveStack( ThreadBuffer *  buffer )
+        {
+            if ( !putStackTrace )   return;
+
+            vector<string>      frames;
+            this->getStack( frames );
+            for ( size_t  k = 0; k < frames.size(); ++k )
+                this->outputFormatted( buffer, "Bt:  %s\n", frames[k].c_str() );
+        }
+
+        // dl_iterate_phdr() callback which registers a loaded module
+        static int  registerModule( struct dl_phdr_info *  info, size_t  size,
+                                    void *  wrapper )
+        {
+            ((PthreadWrapper *)wrapper)->addModule( info );
+            return 0;
+        }
+
+        // Remembers the module address range and writes it to the log if
+        // the module is not known yet. The modulesLock must be locked.
+        void  addModule( const struct dl_phdr_info *  info )
+        {
+            ModuleRange     range( getModuleRange( info ) );
+
+            if ( range.end == 0 )                           return;
+            if ( isKnownAddress( (void *)range.start ) )    return;
+            if ( modulesCount >= maxModules )               return;
+
+            // The main executable has no name
+            string      path( info->dlpi_name );
+            if ( path.empty() )
+            {
+                char        buffer[ 4096 ];
+                ssize_t     length( readlink( "/proc/self/exe", buffer,
+                                              sizeof( buffer ) - 1 ) );
+                if ( length > 0 )   path = string( buffer, length );
+                else                path = "unknown";
+            }
+
+            modules[ modulesCount ] = range;
+            __sync_synchronize();
+            modulesCount = modulesCount + 1;
+            this->writeEnv( "module: 0x%lx 0x%lx 0x%lx %s",
+                            (unsigned long)range.start,
+                            (unsigned long)range.end,
+                            (unsigned long)info->dlpi_addr, path.c_str() );
+        }
+
+        // Writes the modules which are loaded but not known yet.
+        // The outputLock is locked if it is not locked by the caller.
+        void  registerModules( bool  locked )
+        {
+            if ( !locked )  this->lockFunction( &outputLock );
+            this->lockFunction( &modulesLock );
+            dl_iterate_phdr( registerModule, this );
+            this->unlockFunction( &modulesLock );
+            if ( !locked )  this->unlockFunction( &outputLock );
+        }
+
+        // Collects the stack return addresses without the libmi.so ones.
+        // The modules loaded since the last check are written to the log.
+        int  getAddresses( void **  addresses, bool  locked )
+        {
+            this->registerThread();
+
+            // locks a mutex internally!
+            int         count( backtrace( addresses, maxFrames ) );
+            int         first( 0 );
+            while ( first < count && isLibmiAddress( addresses[ first ] ) )
+                ++first;
+
+            for ( int  k = first; k < count; ++k )
+            {
+                if ( !isKnownAddress( addresses[ k ] ) )
+                {
+                    this->registerModules( locked );
+                    break;
+                }
+            }
+
+            this->unregisterThread();
+            memmove( addresses, addresses + first,
+                     ( count - first ) * sizeof( void * ) );
+            return count - first;
+        }
+
+        // Writes the Bt: lines of the return addresses
+        void saveAddresses( ThreadBuffer *  buffer, void **  addresses,
+                            int  count )
+        {
+            static const char *     digits = "0123456789abcdef";
+            char                    lines[ 4096 ];
+            size_t                  length( 0 );
+
+            for ( int  k = 0; k < count; ++k )
+            {
+                if ( length + 32 > sizeof( lines ) )
+                {
+                    this->output( buffer, lines, length );
+                    length = 0;
+                }
+
+                char                hex[ 2 * sizeof( void * ) ];
+                int                 size( 0 );
+                uintptr_t           address( (uintptr_t)addresses[ k ] );
+                do
+                {
+                    hex[ size++ ] = digits[ address & 0xf ];
+                    address >>= 4;
+                } while ( address != 0 );
+
+                memcpy( lines + length, "Bt:  0x", 7 );
+                length += 7;
+                while ( size > 0 )
+                    lines[ length++ ] = hex[ --size ];
+                lines[ length++ ] = '\n';
+            }
+            if ( length > 0 )
+                this->output( buffer, lines, length );
+        }
+
+        // Provides the address only stack frame IDs,
+        // writes the new frames if needed
+        void getAddressFrames( vector<uint32_t> &  stack,
+                               void **  addresses, int  count )
+        {
+            for ( int  k = 0; k < count; ++k )
+            {
+                map<void *, uint32_t>::iterator   found( addressIDs.find( addresses[k] ) );
+                if ( found != addressIDs.end() )
+                {
+                    stack.push_back( found->second );
+                    continue;
+                }
+
+                uint32_t    frameID( addressIDs.size() + 1 );
+                char        text[ 32 ];
+                uint32_t    length( snprintf( text, sizeof( text ), "0x%lx",
+                                              (unsigned long)addresses[k] ) );
+                addressIDs[ addresses[k] ] = frameID;
+                stack.push_back( frameID );
+
+                this->writeData( "F", 1 );
+                this->writeData( &frameID, sizeof( frameID ) );
+                this->writeData( &length, sizeof( length ) );
+                this->writeData( text, length );
+            }
+        }
+
+        // Provides the stack ID, writes the new frames and stack if needed.
+        // The return addresses are the collected ones in the addresses mode.
+        // 0 - no stack trace
+        uint32_t saveBinaryStack( void **  addresses, int  addressCount )
+        {
+            if ( !putStackTrace )   return 0;
+
+            vector<string>      frames;
+            vector<uint32_t>    stack;
+
+            if ( stackAddresses )
+                this->getAddressFrames( stack, addresses, addressCount );
+            else
+                this->getStack( frames );
+            for ( size_t  k = 0; k < frames.size(); ++k )
+            {
+                map<string, uint32_t>::iterator   found( frameIDs.find( frames[k] ) );
+                if ( found != frameIDs.end() )
+                {
+                    stack.push_back( found->second );
+                    continue;
+                }
+
+                uint32_t    frameID( frameIDs.size() + 1 );
+                uint32_t    length( frames[k].size() );
+                frameIDs[ frames[k] ] = frameID;
+                stack.push_back( frameID );
+
+                this->writeData( "F", 1 );
+                this->writeData( &frameID, sizeof( frameID ) );
+                this->writeData( &length, sizeof( length ) );
+                this->writeData( frames[k].data(), length );
+            }
+
+            map<vector<uint32_t>, uint32_t>::iterator   found( stackIDs.find( stack ) );
+            if ( found != stackIDs.end() )
+                return found->second;
+
+            uint32_t    stackID( stackIDs.size() + 1 );
+            uint32_t    count( stack.size() );
+            stackIDs[ stack ] = stackID;
+
+            this->writeData( "S", 1 );
+            this->writeData( &stackID, sizeof( stackID ) );
+            this->writeData( &count, sizeof( count ) );
+            if ( count > 0 )
+                this->writeData( &stack[0], sizeof( uint32_t ) * count );
+            return stackID;
+        }
+
+        uint64_t        getTicks( void )           const { return clock.Ticks(); }
         mutex_function  getLockFunction( void )    const { return lockFunction; }
         mutex_function  getUnlockFunction( void )  const { return unlockFunction; }
         mutex_function  getTrylockFunction( void ) const { return trylockFunction; }
@@ -314,6 +1203,14 @@ class PthreadWrapper
 
 static PthreadWrapper   pw;
 
+
+// Called at a thread exit
+static void  releaseThreadBuffer( void *  buffer )
+{
+    pw.releaseBuffer( (ThreadBuffer *) buffer );
+}
+
+
 extern "C"
 {
     // Instrumented functions
@@ -325,15 +1222,11 @@ extern "C"
             return pw.getLockFunction()( m );
         }
 
-        PreciseTime     before( PreciseTime::Current() );
+        uint64_t        before( pw.getTicks() );
         int             retVal( pw.getLockFunction()( m ) );
-        PreciseTime     after( PreciseTime::Current() );
+        uint64_t        after( pw.getTicks() );
 
-        pw.getLockFunction()( &outputLock );
-        pw.write( "Op: lock Object: %p Thread: %lu RetCode: %d Clocks: %f\n",
-                  m, pthread_self(), retVal, (double)( after - before ) );
-        pw.saveStack();
-        pw.getUnlockFunction()( &outputLock );
+        pw.logOperation( OpLock, m, retVal, after - before, after );
 
         return retVal;
     }
@@ -345,15 +1238,11 @@ extern "C"
             return pw.getUnlockFunction()( m );
         }
 
-        PreciseTime     before( PreciseTime::Current() );
+        uint64_t        before( pw.getTicks() );
         int             retVal( pw.getUnlockFunction()( m ) );
-        PreciseTime     after( PreciseTime::Current() );
+        uint64_t        after( pw.getTicks() );
 
-        pw.getLockFunction()( &outputLock );
-        pw.write( "Op: unlock Object: %p Thread: %lu RetCode: %d Clocks: %f\n",
-                  m, pthread_self(), retVal, (double)( after - before ) );
-        pw.saveStack();
-        pw.getUnlockFunction()( &outputLock );
+        pw.logOperation( OpUnlock, m, retVal, after - before, before );
 
         return retVal;
     }
@@ -362,18 +1251,14 @@ extern "C"
     {
         if ( pw.isProcessed() )
         {
-            pw.getTrylockFunction()( m );
+            return pw.getTrylockFunction()( m );
         }
 
-        PreciseTime     before( PreciseTime::Current() );
+        uint64_t        before( pw.getTicks() );
         int             retVal( pw.getTrylockFunction()( m ) );
-        PreciseTime     after( PreciseTime::Current() );
+        uint64_t        after( pw.getTicks() );
 
-        pw.getLockFunction()( &outputLock );
-        pw.write( "Op: trylock Object: %p Thread: %lu RetCode: %d Clocks: %f\n",
-                  m, pthread_self(), retVal, (double)( after - before ) );
-        pw.saveStack();
-        pw.getUnlockFunction()( &outputLock );
+        pw.logOperation( OpTrylock, m, retVal, after - before, after );
 
         return retVal;
     }
@@ -180,10 +180,16 @@ def miMain():
 
     # Check for the options
     if options != "":
-        if not options in [ "stack" ]:
-            print >> sys.stderr, "Unsupported option '" + options + "'. " \
-                     " Type: " + sys.argv[0] + " --help for usage."
-            return 2
+        for option in options.split( "," ):
+            name, value = ( option.split( "=", 1 ) + [ "" ] )[ : 2 ]
+            if name in [ "sample", "threshold", "stackthreshold" ] and \
+               value.isdigit() and int( value ) > 0:
+                continue
+            if not option in [ "stack", "addresses", "binary",
+                               "buffered", "gzip", "zstd", "lz4" ]:
+                print >> sys.stderr, "Unsupported option '" + option + "'. " \
+                         " Type: " + sys.argv[0] + " --help for usage."
+                return 2
 
 
     # Form the executable command line
@@ -283,8 +289,22 @@ MI_LIBPTHREAD - path to the system pthread library. If the variable is not set
                 then mi will look for the path to the library using ldd on the
                 given program to be analysed
 MI_LOGFILE    - path to the log file where the collected information is stored
-MI_OPTIONS    - accepted values:
-                stack - accompany each operation with a stack trace (slow)
+MI_OPTIONS    - comma separated list of the values:
+                stack  - accompany each operation with a stack trace (slow)
+                addresses - accompany each operation with the stack trace
+                            return addresses only, statmi.py resolves them
+                binary - write the log in a compact binary format
+                buffered - collect the records in per thread buffers and
+                           write them in bulk
+                sample=N - record 1 of N lock operations per mutex
+                           and their unlocks
+                threshold=NS - record only the lock operations which took
+                               at least NS nanoseconds and their unlocks
+                stackthreshold=NS - accompany only the operations which
+                                    took at least NS nanoseconds with a
+                                    stack trace
+                gzip, zstd, lz4 - compress the log (also chosen by the log
+                                  file name extension .gz, .zst, .lz4)
 
 Usage:
 mi [me option keys] [--] <program to analyse> [program option keys]
@@ -293,7 +313,7 @@ mi option keys:
 --verbose, -v         be verbose
 --logfile, -l <path>  path to the log file (overwrites MI_LOGFILE)
 --pthread, -p <path>  path the libpthread.so (overwrites MI_LIBPTHREAD)
---option,  -o <val>   at the moment the only accepted value is 'stack'
+--option,  -o <val>   comma separated list of the MI_OPTIONS values
                       (overwrites MI_OPTIONS)
 --libmi,   -m <path>  path to libmi.so. Default: the same as this script.
 --                    explicitly separates mi option keys from the program
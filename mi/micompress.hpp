@@ -0,0 +1,240 @@
+//
+// File:   micompress.hpp
+//
+// Permission to copy, use, modify, sell and distribute this software
+// is granted provided this copyright notice appears in all copies.
+// This software is provided "as is" without express or implied
+// warranty, and with no claim as to its suitability for any purpose.
+//
+
+
+#ifndef MICOMPRESS__HPP
+#define MICOMPRESS__HPP
+
+# include <dlfcn.h>
+# include <string.h>
+# include <stdint.h>
+# include <string>
+# include <vector>
+
+
+// Compressed log output. The log is compressed in independent blocks and
+// each block holds whole records, so the blocks of a log can be
+// decompressed and parsed separately:
+// gzip       - a gzip member with the 'MI' extra subfield which holds the
+//              uint32 member size. gzip reads such files as usual.
+// zstd, lz4  - a skippable frame which holds the uint32 size of the
+//              following compressed frame, then the frame.
+// The compression libraries are loaded at run time so libmi.so does not
+// depend on them.
+class BlockCompressor
+{
+    public:
+        enum Format
+        {
+            None    = 0,
+            Gzip    = 1,
+            Zstd    = 2,
+            Lz4     = 3
+        };
+
+    private:
+        // zlib
+        typedef int (*compress2_function)( unsigned char *, unsigned long *,
+                                           const unsigned char *,
+                                           unsigned long, int );
+        typedef unsigned long (*compressBound_function)( unsigned long );
+        typedef unsigned long (*crc32_function)( unsigned long,
+                                                 const unsigned char *,
+                                                 unsigned int );
+        // zstd and lz4 frame
+        typedef size_t (*zstdBound_function)( size_t );
+        typedef size_t (*zstd_function)( void *, size_t, const void *,
+                                         size_t, int );
+        typedef size_t (*lz4Bound_function)( size_t, const void * );
+        typedef size_t (*lz4_function)( void *, size_t, const void *,
+                                        size_t, const void * );
+        typedef unsigned (*error_function)( size_t );
+
+        Format                  format;
+        void *                  handle;         // compression library
+        compress2_function      compress2;
+        compressBound_function  compressBound;
+        crc32_function          crc32;
+        zstdBound_function      zstdBound;
+        zstd_function           zstdCompress;
+        lz4Bound_function       lz4Bound;
+        lz4_function            lz4Compress;
+        error_function          isError;
+        std::string             error;
+
+        static const uint32_t   skippableMagic = 0x184D2A5D;
+        static const size_t     gzipHeaderSize = 20;
+
+        static void  PutUint32( char *  buffer, uint32_t  value )
+        {
+            // Little endian regardless of the platform
+            buffer[0] = value & 0xFF;
+            buffer[1] = ( value >> 8 ) & 0xFF;
+            buffer[2] = ( value >> 16 ) & 0xFF;
+            buffer[3] = ( value >> 24 ) & 0xFF;
+        }
+
+        void *  Symbol( const char *  name )
+        {
+            dlerror();
+            void *          symbol( dlsym( handle, name ) );
+            const char *    err( dlerror() );
+            if ( err != 0 && error.empty() )    error = err;
+            return symbol;
+        }
+
+        // The zlib stream of compress2() is a 2 bytes header, the raw
+        // deflate data and a 4 bytes adler32; the gzip member takes the
+        // deflate data only
+        bool  CompressGzip( const char *  data, size_t  size,
+                            std::vector<char> &  block )
+        {
+            unsigned long   length( compressBound( size ) );
+            block.resize( gzipHeaderSize + length );
+            if ( compress2( (unsigned char *)&block[ gzipHeaderSize - 2 ],
+                            &length, (const unsigned char *)data, size,
+                            1 ) != 0 || length < 6 )
+                return false;
+
+            static const char   header[] = { '\x1f', '\x8b', 8, 4,
+                                             0, 0, 0, 0, 0, 3,
+                                             8, 0, 'M', 'I', 4, 0 };
+            size_t      deflateSize( length - 6 );
+            size_t      memberSize( gzipHeaderSize + deflateSize + 8 );
+            memcpy( &block[0], header, sizeof( header ) );
+            PutUint32( &block[ sizeof( header ) ], memberSize );
+
+            block.resize( memberSize );
+            PutUint32( &block[ gzipHeaderSize + deflateSize ],
+                       crc32( 0, (const unsigned char *)data, size ) );
+            PutUint32( &block[ gzipHeaderSize + deflateSize + 4 ], size );
+            return true;
+        }
+
+        bool  CompressFrame( const char *  data, size_t  size,
+                             std::vector<char> &  block )
+        {
+            size_t      length;
+            if ( format == Zstd )
+            {
+                length = zstdBound( size );
+                block.resize( 12 + length );
+                length = zstdCompress( &block[ 12 ], length, data, size, 1 );
+            }
+            else
+            {
+                // The default frame preferences
+                length = lz4Bound( size, 0 );
+                block.resize( 12 + length );
+                length = lz4Compress( &block[ 12 ], length, data, size, 0 );
+            }
+            if ( isError( length ) )
+                return false;
+
+            PutUint32( &block[0], skippableMagic );
+            PutUint32( &block[4], 4 );
+            PutUint32( &block[8], length );
+            block.resize( 12 + length );
+            return true;
+        }
+
+    public:
+        BlockCompressor( void ) :
+            format( None ), handle( 0 ), compress2( 0 ), compressBound( 0 ),
+            crc32( 0 ), zstdBound( 0 ), zstdCompress( 0 ), lz4Bound( 0 ),
+            lz4Compress( 0 ), isError( 0 )
+        {}
+
+        ~BlockCompressor()
+        {
+            if ( handle != 0 )  dlclose( handle );
+        }
+
+        // The format of the MI_OPTIONS value or None
+        static Format  FromName( const std::string &  name )
+        {
+            if ( name == "gzip" )   return Gzip;
+            if ( name == "zstd" )   return Zstd;
+            if ( name == "lz4" )    return Lz4;
+            return None;
+        }
+
+        // The format of the log file name extension or None
+        static Format  FromPath( const char *  path )
+        {
+            const char *    extension( strrchr( path, '.' ) );
+            if ( extension == 0 )                   return None;
+            if ( strcmp( extension, ".gz" ) == 0 )  return Gzip;
+            if ( strcmp( extension, ".zst" ) == 0 ) return Zstd;
+            if ( strcmp( extension, ".lz4" ) == 0 ) return Lz4;
+            return None;
+        }
+
+        // Loads the compression library.
+        // Provides the error message or 0 if succeeded.
+        const char *  Open( Format  f )
+        {
+            format = f;
+            error.clear();
+            handle = dlopen( Library(), RTLD_LAZY );
+            if ( handle == 0 )
+            {
+                error = dlerror();
+                return error.c_str();
+            }
+
+            if ( format == Gzip )
+            {
+                compress2 = (compress2_function)Symbol( "compress2" );
+                compressBound = (compressBound_function)Symbol( "compressBound" );
+                crc32 = (crc32_function)Symbol( "crc32" );
+            }
+            else if ( format == Zstd )
+            {
+                zstdBound = (zstdBound_function)Symbol( "ZSTD_compressBound" );
+                zstdCompress = (zstd_function)Symbol( "ZSTD_compress" );
+                isError = (error_function)Symbol( "ZSTD_isError" );
+            }
+            else
+            {
+                lz4Bound = (lz4Bound_function)Symbol( "LZ4F_compressFrameBound" );
+                lz4Compress = (lz4_function)Symbol( "LZ4F_compressFrame" );
+                isError = (error_function)Symbol( "LZ4F_isError" );
+            }
+            if ( error.empty() )    return 0;
+            return error.c_str();
+        }
+
+        const char *  Name( void ) const
+        {
+            if ( format == Gzip )   return "gzip";
+            if ( format == Zstd )   return "zstd";
+            return "lz4";
+        }
+
+        const char *  Library( void ) const
+        {
+            if ( format == Gzip )   return "libz.so.1";
+            if ( format == Zstd )   return "libzstd.so.1";
+            return "liblz4.so.1";
+        }
+
+        // Compresses the data into a single block.
+        // Returns false if the data could not be compressed.
+        bool  Compress( const char *  data, size_t  size,
+                        std::vector<char> &  block )
+        {
+            if ( format == Gzip )
+                return CompressGzip( data, size, block );
+            return CompressFrame( data, size, block );
+        }
+};
+
+
+#endif /* MICOMPRESS__HPP */
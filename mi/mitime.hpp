@@ -1,5 +1,5 @@
 //
-// File:   mi.cpp
+// File:   mitime.hpp
 //
 // Author: Sergey Satskiy, copyright (c) 2009 - 2012
 //
@@ -18,6 +18,11 @@
 #define MITIME__HPP
 
 # include <sys/time.h>
+# include <time.h>
+# include <stdint.h>
+# if defined( __i386__ ) || defined( __x86_64__ )
+#  include <cpuid.h>
+# endif
 
 
 class PreciseTime : public timespec
@@ -41,6 +46,14 @@ class PreciseTime : public timespec
             return result;
         }
 
+        // Not affected by the system time changes
+        static PreciseTime  Monotonic( void )
+        {
+            PreciseTime    result;
+            clock_gettime( CLOCK_MONOTONIC, &result );
+            return result;
+        }
+
         PreciseTime( void )
         {
             tv_sec = 0;
@@ -153,5 +166,93 @@ bool operator != ( const PreciseTime &  lhs,
 }
 
 
+
+// Low overhead monotonic clock. The time stamp counter is read if the CPU
+// has the invariant one (it runs at a constant rate in all the power states
+// and is synchronised between the cores), otherwise CLOCK_MONOTONIC
+// nanoseconds are used. The ticks rate is calibrated at construction: it
+// sleeps for 20 ms, i.e. delays the start of the traced application. The
+// calibration is skipped if the time stamp counter is not allowed.
+class TickClock
+{
+    private:
+        bool        useTSC;
+        double      ticksPerSecond;
+        double      nsPerTick;
+
+        static uint64_t  MonotonicNanoseconds( void )
+        {
+            struct timespec     t;
+            clock_gettime( CLOCK_MONOTONIC, &t );
+            return (uint64_t)t.tv_sec * 1000000000ULL + t.tv_nsec;
+        }
+
+        static bool  HasInvariantTSC( void )
+        {
+# if defined( __i386__ ) || defined( __x86_64__ )
+            unsigned int    eax, ebx, ecx, edx;
+            if ( __get_cpuid( 0x80000000, &eax, &ebx, &ecx, &edx ) == 0 ||
+                 eax < 0x80000007 )
+                return false;
+            __get_cpuid( 0x80000007, &eax, &ebx, &ecx, &edx );
+            return ( edx & ( 1 << 8 ) ) != 0;
+# else
+            return false;
+# endif
+        }
+
+    public:
+        TickClock( bool  allowTSC = true ) :
+            useTSC( allowTSC && HasInvariantTSC() ), ticksPerSecond( 1e9 ),
+            nsPerTick( 1.0 )
+        {
+            if ( !useTSC )  return;
+
+            // 20ms of the monotonic clock against the time stamp counter
+            struct timespec     pause = { 0, 20000000 };
+            uint64_t            startNs( MonotonicNanoseconds() );
+            uint64_t            startTicks( Ticks() );
+            nanosleep( &pause, 0 );
+            uint64_t            endNs( MonotonicNanoseconds() );
+            uint64_t            endTicks( Ticks() );
+
+            if ( endNs <= startNs || endTicks <= startTicks )
+            {
+                useTSC = false;
+                return;
+            }
+            ticksPerSecond = (double)( endTicks - startTicks ) * 1e9 /
+                             (double)( endNs - startNs );
+            nsPerTick = 1e9 / ticksPerSecond;
+        }
+
+        uint64_t  Ticks( void ) const
+        {
+# if defined( __i386__ ) || defined( __x86_64__ )
+            if ( useTSC )
+            {
+                uint32_t    low, high;
+                __asm__ __volatile__( "rdtsc" : "=a" ( low ), "=d" ( high ) );
+                return ( (uint64_t)high << 32 ) | low;
+            }
+# endif
+            return MonotonicNanoseconds();
+        }
+
+        // Converts a number of ticks to nanoseconds
+        uint64_t  Nanoseconds( uint64_t  ticks ) const
+        {
+            if ( !useTSC )  return ticks;
+            return (uint64_t)( (double)ticks * nsPerTick + 0.5 );
+        }
+
+        const char *  Source( void ) const
+        { return useTSC ? "tsc" : "monotonic"; }
+
+        double  TicksPerSecond( void ) const
+        { return ticksPerSecond; }
+};
+
+
 #endif /* MITIME__HPP */
 
@@ -19,7 +19,9 @@
 statmi - statistics of mutex instrumentation
 """
 
-import sys, os, os.path
+import sys, os, os.path, re, mmap, struct, heapq, math, multiprocessing
+import hashlib, zlib, cPickle, time, subprocess, resource, json, cProfile
+import glob, bisect, threading
 from optparse import OptionParser
 from mi       import getExceptionInfo
 
@@ -29,6 +31,11 @@ __author__  = "Sergey Satskiy <sergey.satskiy@gmail.com>"
 
 warningsCount = 0
 errorsCount = 0
+findingsLimit = 1000        # 0 - no limit
+cycleSearchLimit = 1000000  # lock order cycle search steps per component
+findings = {}               # finding signature -> [ number, occurrences ]
+phaseStatistics = None      # PhaseStatistics if --stats is given
+reportWriter = None         # ReportWriter if --json is given
 
 
 class Env:
@@ -41,22 +48,390 @@ class Env:
     def __repr__( self ):
         return self.__str__()
 
-class Op:
+class FrameTable:
+    """ Interned backtrace frames and stacks shared by all the operations.
+        A stack is identified by an integer so the operations backtraces
+        are compared as integers """
+
+    def __init__( self ):
+        self.ids = {}           # frame -> frame ID
+        self.frames = []        # frame ID -> frame
+        self.stackIDs = { (): 0 }   # frame IDs -> stack ID
+        self.stacks = [ () ]    # stack ID -> frame IDs, 0 - no backtrace
+        self.blocks = {}        # Bt: lines block -> stack ID
+        self.symbolizer = None  # resolves the frames to be printed if set
+        self.resolved = []      # frame ID -> resolved frame
+        self.modules = []       # sorted ( start, end, load bias, path )
+
+    def getID( self, frame ):
+        """ provides an existed or a newly registered frame ID """
+        try:
+            return self.ids[ frame ]
+        except KeyError:
+            frameID = len( self.frames )
+            self.ids[ frame ] = frameID
+            self.frames.append( frame )
+            return frameID
+
+    def getStackID( self, frameIDs ):
+        """ provides an existed or a newly registered stack ID """
+        try:
+            return self.stackIDs[ frameIDs ]
+        except KeyError:
+            stackID = len( self.stacks )
+            self.stackIDs[ frameIDs ] = stackID
+            self.stacks.append( frameIDs )
+            return stackID
+
+    def getBlockStackID( self, block ):
+        """ provides the stack ID of a log file Bt: lines block """
+        try:
+            return self.blocks[ block ]
+        except KeyError:
+            frameIDs = tuple( [ self.getID( self.getAddressFrame(
+                                        line.replace( "Bt: ", "" ).strip() ) )
+                                for line in block.split( "\n" )
+                                if line.startswith( "Bt: " ) ] )
+            stackID = self.getStackID( frameIDs )
+            self.blocks[ block ] = stackID
+            return stackID
+
+    def addModule( self, statement ):
+        """ registers a loaded module of the 'module: start end bias path'
+            Env: statement """
+        parts = statement.split( None, 4 )
+        module = ( int( parts[ 1 ], 16 ), int( parts[ 2 ], 16 ),
+                   int( parts[ 3 ], 16 ), parts[ 4 ] )
+        if not module in self.modules:
+            bisect.insort( self.modules, module )
+        return
+
+    def getAddressFrame( self, frame ):
+        """ provides the 'module : ??+offset' frame for a return address
+            frame (MI_OPTIONS=addresses) so the frames of the same code are
+            the same in all the logs. The Symbolizer resolves them """
+        if not frame.startswith( "0x" ):
+            return frame
+        address = int( frame, 16 )
+        index = bisect.bisect_right( self.modules,
+                                     ( address, sys.maxint ) ) - 1
+        if index < 0:
+            return frame
+        start, end, bias, path = self.modules[ index ]
+        if address >= end:
+            return frame
+        return path + " : ??+" + hex( address - bias ).rstrip( "L" )
+
+    def getState( self ):
+        """ provides the registered frames and stacks """
+        return ( self.frames, self.stacks )
+
+    def addState( self, state ):
+        """ registers the frames and stacks of another table.
+            Provides the frame IDs map and the stack IDs map """
+        frames, stacks = state
+        frameMap = [ self.getID( frame ) for frame in frames ]
+        stackMap = [ self.getStackID( tuple( [ frameMap[ frameID ]
+                                               for frameID in frameIDs ] ) )
+                     for frameIDs in stacks ]
+        return frameMap, stackMap
+
+    def setState( self, state ):
+        """ replaces the frames and stacks with the previously registered """
+        self.frames, self.stacks = state
+        self.ids = dict( [ ( frame, frameID )
+                           for frameID, frame in enumerate( self.frames ) ] )
+        self.stackIDs = dict( [ ( frameIDs, stackID )
+                                for stackID, frameIDs
+                                in enumerate( self.stacks ) ] )
+        self.blocks = {}
+        self.resolved = []
+        return
+
+    def getFrame( self, frameID ):
+        """ provides the frame text. The frames registered so far are
+            resolved in one go when the first of them is required """
+        if self.symbolizer is None:
+            return self.frames[ frameID ]
+        if frameID >= len( self.resolved ):
+            self.resolved.extend( self.symbolizer.symbolize(
+                                    self.frames[ len( self.resolved ) : ] ) )
+        return self.resolved[ frameID ]
+
+    def getStack( self, stackID ):
+        """ provides the frames texts of the stack """
+        return [ self.getFrame( frameID ) for frameID in self.stacks[ stackID ] ]
+
+
+frameTable = FrameTable()
+
+
+# Backtrace frame as formatted by libmi.so: module : function+offset
+frameRegexp = re.compile( r"^(.+) : (.*)\+(0x[0-9a-fA-F]+)$" )
+
+
+def getSections( f ):
+    """ provides the ELF file byte order and the list of the section
+        headers as ( name, type, flags, address, offset, size ).
+        The list is empty if it is not an ELF file """
+
+    f.seek( 0 )
+    header = f.read( 64 )
+    if len( header ) != 64 or header[ : 4 ] != "\x7fELF":
+        return "<", []
+
+    byteOrder = { 1: "<", 2: ">" }.get( ord( header[ 5 ] ), "<" )
+    if ord( header[ 4 ] ) == 2:
+        headerFormat, sectionFormat = "HHIQQQIHHHHHH", "IIQQQQ"
+    else:
+        headerFormat, sectionFormat = "HHIIIIIHHHHHH", "IIIIII"
+    values = struct.unpack_from( byteOrder + headerFormat, header, 16 )
+    sectionsOffset = values[ 5 ]
+    sectionSize, sectionsCount = values[ 10 ], values[ 11 ]
+    sections = []
+    for index in range( 0, sectionsCount ):
+        f.seek( sectionsOffset + index * sectionSize )
+        sections.append( struct.unpack( byteOrder + sectionFormat,
+                                        f.read( struct.calcsize(
+                                                    sectionFormat ) ) ) )
+    return byteOrder, sections
+
+
+def getFunctions( path ):
+    """ provides the sorted [ ( start, end, name ), ... ] of the functions
+        of an ELF file: the symbol table ones and the dynamic ones. The
+        addresses are the module offsets the frames refer to """
+
+    functions = {}      # start -> ( start, end, name )
+    for options in [ [], [ "-D" ] ]:
+        try:
+            process = subprocess.Popen( [ "nm", "-C", "-S", "--defined-only" ] +
+                                        options + [ path ],
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.PIPE )
+        except OSError:
+            return []
+        for line in process.communicate()[ 0 ].split( "\n" ):
+            parts = line.split( None, 3 )
+            if len( parts ) != 4 or \
+               not parts[ 2 ] in [ "T", "t", "W", "w", "i" ]:
+                continue
+            start, size = int( parts[ 0 ], 16 ), int( parts[ 1 ], 16 )
+            if size > 0 and not functions.has_key( start ):
+                functions[ start ] = ( start, start + size, parts[ 3 ] )
+    return sorted( functions.values() )
+
+
+def getBuildID( path ):
+    """ provides the GNU build ID of an ELF file or the file content hash
+        if there is no build ID """
+
+    f = open( path, "rb" )
+    try:
+        byteOrder, sections = getSections( f )
+        for section in sections:
+            if section[ 1 ] != 7:        # SHT_NOTE
+                continue
+            f.seek( section[ 4 ] )
+            notes = f.read( section[ 5 ] )
+            position = 0
+            while position + 12 <= len( notes ):
+                nameSize, descSize, noteType = \
+                    struct.unpack_from( byteOrder + "III", notes, position )
+                position += 12
+                name = notes[ position : position + nameSize ]
+                position += ( nameSize + 3 ) & ~3
+                desc = notes[ position : position + descSize ]
+                position += ( descSize + 3 ) & ~3
+                if noteType == 3 and name.rstrip( "\0" ) == "GNU":
+                    return desc.encode( "hex" )
+
+        f.seek( 0 )
+        digest = hashlib.md5()
+        while True:
+            block = f.read( 1024 * 1024 )
+            if block == "":
+                break
+            digest.update( block )
+        return digest.hexdigest()
+    finally:
+        f.close()
+
+
+symbolsVersion = 2      # the resolved frames cache format
+
+
+class Symbolizer:
+    """ Resolves the return address frames (MI_OPTIONS=addresses) and,
+        if required, the backtrace frames which libmi.so could not name
+        (static functions, stripped dynamic symbols) with addr2line.
+        The resolved addresses are cached on disk per module build ID so
+        the analysis of another log of the same binary does not run
+        addr2line again """
+
+    def __init__( self, cacheDir, searchPath, unnamed ):
+        self.cacheDir = cacheDir
+        self.searchPath = searchPath    # directories to look for modules in
+        self.unnamed = unnamed          # resolve the frames without names?
+        self.modules = {}               # path -> [ cache file name,
+                                        #   { offset -> symbol } ]
+
+    def findModule( self, module ):
+        """ provides the path to the module file or None """
+        if os.path.isfile( module ):
+            return module
+        for directory in self.searchPath:
+            path = os.path.join( directory, os.path.basename( module ) )
+            if os.path.isfile( path ):
+                return path
+        return None
+
+    def symbolize( self, frames ):
+        """ provides the list of the frames with the resolved names """
+
+        modules = {}    # module -> { offset -> [ frame index, ... ] }
+        for index in range( 0, len( frames ) ):
+            match = frameRegexp.match( frames[ index ] )
+            if match is None:
+                continue
+            if match.group( 2 ) != "??" and \
+               ( match.group( 2 ) != "()" or not self.unnamed ):
+                continue
+            module, offset = match.group( 1 ), int( match.group( 3 ), 16 )
+            modules.setdefault( module, {} ).setdefault( offset,
+                                                         [] ).append( index )
+
+        # The frames are printed as libmi.so does in the stack mode:
+        # the offset is the one within the function
+        resolved = list( frames )
+        for module, offsets in modules.iteritems():
+            path = self.findModule( module )
+            if path is None:
+                continue
+            symbols = self.getSymbols( path, offsets.keys() )
+            for offset, indexes in offsets.iteritems():
+                function, start, location = symbols[ offset ]
+                if function is None:
+                    continue
+                if not "(" in function:
+                    function += "()"
+                frame = module + " : " + function + "+" + \
+                        hex( offset - start ).rstrip( "L" )
+                if not location.startswith( "??" ):
+                    frame += " at " + location
+                for index in indexes:
+                    resolved[ index ] = frame
+        return resolved
+
+    def getSymbols( self, path, offsets ):
+        """ provides offset -> ( function, function start, location ) for
+            the module. The function is None if no function holds the
+            offset """
+
+        if not self.modules.has_key( path ):
+            self.modules[ path ] = [ os.path.join( self.cacheDir,
+                                                   getBuildID( path ) +
+                                                   ".symbols" +
+                                                   str( symbolsVersion ) ),
+                                     None ]
+        cacheFileName, symbols = self.modules[ path ]
+        if symbols is None:
+            symbols = readStateFile( cacheFileName )
+            if symbols is None:
+                symbols = {}
+            self.modules[ path ][ 1 ] = symbols
+
+        missing = [ offset for offset in offsets
+                    if not symbols.has_key( offset ) ]
+        if len( missing ) == 0:
+            return symbols
+
+        # The offsets are return addresses so the call instruction is
+        # one byte before. The function is the symbol which holds it:
+        # addr2line provides the nearest symbol without the debug
+        # information and the inlined function name with it
+        functions = getFunctions( path )
+        starts = [ function[ 0 ] for function in functions ]
+        for start in range( 0, len( missing ), 1000 ):
+            part = missing[ start : start + 1000 ]
+            process = subprocess.Popen( [ "addr2line", "-e", path ] +
+                                        [ hex( max( offset - 1, 0 ) )
+                                          for offset in part ],
+                                        stdout = subprocess.PIPE )
+            lines = process.communicate()[ 0 ].split( "\n" )
+            if process.returncode != 0 or len( lines ) < len( part ):
+                lines = [ "??:0" ] * len( part )
+            for index in range( 0, len( part ) ):
+                address = max( part[ index ] - 1, 0 )
+                position = bisect.bisect_right( starts, address ) - 1
+                if position >= 0 and address < functions[ position ][ 1 ]:
+                    symbols[ part[ index ] ] = ( functions[ position ][ 2 ],
+                                                 functions[ position ][ 0 ],
+                                                 lines[ index ].strip() )
+                else:
+                    symbols[ part[ index ] ] = ( None, None,
+                                                 lines[ index ].strip() )
+
+        if not os.path.isdir( self.cacheDir ):
+            try:
+                os.makedirs( self.cacheDir )
+            except OSError:
+                pass
+        writeStateFile( cacheFileName, symbols )
+        return symbols
+
+
+def getNanoseconds( value ):
+    """ provides the integer nanoseconds of a log file Clocks: or Time:
+        value. libmi.so writes integer nanoseconds, the older versions
+        wrote decimal seconds which are converted exactly """
+    if not "." in value:
+        return int( value )
+    seconds, fraction = value.split( "." )
+    if seconds.isdigit() and fraction.isdigit():
+        return int( seconds ) * 1000000000 + \
+               int( ( fraction + "000000000" )[ : 9 ] )
+    return int( round( float( value ) * 1e9 ) )
+
+
+def formatSeconds( nanoseconds ):
+    """ provides the nanoseconds as decimal seconds without the trailing
+        zeros, e.g. 0.000000125 """
+    sign = ""
+    if nanoseconds < 0:
+        sign, nanoseconds = "-", -nanoseconds
+    text = ( "%d.%09d" % divmod( nanoseconds, 1000000000 ) ).rstrip( "0" )
+    if text.endswith( "." ):
+        text += "0"
+    return sign + text
+
+
+class Op( object ):
     """ Single operation """
 
-    def __init__( self, op, obj, th, ret, cl ):
-        self.operation   = op
-        self.object      = obj
-        self.thread      = th
-        self.ret         = ret
-        self.clocks      = float(cl)
-        self.backtrace   = []
+    __slots__ = [ "operation", "object", "thread", "ret", "clocks", "time",
+                  "backtrace", "shortObj", "shortThread" ]
+
+    def __init__( self, op, obj, th, ret, cl, time = None ):
+        self.operation   = intern( op )
+        self.object      = intern( obj )
+        self.thread      = intern( th )
+        self.ret         = int( ret )
+        self.clocks      = cl       # nanoseconds
+        self.time        = time     # nanoseconds since the log start or None
+        self.backtrace   = 0        # stack ID in the frameTable
         self.shortObj    = ""
         self.shortThread = ""
 
     def addBt( self, line ):
         """ Adds a back trace line """
-        self.backtrace.append( line )
+        self.backtrace = frameTable.getStackID(
+                                    frameTable.stacks[ self.backtrace ] +
+                                    ( frameTable.getID( line ), ) )
+
+    def getBacktrace( self ):
+        """ provides the back trace lines """
+        return frameTable.getStack( self.backtrace )
 
     def __str__( self ):
         return self.getPrepended( "" )
@@ -73,18 +448,23 @@ class Op:
         if self.shortThread != "":
             retVal += "(" + self.shortThread + ")"
 
-        retVal += " Return code: " + self.ret + " Clocks: " + str(self.clocks)
-        if len( self.backtrace ) == 0:
+        retVal += " Return code: " + str(self.ret) + \
+                  " Clocks: " + formatSeconds( self.clocks )
+        if self.backtrace == 0:
             return retVal
 
         return retVal + "\n" + prefix + "Backtrace:\n" + \
                                prefix + "    " + str("\n" + \
-                               prefix + "    ").join( self.backtrace )
+                               prefix + "    ").join( self.getBacktrace() )
 
 
     def __repr__( self ):
         return self.__str__()
 
+    def getKey( self ):
+        """ provides a hashable key which is the same for equal operations """
+        return ( self.operation, self.object, self.thread, self.backtrace )
+
     def __eq__( self, other ):
         return self.operation == other.operation and \
                self.object    == other.object and \
@@ -100,28 +480,469 @@ class MostConsumingOperations:
 
     def __init__( self, lim ):
         self.limit = lim
-        self.operations = []
+        self.heap = []          # min-heap of [ clocks, -number, item ]
+        self.count = 0
 
     def addOperation( self, oper ):
         """ Adds a single operation to the list if required """
+        self.addItem( oper.clocks, oper )
+        return
+
+    def addItem( self, value, item ):
+        """ Adds an item consuming the given time to the list if required """
 
-        if oper.clocks == 0.0:
+        if value == 0 or self.limit <= 0:
             return
 
-        if len( self.operations ) == self.limit:
-            if oper.clocks < self.operations[ self.limit - 1 ]:
-                return
+        self.count += 1
+        if len( self.heap ) < self.limit:
+            heapq.heappush( self.heap, ( value, -self.count, item ) )
+            return
 
-        for index in range( 0, len( self.operations ) ):
-            if oper.clocks > self.operations[index].clocks:
-                self.operations.insert( index, oper )
-                if len( self.operations ) > self.limit:
-                    self.operations = self.operations[ :-1 ]
-                return
-        if len( self.operations ) < self.limit:
-            self.operations.append( oper )
+        # The same or less consuming than the least memorised one
+        if value <= self.heap[ 0 ][ 0 ]:
+            return
+
+        heapq.heapreplace( self.heap, ( value, -self.count, item ) )
+        return
+
+    def getOperations( self, limit = None ):
+        """ provides the memorised operations, the most consuming first.
+            Equally consuming operations are in the order of appearance """
+        operations = [ item[ 2 ] for item in sorted( self.heap, reverse = True ) ]
+        if limit is not None:
+            operations = operations[ : max( limit, 0 ) ]
+        return operations
+
+
+class LatencySketch:
+    """ Mergeable streaming quantiles sketch. The values are counted in
+        logarithmic buckets so the relative error of a quantile is bounded
+        by the given accuracy """
+
+    def __init__( self, accuracy = 0.01 ):
+        self.gamma = ( 1.0 + accuracy ) / ( 1.0 - accuracy )
+        self.logGamma = math.log( self.gamma )
+        self.buckets = {}       # bucket index -> number of values
+        self.zeroCount = 0
+        self.count = 0
+        self.maximum = 0
+
+    def add( self, value ):
+        """ Adds a single value """
+        self.count += 1
+        if value > self.maximum:
+            self.maximum = value
+        if value <= 0:
+            self.zeroCount += 1
+            return
+        index = int( math.ceil( math.log( value ) / self.logGamma ) )
+        self.buckets[ index ] = self.buckets.get( index, 0 ) + 1
+        return
+
+    def merge( self, other ):
+        """ Adds all the values of another sketch of the same accuracy """
+        for index, count in other.buckets.iteritems():
+            self.buckets[ index ] = self.buckets.get( index, 0 ) + count
+        self.zeroCount += other.zeroCount
+        self.count += other.count
+        self.maximum = max( self.maximum, other.maximum )
+        return
+
+    def getQuantile( self, quantile ):
+        """ provides the approximate value of the given quantile (0..1) """
+        if self.count == 0:
+            return 0.0
+        rank = quantile * ( self.count - 1 )
+        if rank < self.zeroCount:
+            return 0.0
+        cumulative = self.zeroCount
+        for index in sorted( self.buckets.keys() ):
+            cumulative += self.buckets[ index ]
+            if cumulative > rank:
+                value = 2.0 * self.gamma ** index / ( self.gamma + 1.0 )
+                return min( value, self.maximum )
+        return self.maximum
+
+    def __str__( self ):
+        """ the values are nanoseconds, they are printed in seconds """
+        return "p50: %g p90: %g p99: %g max: %g" % \
+               ( self.getQuantile( 0.5 ) / 1e9, self.getQuantile( 0.9 ) / 1e9,
+                 self.getQuantile( 0.99 ) / 1e9, self.maximum / 1e9 )
+
+
+class LatencyStatistics:
+    """ Operations time distribution per mutex and per thread """
+
+    def __init__( self ):
+        self.mutexes = {}       # mZZZ -> LatencySketch
+        self.threads = {}       # tZZZ -> LatencySketch
+
+    def addOperation( self, oper ):
+        """ Accounts a single operation time """
+        self.addValue( oper.shortObj, oper.shortThread, oper.clocks )
+        return
+
+    def addValue( self, mutex, thread, clocks ):
+        """ Accounts a single operation time of the given mutex and thread """
+        if not self.mutexes.has_key( mutex ):
+            self.mutexes[ mutex ] = LatencySketch()
+        self.mutexes[ mutex ].add( clocks )
+        if not self.threads.has_key( thread ):
+            self.threads[ thread ] = LatencySketch()
+        self.threads[ thread ].add( clocks )
         return
 
+    def merge( self, other, mutexLegend = None, threadLegend = None ):
+        """ Merges the statistics collected for another part of a log.
+            If legends are given then the other statistics names are
+            translated via them """
+        for target, source, legend in \
+                    [ ( self.mutexes, other.mutexes, mutexLegend ),
+                      ( self.threads, other.threads, threadLegend ) ]:
+            for name, sketch in source.iteritems():
+                if legend is not None:
+                    name = legend[ name ]
+                if not target.has_key( name ):
+                    target[ name ] = LatencySketch()
+                target[ name ].merge( sketch )
+        return
+
+    def printStatistics( self ):
+        """ Prints the distributions """
+        print "Operations time percentiles:"
+        for name in sorted( self.mutexes.keys(), compareLegendName ):
+            sketch = self.mutexes[ name ]
+            print "    Mutex " + name + ": " + str( sketch ) + \
+                  " (" + str( sketch.count ) + " operations)"
+        for name in sorted( self.threads.keys(), compareLegendName ):
+            sketch = self.threads[ name ]
+            print "    Thread " + name + ": " + str( sketch ) + \
+                  " (" + str( sketch.count ) + " operations)"
+        return
+
+
+class HeldLocks:
+    """ The currently locked mutexes of all the threads. An unlock is paired
+        with the latest lock of the mutex in the same thread or, if the
+        thread does not hold the mutex, with the latest lock of it in
+        another thread. A holder is [ lock op, value, position in the thread
+        stack ], the value is up to the caller. Both lookups take an
+        amortised constant time """
+
+    def __init__( self ):
+        self.threads = {}       # tZZZ -> [ holder, ... ] in the locking order
+        self.owned = {}         # ( mZZZ, tZZZ ) -> [ holder, ... ]
+        self.mutexes = {}       # mZZZ -> [ holder, ... ] in the locking order,
+                                # the released ones are dropped lazily
+
+    def push( self, op, value = None ):
+        """ Registers a lock operation """
+        stack = self.threads.setdefault( op.shortThread, [] )
+        holder = [ op, value, len( stack ) ]
+        stack.append( holder )
+        self.owned.setdefault( ( op.shortObj, op.shortThread ),
+                               [] ).append( holder )
+        self.mutexes.setdefault( op.shortObj, [] ).append( holder )
+        return
+
+    def pop( self, op ):
+        """ Removes the lock the unlock operation is paired with.
+            Provides ( lock op, value, position in the lock op thread
+            stack ) or None if the mutex is not locked """
+
+        key = ( op.shortObj, op.shortThread )
+        if not self.owned.has_key( key ):
+            # The latest lock of the mutex in another thread
+            holders = self.mutexes.get( op.shortObj )
+            if not holders:
+                return None
+            key = ( op.shortObj, holders[ -1 ][ 0 ].shortThread )
+
+        holders = self.owned[ key ]
+        holder = holders.pop()
+        lockOp, value, position = holder
+        if not holders:
+            del self.owned[ key ]
+
+        # The positions of the later locks of the thread are shifted
+        stack = self.threads[ lockOp.shortThread ]
+        del stack[ position ]
+        for index in range( position, len( stack ) ):
+            stack[ index ][ 2 ] = index
+
+        holder[ 2 ] = -1
+        holders = self.mutexes[ op.shortObj ]
+        while holders and holders[ -1 ][ 2 ] == -1:
+            holders.pop()
+        return lockOp, value, position
+
+
+class CriticalSections:
+    """ Pairs each unlock with the latest lock of the mutex in the same
+        thread (or in any thread if the thread has not locked it) and
+        memorises the longest critical sections. The duration is measured
+        by the operations timestamps, the logs without timestamps have
+        no durations """
+
+    def __init__( self, lim ):
+        self.held = HeldLocks() # lock ops with their op numbers
+        self.longest = MostConsumingOperations( lim )
+        self.count = 0          # number of the operations seen so far
+
+    def addOperation( self, op ):
+        """ provides ( lock op, duration ) if the operation is an unlock
+            paired with a lock or None. The duration is None if there
+            are no timestamps """
+
+        self.count += 1
+        if op.ret != 0:
+            return None
+
+        # The unknown operations (see --ignore-unknown) are not locks
+        if op.operation == "lock" or op.operation == "trylock":
+            self.held.push( op, self.count )
+            return None
+        if op.operation != "unlock":
+            return None
+
+        holder = self.held.pop( op )
+        if holder is None:
+            return None
+        lockOp, start, position = holder
+
+        if lockOp.time is None or op.time is None:
+            return lockOp, None
+        duration = op.time - lockOp.time
+        self.longest.addItem( duration, ( duration, lockOp, op ) )
+        return lockOp, duration
+
+    def printLongest( self, limit ):
+        """ Prints the longest critical sections """
+
+        longest = self.longest.getOperations( limit )
+        if len( longest ) == 0:
+            return
+        print "The longest critical sections:"
+        for duration, lockOp, unlockOp in longest:
+            print "    Held for " + formatSeconds( duration ) + " seconds:"
+            print lockOp.getPrepended( "        " )
+            print unlockOp.getPrepended( "        " )
+        return
+
+
+class MutexProfile:
+    """ Aggregated operations of a mutex or of a mutex call site """
+
+    def __init__( self ):
+        self.acquisitions = 0   # successfull lock and trylock operations
+        self.failures = 0       # failed lock operations
+        self.trylocks = 0
+        self.trylockFailures = 0
+        self.waitTotal = 0      # nanoseconds
+        self.wait = LatencySketch()
+        self.holds = 0
+        self.holdTotal = 0      # nanoseconds or operations
+        self.hold = LatencySketch()
+        self.threads = {}       # tZZZ -> True
+
+    def addAcquisition( self, op ):
+        """ Accounts a lock or a trylock operation """
+        if op.operation == "trylock":
+            self.trylocks += 1
+            if op.ret != 0:
+                self.trylockFailures += 1
+        if op.ret == 0:
+            self.acquisitions += 1
+        elif op.operation == "lock":
+            self.failures += 1
+        self.waitTotal += op.clocks
+        self.wait.add( op.clocks )
+        self.threads[ op.shortThread ] = True
+        return
+
+    def addHold( self, duration ):
+        """ Accounts the time between a lock and the matching unlock """
+        self.holds += 1
+        self.holdTotal += duration
+        self.hold.add( duration )
+        return
+
+    def merge( self, other, threadNames, scale = 1 ):
+        """ Adds another profile, its threads are renamed via the dictionary.
+            The counts and totals of a sampled profile are scaled """
+        self.acquisitions += other.acquisitions * scale
+        self.failures += other.failures * scale
+        self.trylocks += other.trylocks * scale
+        self.trylockFailures += other.trylockFailures * scale
+        self.waitTotal += other.waitTotal * scale
+        self.wait.merge( other.wait )
+        self.holds += other.holds * scale
+        self.holdTotal += other.holdTotal * scale
+        self.hold.merge( other.hold )
+        for name in other.threads.keys():
+            self.threads[ threadNames[ name ] ] = True
+        return
+
+    def getSortKey( self, order ):
+        """ provides the value the profiles are sorted by """
+        if order == "hold":
+            return self.holdTotal
+        if order == "count":
+            return self.acquisitions
+        return self.waitTotal
+
+
+class ContentionProfile:
+    """ Single pass aggregation of the operations per mutex and per
+        mutex call site. The hold durations come from the critical sections
+        pairing """
+
+    def __init__( self ):
+        self.mutexes = {}       # mZZZ -> MutexProfile
+        self.sites = {}         # ( mZZZ, frame ID ) -> MutexProfile
+        self.timed = False      # are there the hold durations?
+        self.untimed = False    # are there sections without timestamps?
+        self.scale = 1          # the sampling rate of the operations
+
+    def getProfile( self, profiles, key ):
+        """ provides an existed or a new profile """
+        try:
+            return profiles[ key ]
+        except KeyError:
+            profile = MutexProfile()
+            profiles[ key ] = profile
+            return profile
+
+    def getSite( self, op ):
+        """ provides the operation call site key or None """
+        if op.backtrace == 0:
+            return None
+        return ( op.shortObj, frameTable.stacks[ op.backtrace ][ 0 ] )
+
+    def addOperation( self, op, hold ):
+        """ Accounts a single operation. hold is ( lock op, duration ) if
+            the operation is an unlock paired with a lock """
+
+        if op.operation == "unlock":
+            self.addHold( hold )
+            return
+        if op.operation != "lock" and op.operation != "trylock":
+            return
+
+        site = self.getSite( op )
+        if site is not None:
+            self.getProfile( self.sites, site ).addAcquisition( op )
+        self.getProfile( self.mutexes, op.shortObj ).addAcquisition( op )
+        return
+
+    def addHold( self, hold ):
+        """ Accounts the ( lock op, duration ) critical section if any.
+            The sections without timestamps are not accounted: the
+            hold durations are never mixed with the operation counts """
+
+        if hold is None:
+            return
+        lockOp, duration = hold
+        if duration is None:
+            self.untimed = True
+            return
+        self.timed = True
+        self.getProfile( self.mutexes, lockOp.shortObj ).addHold( duration )
+        site = self.getSite( lockOp )
+        if site is not None:
+            self.getProfile( self.sites, site ).addHold( duration )
+        return
+
+    def merge( self, other, mutexNames, threadNames, frameMap ):
+        """ Adds the profile of another log. The mutexes and threads are
+            renamed via the dictionaries, the frame IDs via the list """
+        for name, profile in other.mutexes.iteritems():
+            self.getProfile( self.mutexes,
+                             mutexNames[ name ] ).merge( profile, threadNames,
+                                                         other.scale )
+        for key, profile in other.sites.iteritems():
+            self.getProfile( self.sites,
+                             ( mutexNames[ key[ 0 ] ],
+                               frameMap[ key[ 1 ] ] ) ).merge( profile,
+                                                               threadNames,
+                                                               other.scale )
+        if other.timed:
+            self.timed = True
+        if other.untimed:
+            self.untimed = True
+        return
+
+    def printProfile( self, order, limit ):
+        """ Prints the most contended mutexes and call sites """
+
+        if order == "hold" and not self.timed:
+            print >> sys.stderr, "The log has no timestamps, the contention " \
+                                 "profile is sorted by the wait time"
+            order = "wait"
+        title = { "wait" : "total wait time", "hold" : "total hold time",
+                  "count": "acquisitions" }[ order ]
+        hold = ", hold in seconds"
+        if not self.timed:
+            hold = ", no hold times without timestamps"
+        elif self.untimed:
+            hold = ", hold in seconds of the logs with timestamps only"
+        scaled = ""
+        if self.scale > 1:
+            scaled = ", counts and totals scaled by " + str( self.scale )
+        print "Mutexes contention profile (top " + str( limit ) + \
+              " by " + title + hold + scaled + "):"
+        self.printTable( [ ( name, name, profile ) for name, profile
+                           in self.mutexes.iteritems() ], order, limit )
+        if len( self.sites ) == 0:
+            return
+        print "Mutex call sites contention profile (top " + str( limit ) + \
+              " by " + title + "):"
+        self.printTable( [ ( key[ 0 ],
+                             key[ 0 ] + " at " + frameTable.getFrame( key[ 1 ] ),
+                             profile ) for key, profile
+                           in self.sites.iteritems() ], order, limit )
+        return
+
+    def printTable( self, rows, order, limit ):
+        """ Prints the sorted rows of ( mZZZ, name, profile ) """
+
+        # The most contended first, the equal ones in the legend order
+        rows.sort( lambda left, right:
+                        cmp( right[ 2 ].getSortKey( order ),
+                             left[ 2 ].getSortKey( order ) ) or
+                        compareLegendName( left[ 0 ], right[ 0 ] ) or
+                        cmp( left[ 1 ], right[ 1 ] ) )
+        print "    %10s %8s %10s %10s %10s %10s %10s %10s %10s  %s" % \
+              ( "Acquired", "Failed", "Trylock %", "Wait total", "Wait mean",
+                "Wait p99", "Hold total", "Hold mean", "Hold p99", "Mutex" )
+        # The nanoseconds are printed in seconds
+        for mutex, name, profile in rows[ : max( limit, 0 ) ]:
+            tryRate = 0.0
+            if profile.trylocks > 0:
+                tryRate = 100.0 * profile.trylockFailures / profile.trylocks
+            # The merged sampled profiles are scaled but their sketches not
+            waits = profile.acquisitions + profile.failures + \
+                    profile.trylockFailures
+            waitMean = 0.0
+            if waits > 0:
+                waitMean = float( profile.waitTotal ) / waits
+            holds = "%10s %10s %10s" % ( "-", "-", "-" )
+            if self.timed:
+                holdMean = 0.0
+                if profile.holds > 0:
+                    holdMean = float( profile.holdTotal ) / profile.holds
+                holds = "%10.3g %10.3g %10.3g" % \
+                        ( profile.holdTotal * self.scale / 1e9, holdMean / 1e9,
+                          profile.hold.getQuantile( 0.99 ) / 1e9 )
+            print "    %10d %8d %10.1f %10.3g %10.3g %10.3g %s  %s" % \
+                  ( profile.acquisitions * self.scale,
+                    profile.failures * self.scale, tryRate,
+                    profile.waitTotal * self.scale / 1e9, waitMean / 1e9,
+                    profile.wait.getQuantile( 0.99 ) / 1e9, holds, name )
+            print "        threads: " + \
+                  " ".join( sorted( profile.threads.keys(), compareLegendName ) )
+        return
 
 
 def statmiMain():
@@ -129,8 +950,10 @@ def statmiMain():
 
     parser = OptionParser(
     """
-    %prog [options] [fileName]
-    Statistics collection in a log file produced by mi
+    %prog [options] [fileName ...]
+    Statistics collection in a log file produced by mi.
+    Many log files (directories of *.log files, shell patterns) are
+    analysed together
     Return code: 0 - no problems identified
                  1 - there are warnings
                  2 - there are errors
@@ -148,46 +971,328 @@ def statmiMain():
     parser.add_option( "-l", "--tco-limit", dest="tcoLimit", default=10,
                        type="int", help="Number of the most time consuming " \
                                    "operations to be memorised (default: 10)" )
+    parser.add_option( "-p", "--percentiles",
+                       action="store_true", dest="percentiles", default=False,
+                       help="print operations time percentiles per mutex " \
+                            "and per thread (default: False)" )
+
+    parser.add_option( "--cache",
+                       action="store_true", dest="useCache", default=False,
+                       help="use and write the parsed log cache file " \
+                            "<fileName>.statmi-cache (default: False)" )
+    parser.add_option( "--no-cache",
+                       action="store_false", dest="useCache",
+                       help="do not use the parsed log cache file " \
+                            "(default)" )
+
+    parser.add_option( "-c", "--contention",
+                       action="store_true", dest="contention", default=False,
+                       help="print the contention profile per mutex and " \
+                            "per mutex call site (default: False)" )
+    parser.add_option( "--contention-sort", dest="contentionOrder",
+                       default="wait", type="choice",
+                       choices=[ "wait", "hold", "count" ],
+                       help="contention profile order: wait, hold or " \
+                            "count (default: wait)" )
+    parser.add_option( "--contention-limit", dest="contentionLimit",
+                       default=20, type="int",
+                       help="number of the contention profile rows " \
+                            "(default: 20)" )
+
+    parser.add_option( "-s", "--symbolize",
+                       action="store_true", dest="symbolize", default=False,
+                       help="resolve the backtrace frames without function " \
+                            "names with addr2line. The return address " \
+                            "frames are always resolved (default: False)" )
+    parser.add_option( "--symbols-cache", dest="symbolsCache",
+                       default=os.path.join( os.path.expanduser( "~" ),
+                                             ".cache", "statmi" ),
+                       help="directory of the resolved frames cache " \
+                            "(default: ~/.cache/statmi)" )
+    parser.add_option( "--symbols-path", dest="symbolsPath", default="",
+                       help="colon separated directories to look for the " \
+                            "binaries which are not found by the log " \
+                            "file path (default: none)" )
+
+    parser.add_option( "-f", "--follow",
+                       action="store_true", dest="follow", default=False,
+                       help="follow the growing log file and report the " \
+                            "problems as they appear (default: False)" )
+    parser.add_option( "--interval", dest="interval", default=1.0,
+                       type="float", help="Seconds between the log file " \
+                                   "checks in the follow mode (default: 1)" )
+    parser.add_option( "--checkpoint", dest="checkpoint", default=None,
+                       help="file to save the follow mode state to and to " \
+                            "continue from (default: none)" )
+
+    parser.add_option( "-j", "--jobs", dest="jobs", default=1,
+                       type="int", help="Number of processes to parse " \
+                                   "the log file (default: 1)" )
+
+    parser.add_option( "--max-findings", dest="maxFindings", default=1000,
+                       type="int", help="stop the analysis after this " \
+                                        "number of errors or warnings, " \
+                                        "0 - no limit (default: 1000)" )
+
+    parser.add_option( "--stats", dest="statsFile", default=None,
+                       help="file to write the JSON statistics of the " \
+                            "analysis phases to, - for stdout " \
+                            "(default: none)" )
+    parser.add_option( "--profile", dest="profileFile", default=None,
+                       help="file to write the cProfile statistics of the " \
+                            "run to, see the pstats module (default: none)" )
+    parser.add_option( "--json", dest="jsonFile", default=None,
+                       help="file to write the findings and the " \
+                            "statistics to as they appear, one JSON record " \
+                            "per line; - for stdout, the text report goes " \
+                            "to stderr then (default: none)" )
 
     options, args = parser.parse_args()
-    if not len( args ) in [ 0, 1 ]:
-        sys.stdout = sys.stderr
-        parser.print_help()
+
+    logFileNames = [ os.environ.get( 'MI_LOGFILE', 'mi.log' ) ]
+    if len( args ) > 0:
+        logFileNames = getLogFileNames( args )
+
+    if len( logFileNames ) == 0:
+        print >> sys.stderr, "No log files found"
+        return 3
+    for logFileName in logFileNames:
+        if not os.path.exists( logFileName ):
+            print >> sys.stderr, "Cannot find log file '" + logFileName + "'"
+            return 3
+    if options.follow and len( logFileNames ) > 1:
+        print >> sys.stderr, "Only one log file can be followed"
         return 3
 
-    verbose = options.verbose
+    global phaseStatistics
+    global reportWriter
+    global findingsLimit
+    findingsLimit = max( options.maxFindings, 0 )
+    if options.statsFile is not None:
+        phaseStatistics = PhaseStatistics()
+    if options.jsonFile == "-":
+        reportWriter = ReportWriter( sys.stdout )
+        sys.stdout = sys.stderr
+    elif options.jsonFile is not None:
+        reportWriter = ReportWriter( open( options.jsonFile, "w" ) )
+    profiler = None
+    if options.profileFile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if len( logFileNames ) == 1:
+            returnCode = processLogFile( logFileNames[ 0 ], options )
+        else:
+            returnCode = processLogFiles( logFileNames, options )
+        printRepeatedFindings()
+        return returnCode
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats( options.profileFile )
+        if phaseStatistics is not None:
+            setCount( "warnings", warningsCount )
+            setCount( "errors", errorsCount )
+            setCount( "repeated findings",
+                      sum( [ item[ 1 ] - 1 for item in findings.values() ] ) )
+            phaseStatistics.write( options.statsFile,
+                                   " ".join( logFileNames ) )
+        if reportWriter is not None:
+            reportWriter.write( { "type"     : "end",
+                                  "errors"   : errorsCount,
+                                  "warnings" : warningsCount } )
+            reportWriter.close()
+
+
+def processLogFile( logFileName, options ):
+    """ Analyses the log file and prints the report """
+
+    frameTable.symbolizer = Symbolizer( options.symbolsCache,
+                                        [ item for item in
+                                          options.symbolsPath.split( ":" )
+                                          if item ], options.symbolize )
+
+    if options.follow:
+        return followLogFile( logFileName, options )
+
+    # The sidecar cache keeps everything collected in the parsing pass so
+    # the repeated runs with other printing options do not parse the log
+    content = None
+    if options.useCache:
+        startPhase( "cache load" )
+        content = loadParsedLog( logFileName, options )
+        stopPhase( "cache load" )
+
+    if content is not None:
+        frameTable.setState( content[ "frames" ] )
+        setFindingsCount( content[ "warningsCount" ], content[ "errorsCount" ],
+                          content[ "findings" ] )
+        sys.stderr.write( content[ "messages" ] )
+        if reportWriter is not None:
+            reportWriter.setState( content[ "records" ] )
+    else:
+        content = parseLog( logFileName, options )
+
+    return printReport( content, options, logFileName )
 
-    logFileName = os.environ.get( 'MI_LOGFILE', 'mi.log' )
-    if len( args ) == 1:
-        logFileName = args[0]
 
-    if not os.path.exists( logFileName ):
-        print >> sys.stderr, "Cannot find log file '" + logFileName + "'"
-        return 3
+def parseLog( logFileName, options, replayed = False ):
+    """ Parses the log file, collects the chains and the statistics.
+        Provides the parsed log content; it is saved in the cache if
+        the cache is used. The collection messages and report records are
+        kept in the content only if they are replayed later: from the
+        cache or by the many logs analysis """
 
     environment      = []
-    operations       = []
     failedOperations = []
     mutexLegend      = {}   # 0xZZZZZZZZZZZ -> mZZZ
     threadLegend     = {}   # ULZZZZZZZZZZZ -> tZZZ
+    chains           = {}   # tZZZ -> [ [opx, opy, opz], [opx, opz], ... ]
 
+    logFileStat = None
+    logFileHash = None
+    if options.useCache:
+        logFileStat = getLogFileStat( logFileName )
+        logFileHash = getLogFileHash( logFileName )
     mostConsumingOps = MostConsumingOperations( options.tcoLimit )
+    latencies = None
+    if options.percentiles:
+        latencies = LatencyStatistics()
+    sections = CriticalSections( mostConsumingOps.limit )
+    profile = None
+    if options.contention:
+        profile = ContentionProfile()
+    collector = ChainsCollector( chains, options.ignoreUnknown )
+
+    # Single pass: the log records are parsed one by one and fed directly
+    # to the timing, the failed operations and the chains collection, so
+    # the memory does not depend on the log file size.
+    if options.jobs > 1:
+        operations = parseLogFileParallel( logFileName, environment,
+                                           mutexLegend, threadLegend,
+                                           failedOperations,
+                                           mostConsumingOps,
+                                           latencies, options.jobs,
+                                           sections, profile )
+    else:
+        operations = filterOperations( parseLogFile( logFileName,
+                                                     environment,
+                                                     mutexLegend,
+                                                     threadLegend ),
+                                       failedOperations, mostConsumingOps,
+                                       latencies, sections, profile )
+    if phaseStatistics is not None:
+        operations = timeOperations( operations, "parse" )
+
+    # The collection messages are memorised to be repeated from the cache.
+    # Otherwise they are not kept so the memory does not grow with them.
+    recorded = replayed or options.useCache
+    if recorded:
+        recorder = StreamRecorder( sys.stderr )
+        sys.stderr = recorder
+        if reportWriter is not None:
+            reportWriter.stream = StreamRecorder( reportWriter.stream )
+    startPhase( "collect" )
+    try:
+        collectChains( operations, collector )
+    finally:
+        stopPhase( "collect" )
+        if recorded:
+            sys.stderr = recorder.stream
+    messages = None
+    records = None
+    if recorded:
+        messages = recorder.getText()
+        if reportWriter is not None:
+            records = reportWriter.getState()
+            reportWriter.stream = reportWriter.stream.stream
+    rate = getSampling( environment )[ 0 ]
+    if profile is not None:
+        profile.scale = rate
+
+    content = { "version"          : cacheVersion,
+                "stat"             : logFileStat,
+                "hash"             : logFileHash,
+                "ignoreUnknown"    : options.ignoreUnknown,
+                "symbolize"        : options.symbolize,
+                "findingsLimit"    : findingsLimit,
+                "tcoLimit"         : mostConsumingOps.limit,
+                "environment"      : environment,
+                "failedOperations" : failedOperations,
+                "mutexLegend"      : mutexLegend,
+                "threadLegend"     : threadLegend,
+                "chains"           : chains,
+                "mostConsumingOps" : mostConsumingOps,
+                "latencies"        : latencies,
+                "profile"          : profile,
+                "sections"         : sections,
+                "operationsCount"  : collector.operationsCount,
+                "estimatedOps"     : collector.operationsCount * rate,
+                "frames"           : frameTable.getState(),
+                "warningsCount"    : warningsCount,
+                "errorsCount"      : errorsCount,
+                "findings"         : findings,
+                "messages"         : messages,
+                "records"          : records }
+    if options.useCache:
+        startPhase( "cache save" )
+        saveParsedLog( logFileName, content )
+        stopPhase( "cache save" )
+    return content
+
+
+def printReport( content, options, logFileName = None ):
+    """ Prints the statistics of the parsed log content and analyses the
+        chains. The collected operations are printed in the verbose mode
+        if the log file name is given """
+
+    verbose          = options.verbose
+    environment      = content[ "environment" ]
+    failedOperations = content[ "failedOperations" ]
+    mutexLegend      = content[ "mutexLegend" ]
+    threadLegend     = content[ "threadLegend" ]
+    chains           = content[ "chains" ]
+    mostConsumingOps = content[ "mostConsumingOps" ]
+    latencies        = content[ "latencies" ]
+    profile          = content[ "profile" ]
+    sections         = content[ "sections" ]
+    operationsCount  = content[ "operationsCount" ]
+    estimatedOps     = content[ "estimatedOps" ]
+
+    if not options.percentiles:
+        latencies = None
+
+    setCount( "records", operationsCount + len( failedOperations ) )
+    setCount( "failed operations", len( failedOperations ) )
+    setCount( "chains kept", sum( [ len( item ) for item in chains.values() ] ) )
+    setCount( "threads", len( threadLegend ) )
+    setCount( "mutexes", len( mutexLegend ) )
+    startPhase( "report" )
+
+    if reportWriter is not None:
+        reportWriter.writeStatistics( environment, mutexLegend, threadLegend,
+                                      operationsCount, failedOperations,
+                                      mostConsumingOps, sections, latencies,
+                                      profile, chains, options )
 
-    parseLogFile( logFileName,
-                  environment, operations, failedOperations, mostConsumingOps,
-                  mutexLegend, threadLegend )
     if len( environment ) > 0:
         print "Execution environment:"
         for item in environment:
             print "    " + item.string
+    printSamplingNote( environment )
 
-    if len( operations ) == 0:
+    if operationsCount == 0:
         print "No mutex operations detected"
+        stopPhase( "report" )
         return 0
 
     print "Number of threads: " + str( len(threadLegend) )
     print "Number of mutexes: " + str( len(mutexLegend) )
-    print "Successfull operations: " + str( len(operations) )
+    if estimatedOps != operationsCount:
+        print "Successfull operations: " + str( operationsCount ) + \
+              " (sampled, about " + str( estimatedOps ) + ")"
+    else:
+        print "Successfull operations: " + str( operationsCount )
     print "Failed operations: " + str( len(failedOperations) )
 
     if len(failedOperations) > 0:
@@ -195,32 +1300,37 @@ def statmiMain():
         for item in failedOperations:
             print item.getPrepended( "    " )
 
-    if len( mostConsumingOps.operations ) > 0:
+    mostConsuming = mostConsumingOps.getOperations( options.tcoLimit )
+    if len( mostConsuming ) > 0:
         print "The most time consuming operations:"
-        for item in mostConsumingOps.operations:
+        for item in mostConsuming:
             print item.getPrepended( "    " )
 
+    sections.printLongest( options.tcoLimit )
 
-    if verbose:
-        print "Collected operations:"
-        for item in operations:
-            print item.getPrepended( "    " )
+    if latencies is not None:
+        latencies.printStatistics()
+
+    if options.contention:
+        profile.printProfile( options.contentionOrder,
+                              options.contentionLimit )
 
-    chains = {}                 # tZZZ -> [ [opx, opy, opz], [opx, opz], ... ]
+
+    if verbose and logFileName is not None:
+        # The operations are not kept in memory so the log is read again
+        print "Collected operations:"
+        for item in parseLogFile( logFileName, [], mutexLegend, threadLegend ):
+            if item.ret == 0:
+                print item.getPrepended( "    " )
 
     print "Collecting chains and statistics..."
-    collectChains( operations, chains, threadLegend,
-                   options.ignoreUnknown )
 
     printCollectedChains( chains, verbose )
 
-    if len( operations ) == 0:
-        print "The program has not locked any mutexes. No analysis required."
-        return 0
-
     if len( threadLegend ) == 1:
         print "The program has exactly one thread. " \
               "No further analysis required."
+        stopPhase( "report" )
         return 0
 
     print "Threads legend:"
@@ -238,8 +1348,11 @@ def statmiMain():
     legend = sorted( legend, compareLegendName )
     for item in legend:
         print "    " + item
+    stopPhase( "report" )
 
+    startPhase( "analyse" )
     analyse( chains, verbose )
+    stopPhase( "analyse" )
     return 0
 
 
@@ -273,80 +1386,148 @@ def compareLegendName( left, right ):
     return cmp( int( left[ 1: ].split()[0] ), int( right[ 1: ].split()[0] ) )
 
 
-def collectChains( operations, chains, threadLegend, ignoreUnknown ):
-    """ Collects statistics and operations chains """
+class ChainsCollector:
+    """ Collects the operations chains from a stream of operations.
+        Only the currently locked mutexes of each thread and the collected
+        chains are kept in memory """
+
+    def __init__( self, chains, ignoreUnknown, graph = None ):
+        self.chains = chains
+        self.chainsIndex = {}       # tZZZ -> prefix tree of the chains
+        self.ignoreUnknown = ignoreUnknown
+        self.graph = graph          # lock order graph to be kept up to date
+        self.newEdges = []          # the graph edges added since the caller
+                                    # checked them last time
+        self.operationsCount = 0
+        self.currentChains = {}     # tZZZ -> [ shouldBeAdded, [ op, ... ] ]
+        self.held = HeldLocks()     # the locks of the current chains, the
+                                    # positions are the chains indexes
+
+    def registerChain( self, chain ):
+        """ Adds a chain to the collected ones and to the graph if given """
+        startPhase( "addChain" )
+        added = addChain( self.chains, self.chainsIndex, chain )
+        stopPhase( "addChain" )
+        if added is None:
+            addCount( "chains dropped", 1 )
+        else:
+            addCount( "chains added", 1 )
+        if added is not None and self.graph is not None:
+            self.newEdges.extend( self.graph.addChain( added ) )
+        return
 
-    # Initialise the initial chains
-    currentChains = {}
-    for key, value in threadLegend.iteritems():
-        currentChains[ value ] = [ False, [] ]      # False - should not be
-                                                    # added to the chains list
+    def getCurrentChain( self, shortThread ):
+        """ provides the thread current chain, creates it if required """
+        if not self.currentChains.has_key( shortThread ):
+            self.currentChains[ shortThread ] = [ False, [] ]   # False -
+                                                # should not be added to
+                                                # the chains list
+        return self.currentChains[ shortThread ]
 
-    # process all the operation. The failed operations were excluded
-    # at the stage of the reading log file
-    for op in operations:
+    def addOperation( self, op ):
+        """ Processes a single successful operation """
+
+        self.operationsCount += 1
+        currentChain = self.getCurrentChain( op.shortThread )
 
         if op.operation == "lock" or op.operation == "trylock":
             # add the operation and mark as should be added to the chains list
-            currentChains[ op.shortThread ][ 0 ] = True
-            currentChains[ op.shortThread ][ 1 ].append( op )
-            continue
+            currentChain[ 0 ] = True
+            currentChain[ 1 ].append( op )
+            self.held.push( op )
+            return
 
         if op.operation == "unlock":
-            lockedMutexIndex = getMutexIndexInChain( op,
-                                   currentChains[ op.shortThread ][ 1 ] )
-            if lockedMutexIndex == -1:
-                # Need to check if it was locked in another thread
-                ch, index = getMutexIndexInAnyChain( op, currentChains )
-                if index == -1:
-                    printUnlockingNonLockedError( op,
-                                                  currentChains[op.shortThread][1] )
-                else:
-                    # Sick! They lock mutex in one thread and unlock it in
-                    # another!
-                    otherThread = ch[0].shortThread
+            holder = self.held.pop( op )
+            if holder is None:
+                printUnlockingNonLockedError( op, currentChain[ 1 ] )
+                return
+            lockOp, value, lockedMutexIndex = holder
 
-                    printLockInOneUnlockInOtherWarning( ch, op )
+            if lockOp.shortThread != op.shortThread:
+                # Sick! They lock mutex in one thread and unlock it in
+                # another!
+                otherChain = self.currentChains[ lockOp.shortThread ]
 
-                    # Register the other thread chain if required
-                    if currentChains[ otherThread ][ 0 ] == True and \
-                       len( currentChains[ otherThread ][ 1 ] ) > 1:
-                        addChain( chains, currentChains[ otherThread ][ 1 ] )
-                    # Delete the operation from the other thread chain
-                    del( currentChains[ otherThread ][ 1 ][ index ] )
+                printLockInOneUnlockInOtherWarning( otherChain[ 1 ], op )
 
-                    # reset the other thread chain flag
-                    currentChains[ otherThread ][ 0 ] = False
-                continue
+                # Register the other thread chain if required
+                if otherChain[ 0 ] == True and len( otherChain[ 1 ] ) > 1:
+                    self.registerChain( otherChain[ 1 ] )
+                # Delete the operation from the other thread chain
+                del( otherChain[ 1 ][ lockedMutexIndex ] )
 
-            if lockedMutexIndex != len(currentChains[op.shortThread][1]) - 1:
-                printUnlockingOrderWarning( op,
-                                            currentChains[op.shortThread][1] )
+                # reset the other thread chain flag
+                otherChain[ 0 ] = False
+                return
+
+            if lockedMutexIndex != len( currentChain[ 1 ] ) - 1:
+                printUnlockingOrderWarning( op, currentChain[ 1 ] )
 
             # Register the chain if required
-            if currentChains[ op.shortThread ][ 0 ] == True and \
-               len(currentChains[op.shortThread][1]) > 1:
+            if currentChain[ 0 ] == True and len( currentChain[ 1 ] ) > 1:
                 # Chains of length == 1 are not interesting
-                addChain( chains, currentChains[op.shortThread][1] )
+                self.registerChain( currentChain[ 1 ] )
 
             # Delete the operation from the current chain
-            del( currentChains[ op.shortThread ][ 1 ][ lockedMutexIndex ] )
+            del( currentChain[ 1 ][ lockedMutexIndex ] )
 
             # Reset the chain flag
-            currentChains[ op.shortThread ][ 0 ] = False
-            continue
+            currentChain[ 0 ] = False
+            return
 
-        if ignoreUnknown:
+        if self.ignoreUnknown:
             print >> sys.stderr, "WARNING: Unknown operation:\n " + \
                                  str(op) + "\nSkipping."
+            if reportWriter is not None:
+                reportWriter.writeFinding( "warning", "unknownOperation",
+                                           None, { "operation" :
+                                               reportWriter.getOperation( op ) } )
         else:
             raise Exception( "Unknown operation " + str(op) )
+        return
+
+    def finish( self ):
+        """ Post analysis: there should not be still locked mutexes """
+        threads = sorted( self.currentChains.keys(), compareLegendName )
+        for shortThread in threads:
+            if len( self.currentChains[ shortThread ][ 1 ] ) > 0:
+                printLeftUnlockedError( self.currentChains[ shortThread ][ 1 ] )
+        return
 
 
-    # Post analysis: there should not be still locked mutexes
-    for key, value in currentChains.iteritems():
-        if len( value[ 1 ] ) > 0:
-            printLeftUnlockedError( value[ 1 ] )
+def collectChains( operations, collector ):
+    """ Collects statistics and operations chains """
+
+    # process all the operation. The failed operations are excluded
+    # at the stage of the reading log file
+    for op in operations:
+        collector.addOperation( op )
+    collector.finish()
+    return
+
+
+def filterOperations( operations, failedOperations, mostConsumingOps,
+                      latencies, sections, profile = None ):
+    """ Memorises the time consuming and the failed operations and passes
+        the successfull ones further """
+
+    for op in operations:
+        if latencies is not None:
+            latencies.addOperation( op )
+        hold = sections.addOperation( op )
+        if profile is not None:
+            profile.addOperation( op, hold )
+
+        # Memorise the operation time if needed
+        if mostConsumingOps is not None and op.clocks > 0.0:
+            mostConsumingOps.addOperation( op )
+
+        # Check the operation return code
+        if op.ret == 0:
+            yield op
+        else:
+            failedOperations.append( op )
     return
 
 
@@ -356,6 +1537,11 @@ def printLockInOneUnlockInOtherWarning( lockChain, unlockOp ):
 
     global warningsCount
 
+    if isRepeatedFinding( ( "unlockInOtherThread", getSites( [ unlockOp ] ),
+                            getSites( lockChain ) ),
+                          "W" + errorNumber( warningsCount ) ):
+        return
+
     mutex = unlockOp.shortObj
     unlockThread = unlockOp.shortThread
     lockThread = lockChain[0].shortThread
@@ -368,8 +1554,15 @@ def printLockInOneUnlockInOtherWarning( lockChain, unlockOp ):
     for index in range( len(lockChain) - 1, -1, -1 ):
         print >> sys.stderr, lockChain[index].getPrepended( "    " )
     print >> sys.stderr, "--- W" + errorNumber( warningsCount )
+    if reportWriter is not None:
+        reportWriter.writeFinding( "warning", "unlockInOtherThread",
+                                   warningsCount,
+                    { "mutex"     : mutex,
+                      "threads"   : [ lockThread, unlockThread ],
+                      "operation" : reportWriter.getOperation( unlockOp ),
+                      "locked"    : reportWriter.getChain( lockChain ) } )
     warningsCount += 1
-    if warningsCount >= 1000:
+    if findingsLimit > 0 and warningsCount >= findingsLimit:
         raise Exception( "Too many warnings" )
     return
 
@@ -379,6 +1572,12 @@ def printUnlockingNonLockedError( unlockOperation, lockChain ):
 
     global  errorsCount
 
+    if isRepeatedFinding( ( "unlockNotLocked",
+                            getSites( [ unlockOperation ] ),
+                            getSites( lockChain ) ),
+                          "E" + errorNumber( errorsCount ) ):
+        return
+
     print >> sys.stderr, "--- E" + errorNumber( errorsCount ) + "\n" \
              "ERROR: Unlocking mutex which is not previously locked.\n" + \
              str(unlockOperation) + "\nCurrently locked mutexes in the thread:"
@@ -389,8 +1588,14 @@ def printUnlockingNonLockedError( unlockOperation, lockChain ):
         for index in range( len(lockChain) - 1, -1, -1 ):
             print >> sys.stderr, lockChain[index].getPrepended( "    " )
     print >> sys.stderr, "--- E" + errorNumber( errorsCount )
+    if reportWriter is not None:
+        reportWriter.writeFinding( "error", "unlockNotLocked", errorsCount,
+                    { "mutex"     : unlockOperation.shortObj,
+                      "threads"   : [ unlockOperation.shortThread ],
+                      "operation" : reportWriter.getOperation( unlockOperation ),
+                      "locked"    : reportWriter.getChain( lockChain ) } )
     errorsCount += 1
-    if errorsCount >= 1000:
+    if findingsLimit > 0 and errorsCount >= findingsLimit:
         raise Exception( "Too many errors" )
     return
 
@@ -400,6 +1605,11 @@ def printUnlockingOrderWarning( unlockOperation, lockChain ):
 
     global warningsCount
 
+    if isRepeatedFinding( ( "unlockOrder", getSites( [ unlockOperation ] ),
+                            getSites( lockChain ) ),
+                          "W" + errorNumber( warningsCount ) ):
+        return
+
     print >> sys.stderr, "--- W" + errorNumber( warningsCount ) + "\n" \
              "WARNING: Unlocking not the last locked mutex in the thread\n" + \
              str(unlockOperation) + "\nCurrently locked mutexes in the thread:"
@@ -407,8 +1617,14 @@ def printUnlockingOrderWarning( unlockOperation, lockChain ):
     for index in range( len(lockChain) - 1, -1, -1 ):
         print >> sys.stderr, lockChain[index].getPrepended( "    " )
     print >> sys.stderr, "--- W" + errorNumber( warningsCount )
+    if reportWriter is not None:
+        reportWriter.writeFinding( "warning", "unlockOrder", warningsCount,
+                    { "mutex"     : unlockOperation.shortObj,
+                      "threads"   : [ unlockOperation.shortThread ],
+                      "operation" : reportWriter.getOperation( unlockOperation ),
+                      "locked"    : reportWriter.getChain( lockChain ) } )
     warningsCount += 1
-    if warningsCount >= 1000:
+    if findingsLimit > 0 and warningsCount >= findingsLimit:
         raise Exception( "Too many warnings" )
     return
 
@@ -418,14 +1634,23 @@ def printLeftUnlockedError( chain ):
 
     global errorsCount
 
+    if isRepeatedFinding( ( "leftLocked", getSites( chain ) ),
+                          "E" + errorNumber( errorsCount ) ):
+        return
+
     print >> sys.stderr, "--- E" + errorNumber( errorsCount ) + "\n" \
              "ERROR: Some mutex[es] left locked in the thread:"
     # Print in reverse order
     for index in range( len(chain) - 1, -1, -1 ):
         print >> sys.stderr, chain[index].getPrepended( "    " )
     print >> sys.stderr, "--- E" + errorNumber( errorsCount )
+    if reportWriter is not None:
+        reportWriter.writeFinding( "error", "leftLocked", errorsCount,
+                    { "mutexes" : [ op.shortObj for op in chain ],
+                      "threads" : [ chain[0].shortThread ],
+                      "locked"  : reportWriter.getChain( chain ) } )
     errorsCount += 1
-    if errorsCount >= 1000:
+    if findingsLimit > 0 and errorsCount >= findingsLimit:
         raise Exception( "Too many errors" )
     return
 
@@ -438,6 +1663,13 @@ def printWrongLockOrderError( firstChain, secondChain,
 
     global errorsCount
 
+    # The same pair of call sites in other threads is the same problem
+    if isRepeatedFinding( ( "lockOrder", ) +
+                          tuple( sorted( [ getSites( firstPair ),
+                                           getSites( secondPair ) ] ) ),
+                          "E" + errorNumber( errorsCount ) ):
+        return
+
     firstThread = firstChain[0].shortThread
     secondThread = secondChain[0].shortThread
 
@@ -469,83 +1701,108 @@ def printWrongLockOrderError( firstChain, secondChain,
     #         secondPair[1].getPrepended( "    " ) + "\n"
 
     print >> sys.stderr, "--- E" + errorNumber( errorsCount )
+    if reportWriter is not None:
+        reportWriter.writeFinding( "error", "lockOrder", errorsCount,
+                    { "mutexes" : [ firstPair[0].shortObj,
+                                    firstPair[1].shortObj ],
+                      "threads" : [ firstThread, secondThread ],
+                      "pairs"   : [ reportWriter.getChain( firstPair ),
+                                    reportWriter.getChain( secondPair ) ],
+                      "chains"  : [ reportWriter.getChain( firstChain ),
+                                    reportWriter.getChain( secondChain ) ] } )
     errorsCount += 1
-    if errorsCount >= 1000:
+    if findingsLimit > 0 and errorsCount >= findingsLimit:
         raise Exception( "Too many errors" )
     return
 
 
 
-def addChain( chains, chain ):
-    """ Adds a chain to the collected chains if required """
-
-    shortThread = chain[0].shortThread
-    if not chains.has_key( shortThread ):
-        chains[ shortThread ] = []
-
-    # check if there is the same or longer chain
-    for index in range( 0, len( chains[ shortThread ] ) ):
-        compareResult = compareChains( chain, chains[ shortThread ][ index ] )
-        if compareResult == 0:
-            # Matched or shorter
-            return
-        if compareResult == 1:
-            # Should replace the existed
-            chains[ shortThread ][ index ] = chain
-            return
-
-    # No such a chain - add it
-    chains[ shortThread ].append( list(chain) )
-    return
-
-
-def compareChains( inputChain, existedChain ):
-    """ Return value: -1 inputChain differs to the existedChain
-                       0 inputChain is the same or shorter than existedChain
-                      +1 inputChain covers existed and is longer """
-
-    minLength = min( len(inputChain), len(existedChain) )
-    for index in range( 0, minLength ):
-        if inputChain[index] != existedChain[index]:
-            return -1
+def printLockOrderCycleError( cycle ):
+    """ Prints error message that three or more mutexes are locked
+        in a cycle by different threads """
 
-    # Here: the common length part of the chains matches
+    global errorsCount
 
-    if len(inputChain) <= len(existedChain):
-        return 0
+    if isRepeatedFinding( ( "lockOrderCycle", ) +
+                          tuple( sorted( [ getSites( [ first, second ] )
+                                           for chain, first, second
+                                           in cycle ] ) ),
+                          "E" + errorNumber( errorsCount ) ):
+        return
 
-    # Here: input chain is longer and the common part matches
+    summary = ""
+    for chain, first, second in cycle:
+        summary += " -- " + chain[0].shortThread + ": " + \
+                   first.shortObj + " -> " + second.shortObj
 
-    return 1
+    print >> sys.stderr, "--- E" + errorNumber( errorsCount ) + summary + \
+             "\nERROR: potential dead lock detected (lock order cycle of " + \
+             str( len(cycle) ) + " mutexes)"
 
+    for chain, first, second in cycle:
+        print >> sys.stderr, "Thread " + chain[0].shortThread + " lock stack:"
+        # Print it in a reverse order
+        for index in range( len(chain) - 1, -1, -1 ):
+            print >> sys.stderr, chain[index].getPrepended( "    " )
 
-def getMutexIndexInChain( operation, chain ):
-    """ Searches for the locked mutex in the given chain.
-        Returns: -1 if not found """
+    print >> sys.stderr, "--- E" + errorNumber( errorsCount )
+    if reportWriter is not None:
+        reportWriter.writeFinding( "error", "lockOrderCycle", errorsCount,
+                    { "mutexes" : [ first.shortObj for chain, first, second
+                                    in cycle ],
+                      "threads" : [ chain[0].shortThread for chain, first,
+                                    second in cycle ],
+                      "pairs"   : [ reportWriter.getChain( [ first, second ] )
+                                    for chain, first, second in cycle ],
+                      "chains"  : [ reportWriter.getChain( chain )
+                                    for chain, first, second in cycle ] } )
+    errorsCount += 1
+    if findingsLimit > 0 and errorsCount >= findingsLimit:
+        raise Exception( "Too many errors" )
+    return
 
-    # search in the reverse order
-    for index in range( len( chain ) - 1, -1, -1 ):
-        if operation.shortObj == chain[ index ].shortObj:
-            return index
-    return -1
 
 
-def getMutexIndexInAnyChain( op, chains ):
-    """ It is specifically for the case if a mutex was locked in one thread and
-        is unlocked in another. I should check all other mutex chains.
-        The mutex own chain has already be checked so no need to check it. """
+def addChain( chains, chainsIndex, chain ):
+    """ Adds a chain to the collected chains if required.
+        The same or shorter chains are dropped, a longer chain replaces the
+        existed one it covers. The thread chains are indexed by a prefix
+        tree of the operation keys so the insertion takes O(chain length).
+        Returns the added copy of the chain or None """
 
-    for key, value in chains.iteritems():
-        if key == op.shortThread:
-            continue
-        # Search for the mutex in reverse order
-        chain = chains[ key ][ 1 ]
-        for index in range( len( chain ) - 1, -1, -1 ):
-            if op.shortObj == chain[ index ].shortObj:
-                # Found a mutex locked in another thread
-                return chain, index
+    shortThread = chain[0].shortThread
+    if not chains.has_key( shortThread ):
+        chains[ shortThread ] = []
+        chainsIndex[ shortThread ] = [ {}, -1 ]   # [ children, chain index ]
+
+    # Walk the tree to the first operation which is not there
+    node = chainsIndex[ shortThread ]
+    for position in range( 0, len( chain ) ):
+        key = chain[ position ].getKey()
+        if not node[ 0 ].has_key( key ):
+            break
+        node = node[ 0 ][ key ]
+    else:
+        # Matched or shorter
+        return None
+
+    added = list( chain )
+    if node[ 1 ] != -1:
+        # The existed chain is covered by the longer one - replace it
+        index = node[ 1 ]
+        node[ 1 ] = -1
+        chains[ shortThread ][ index ] = added
+    else:
+        # No such a chain - add it
+        index = len( chains[ shortThread ] )
+        chains[ shortThread ].append( added )
 
-    return None, -1
+    for op in chain[ position: ]:
+        child = [ {}, -1 ]
+        node[ 0 ][ op.getKey() ] = child
+        node = child
+    node[ 1 ] = index
+    return added
 
 
 def getMutexName( legend, mutexID ):
@@ -566,108 +1823,2239 @@ def getThreadName( legend, threadID ):
     return name
 
 
-def analyse( operations, verbose ):
-    """ analyses the collected operations """
-
-    threads = operations.keys()
-    for firstThreadIndex in range( 0, len( threads ) - 1 ):
-        for secondThreadIndex in range( firstThreadIndex + 1, len( threads ) ):
-            if verbose:
-                print "Checking threads " + threads[firstThreadIndex] + \
-                      " and " + threads[secondThreadIndex] + "..."
-            checkLockChains( operations[ threads[firstThreadIndex] ],
-                             operations[ threads[secondThreadIndex] ] )
-    return
+class LockOrderGraph:
+    """ Mutexes lock order graph. Each mutex is a node and each 'mutex A is
+        held while mutex B is locked' is an edge annotated with the threads
+        and the sample chains which produced it """
+
+    def __init__( self ):
+        self.edges = {}     # mA -> { mB -> { tZZZ -> [ chain, opA, opB ] } }
+        self.edgesCount = 0
+
+    def addChain( self, chain ):
+        """ Adds all the lock order edges of the given chain.
+            Returns the list of the new ( mA, mB, tZZZ ) edges """
+
+        added = []
+        shortThread = chain[0].shortThread
+        for firstIndex in range( 0, len(chain) - 1 ):
+            first = chain[ firstIndex ]
+            for secondIndex in range( firstIndex + 1, len(chain) ):
+                second = chain[ secondIndex ]
+                # It considers the case when a chain is a recursive mutex lock
+                if first.shortObj == second.shortObj:
+                    continue
+                if not self.edges.has_key( first.shortObj ):
+                    self.edges[ first.shortObj ] = {}
+                targets = self.edges[ first.shortObj ]
+                if not targets.has_key( second.shortObj ):
+                    targets[ second.shortObj ] = {}
+                    self.edgesCount += 1
+                if not targets[ second.shortObj ].has_key( shortThread ):
+                    targets[ second.shortObj ][ shortThread ] = \
+                                                    [ chain, first, second ]
+                    added.append( ( first.shortObj, second.shortObj,
+                                    shortThread ) )
+        return added
+
+    def getNodes( self ):
+        """ provides sorted mutexes which have outgoing or incoming edges """
+        nodes = {}
+        for first, targets in self.edges.iteritems():
+            nodes[ first ] = True
+            for second in targets.keys():
+                nodes[ second ] = True
+        return sorted( nodes.keys(), compareLegendName )
+
+    def hasEdge( self, first, second ):
+        """ True if the second mutex is locked while the first is held """
+        return self.edges.has_key( first ) and \
+               self.edges[ first ].has_key( second )
+
+    def getTargets( self, node ):
+        """ provides sorted mutexes locked while the given one is held """
+        if not self.edges.has_key( node ):
+            return []
+        return sorted( self.edges[ node ].keys(), compareLegendName )
+
+    def getStronglyConnectedComponents( self ):
+        """ Tarjan algorithm (iterative). Provides the list of the
+            components which have more than one mutex """
+
+        index = {}
+        lowLink = {}
+        onStack = {}
+        stack = []
+        components = []
+        counter = 0
+
+        for root in self.getNodes():
+            if index.has_key( root ):
+                continue
+            work = [ [ root, self.getTargets( root ), 0 ] ]
+            index[ root ] = lowLink[ root ] = counter
+            counter += 1
+            stack.append( root )
+            onStack[ root ] = True
+
+            while work:
+                node, targets, position = work[ -1 ]
+                if position < len( targets ):
+                    work[ -1 ][ 2 ] += 1
+                    target = targets[ position ]
+                    if not index.has_key( target ):
+                        index[ target ] = lowLink[ target ] = counter
+                        counter += 1
+                        stack.append( target )
+                        onStack[ target ] = True
+                        work.append( [ target, self.getTargets( target ), 0 ] )
+                    elif onStack.get( target, False ):
+                        lowLink[ node ] = min( lowLink[ node ], index[ target ] )
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[ -1 ][ 0 ]
+                    lowLink[ parent ] = min( lowLink[ parent ], lowLink[ node ] )
+                if lowLink[ node ] == index[ node ]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack[ member ] = False
+                        component.append( member )
+                        if member == node:
+                            break
+                    if len( component ) > 1:
+                        components.append( sorted( component,
+                                                   compareLegendName ) )
+        return components
+
+    def findCycle( self, component ):
+        """ Searches for a cycle of three or more mutexes within the
+            component which involves at least two threads. The shorter
+            cycles are tried first; every path is tried before giving up
+            unless the search exceeds cycleSearchLimit steps.
+            Returns a list of [ chain, opA, opB ] or None """
+
+        order = {}
+        for position in range( 0, len( component ) ):
+            order[ component[ position ] ] = position
+
+        budget = cycleSearchLimit
+        for length in range( 3, len( component ) + 1 ):
+            # Each cycle is searched from its first mutex in the component
+            # by a depth first search limited by the cycle length
+            for start in component:
+                path = [ start ]
+                work = [ [ self.getTargets( start ), 0 ] ]
+                onPath = { start: True }
+                while work:
+                    targets, position = work[ -1 ]
+                    if position == len( targets ):
+                        work.pop()
+                        del onPath[ path.pop() ]
+                        continue
+                    work[ -1 ][ 1 ] += 1
+                    budget -= 1
+                    if budget <= 0:
+                        return None
+                    target = targets[ position ]
+                    if target == start:
+                        if len( path ) == length:
+                            cycle = self.__selectThreads( path + [ start ] )
+                            if cycle is not None:
+                                return cycle
+                        continue
+                    if len( path ) == length or onPath.has_key( target ) or \
+                       not order.has_key( target ) or \
+                       order[ target ] < order[ start ]:
+                        continue
+                    path.append( target )
+                    onPath[ target ] = True
+                    work.append( [ self.getTargets( target ), 0 ] )
+        return None
+
+    def __selectThreads( self, path ):
+        """ Selects the cycle edges samples so that at least two
+            different threads are involved """
+
+        edges = []
+        for index in range( 0, len(path) - 1 ):
+            edges.append( self.edges[ path[index] ][ path[index + 1] ] )
+
+        cycle = []
+        usedThreads = {}
+        for threads in edges:
+            names = sorted( threads.keys(), compareLegendName )
+            selected = names[ 0 ]
+            for name in names:
+                if not usedThreads.has_key( name ):
+                    selected = name
+                    break
+            usedThreads[ selected ] = True
+            cycle.append( threads[ selected ] )
+
+        # A single thread is selected if only the first edge has another one
+        if len( usedThreads ) < 2:
+            for index in range( 0, len( edges ) ):
+                for name in sorted( edges[ index ].keys(), compareLegendName ):
+                    if not usedThreads.has_key( name ):
+                        usedThreads[ name ] = True
+                        cycle[ index ] = edges[ index ][ name ]
+                        break
+                if len( usedThreads ) > 1:
+                    break
 
-def checkLockChains( firstThreadChains, secondThreadChains ):
-    """ check two threads chains"""
+        if len( usedThreads ) < 2:
+            return None
+        return cycle
 
-    for firstThreadChain in firstThreadChains:
-        for secondThreadChain in secondThreadChains:
-            checkLockOrder( firstThreadChain, secondThreadChain )
-    return
 
+def analyse( chains, verbose ):
+    """ analyses the collected chains """
 
-def buildLockPairs( chain ):
-    """ builds a list of mutex lock pairs """
+    graph = LockOrderGraph()
+    for shortThread in sorted( chains.keys(), compareLegendName ):
+        for chain in chains[ shortThread ]:
+            graph.addChain( chain )
 
-    lockPairs = []
-    for firstIndex in range( 0, len(chain) - 1 ):
-        for secondIndex in range( firstIndex + 1, len(chain) ):
-            lockPairs.append( [ chain[firstIndex], chain[secondIndex] ] )
-    return lockPairs
+    setCount( "lock order edges", graph.edgesCount )
+    if verbose:
+        print "Checking lock order graph: " + \
+              str( len( graph.getNodes() ) ) + " mutexes, " + \
+              str( graph.edgesCount ) + " lock order edges..."
+
+    # The longer cycles are searched for even if some pairs of the
+    # component mutexes are locked in opposite order
+    for component in graph.getStronglyConnectedComponents():
+        checkOppositeLockOrder( graph, component )
+        cycle = graph.findCycle( component )
+        if cycle is not None:
+            printLockOrderCycleError( cycle )
+    return
 
 
-def checkLockOrder( firstChain, secondChain ):
-    """ Checks of there are any conflicts in mutex locking order """
-    firstLockPairs = buildLockPairs( firstChain )
-    secondLockPairs = buildLockPairs( secondChain )
+def checkOppositeLockOrder( graph, component ):
+    """ Reports the pairs of mutexes of a strongly connected component
+        which are locked in opposite order in different threads.
+        Returns the number of the reported errors """
+
+    count = 0
+    addCount( "pairs compared", len( component ) *
+                                ( len( component ) - 1 ) / 2 )
+    for firstIndex in range( 0, len(component) - 1 ):
+        first = component[ firstIndex ]
+        for secondIndex in range( firstIndex + 1, len(component) ):
+            second = component[ secondIndex ]
+            if not graph.hasEdge( first, second ) or \
+               not graph.hasEdge( second, first ):
+                continue
 
-    for firstPair in firstLockPairs:
-        for secondPair in secondLockPairs:
-            if isLockPairOpposite( firstPair, secondPair ):
-                printWrongLockOrderError( firstChain, secondChain,
-                                          firstPair, secondPair )
+            forward = graph.edges[ first ][ second ]
+            backward = graph.edges[ second ][ first ]
+            for firstThread in sorted( forward.keys(), compareLegendName ):
+                for secondThread in sorted( backward.keys(),
+                                            compareLegendName ):
+                    if firstThread == secondThread:
+                        continue
+                    firstSample = forward[ firstThread ]
+                    secondSample = backward[ secondThread ]
+                    if compareLegendName( firstThread, secondThread ) > 0:
+                        firstSample, secondSample = secondSample, firstSample
+                    printWrongLockOrderError( firstSample[0], secondSample[0],
+                                              firstSample[1:], secondSample[1:] )
+                    count += 1
+    return count
+
+
+# Op: statement with the optional timestamp and sequence number and the
+# optional Bt: lines which follow it
+opRecordRegexp = re.compile( r"Op: (\S+) \S+ (\S+) \S+ (\S+) \S+ (\S+) \S+ (\S+)"
+                             r"(?: Time: (\S+))?(?: Seq: (\d+))?"
+                             r"[ \t\r]*(?:\n|\Z)" )
+backtraceRegexp = re.compile( r"(?:Bt: [^\n]*(?:\n|\Z))*" )
+
+
+def addEnvironment( environment, statement ):
+    """ appends the Env: statement to the environment. The loaded modules
+        are registered to resolve the return address frames """
+    environment.append( Env( statement ) )
+    if statement.startswith( "module: " ):
+        frameTable.addModule( statement )
     return
 
 
-def isLockPairOpposite( first, second ):
-    """ Checks if the pairs lock mutexes in opposite order """
+# The libmi.so sampling and threshold Env: statements
+samplingRegexp = re.compile( r"^sampling: 1/(\d+) operations per mutex$" )
+thresholdRegexp = re.compile( r"^(stack )?threshold: (\d+) ns$" )
 
-    # It considers the case when a chain is a recursive mutex lock
-    return first[0].shortObj == second[1].shortObj and \
-           first[1].shortObj == second[0].shortObj and \
-           first[0].shortObj != first[1].shortObj and \
-           second[0].shortObj != second[1].shortObj
+
+def getSampling( environment ):
+    """ provides ( rate, threshold, stack threshold ) of the operations
+        recording: 1 of rate locks per mutex is recorded if it took at least
+        threshold nanoseconds; the stacks are recorded for the operations
+        of at least stack threshold nanoseconds """
+    rate, threshold, stackThreshold = 1, 0, 0
+    for item in environment:
+        match = samplingRegexp.match( item.string )
+        if match:
+            rate = int( match.group( 1 ) )
+            continue
+        match = thresholdRegexp.match( item.string )
+        if match and match.group( 1 ):
+            stackThreshold = int( match.group( 2 ) )
+        elif match:
+            threshold = int( match.group( 2 ) )
+    return rate, threshold, stackThreshold
+
+
+def printSamplingNote( environment, prefix = "" ):
+    """ Prints how the operations are selected if libmi.so
+        did not record all of them """
+    rate, threshold, stackThreshold = getSampling( environment )
+    if rate > 1:
+        print prefix + "Sampled log: 1 of " + str( rate ) + " lock " \
+              "operations of each mutex is recorded with its unlock. " \
+              "The contention profile counts and totals are scaled by " + \
+              str( rate )
+    if threshold > 0:
+        print prefix + "Only the lock operations of at least " + \
+              formatSeconds( threshold ) + " seconds are recorded with " \
+              "their unlocks"
+    if stackThreshold > 0:
+        print prefix + "The stack traces are recorded for the operations " \
+              "of at least " + formatSeconds( stackThreshold ) + \
+              " seconds only"
+    if rate > 1 or threshold > 0:
+        print prefix + "The lock order analysis is best-effort: the " \
+              "problems involving the operations which are not recorded " \
+              "are not detected"
+    return
 
 
-def parseLogFile( logFileName,
-                  environment, operations, failedOperations, mostConsumingOps,
-                  mutexLegend, threadLegend ):
-    """ reads and parses log file """
+def readLogRecords( buf, environment, start = 0, end = -1, pieces = None,
+                    backtraces = True ):
+    """ parses the log file records in the buffer (a string or a memory
+        mapped file) from the start position up to the end one (-1 - up to
+        the end of the buffer). Only the used fields are copied from the
+        buffer; the Bt: lines are skipped without copying unless the
+        backtraces are required. Generates the operations as ( operation,
+        object, thread, retCode, clocks, backtraceBlock, sequenceNumber or
+        None, timestamp or None ). The clocks and the timestamp are
+        nanoseconds. The buffer of a compressed log is followed by the
+        decompressed pieces (see readAhead()) """
+
+    size = len( buf )
+    if end == -1:
+        end = size
+    limit = getReadAheadLimit( end, pieces )
+    position = start
+    match = opRecordRegexp.match
+    matchBacktrace = backtraceRegexp.match
+    while position < end or pieces is not None:
+        if position >= limit:
+            buf, pieces = readAhead( buf, position, pieces )
+            size = end = len( buf )
+            limit = getReadAheadLimit( end, pieces )
+            position = 0
+            continue
 
-    f = open( logFileName )
-    line = f.readline()
-    while line:
-        line = line.strip()
+        record = match( buf, position )
+        if record is not None:
+            position = record.end()
+            block = ""
+            backtraceEnd = matchBacktrace( buf, position ).end()
+            if backtraceEnd != position:
+                if backtraces:
+                    block = buf[ position : backtraceEnd ]
+                position = backtraceEnd
+            timestamp = record.group( 6 )
+            if timestamp is not None:
+                timestamp = getNanoseconds( timestamp )
+            sequence = record.group( 7 )
+            if sequence is not None:
+                sequence = int( sequence )
+            yield ( record.group( 1 ), record.group( 2 ), record.group( 3 ),
+                    int( record.group( 4 ) ), getNanoseconds( record.group( 5 ) ),
+                    block, sequence, timestamp )
+            continue
+
+        # Not a well formed Op: statement - process a line at a time
+        lineEnd = buf.find( "\n", position )
+        if lineEnd == -1:
+            lineEnd = size
+        line = buf[ position : lineEnd ].strip()
+        position = lineEnd + 1
         if line == "":
-            line = f.readline()
             continue
         if line.startswith( "Env: " ):
-            environment.append( Env( line.replace( "Env: ", "" ).strip() ) )
-            line = f.readline()
+            addEnvironment( environment,
+                            line.replace( "Env: ", "" ).strip() )
             continue
         if line.startswith( "Op: " ):
             parts = line.split()
-            if len(parts) != 10:
+            # The optional named fields follow the mandatory ones
+            fields = {}
+            for index in range( 10, len(parts) - 1, 2 ):
+                fields[ parts[index] ] = parts[index + 1]
+            if len(parts) < 10 or len(parts) % 2 != 0 or \
+               not set( fields.keys() ).issubset( [ "Time:", "Seq:" ] ):
                 raise Exception( "Unexpected Op: statement format in " \
                                  "line '" + line + "'" )
-            op = Op( parts[1].strip(), parts[3].strip(), parts[5].strip(),
-                     parts[7].strip(), parts[9].strip()  )
-            line = f.readline()
-            while line:
-                if not line.startswith( "Bt: " ):
-                    break
-                op.addBt( line.replace( "Bt: ", "" ).strip() )
-                line = f.readline()
+            sequence = None
+            if fields.has_key( "Seq:" ):
+                sequence = int( fields[ "Seq:" ] )
+            timestamp = None
+            if fields.has_key( "Time:" ):
+                timestamp = getNanoseconds( fields[ "Time:" ] )
+            backtraceStart = min( position, size )
+            while position < size and buf[ position : position + 4 ] == "Bt: ":
+                lineEnd = buf.find( "\n", position )
+                if lineEnd == -1:
+                    lineEnd = size
+                position = lineEnd + 1
+            block = ""
+            if backtraces:
+                block = buf[ backtraceStart : min( position, size ) ]
+            yield ( parts[1], parts[3], parts[5], int( parts[7] ),
+                    getNanoseconds( parts[9] ), block, sequence, timestamp )
+            continue
 
-            op.shortObj = getMutexName( mutexLegend, op.object )
-            op.shortThread = getThreadName( threadLegend, op.thread )
+        raise Exception( "Unrecognised log file line: '" + line + "'." )
+    return
 
-            # Memorise the operation time if needed
-            if op.clocks > 0.0:
-                mostConsumingOps.addOperation( op )
 
-            # Check the operation return code
-            if int(op.ret) == 0:
-                operations.append( op )
+# Binary log format (see mi.cpp)
+binaryMagic = "MIBINLOG"
+binaryOperationNames = [ "lock", "unlock", "trylock" ]
+
+
+def readBinaryLogRecords( buf, environment, pieces = None ):
+    """ decodes the binary log format records.
+        Generates the same records as readLogRecords() does.
+        The buffer of a compressed log is followed by the decompressed
+        pieces (see readAhead()) """
+
+    size = len( buf )
+    if size < 16:
+        raise Exception( "Truncated binary log file header" )
+
+    byteOrder = "<"
+    if struct.unpack( "<I", buf[ 8 : 12 ] )[ 0 ] != 0x01020304:
+        byteOrder = ">"
+    version = struct.unpack( byteOrder + "I", buf[ 12 : 16 ] )[ 0 ]
+    if version != 1:
+        raise Exception( "Unsupported binary log file format version " + \
+                         str( version ) )
+
+    lengthStruct = struct.Struct( byteOrder + "I" )
+    pairStruct = struct.Struct( byteOrder + "II" )
+    opStruct = None
+    fields = {}         # field name -> index in the unpacked 'O' record
+    inSeconds = {}      # floating point seconds field name -> True
+    frames = {}         # frame ID -> frame text
+    stacks = { 0: "" }  # stack ID -> Bt: lines block
+
+    position = 16
+    limit = getReadAheadLimit( size, pieces )
+    while position < size or pieces is not None:
+        if position >= limit:
+            buf, pieces = readAhead( buf, position, pieces )
+            size = len( buf )
+            limit = getReadAheadLimit( size, pieces )
+            position = 0
+            continue
+
+        recordType = buf[ position ]
+        position += 1
+
+        if recordType == "O":
+            if opStruct is None:
+                raise Exception( "Binary log file operation record " \
+                                 "precedes the layout record" )
+            if position + opStruct.size > size:
+                raise Exception( "Truncated binary log file record" )
+            values = opStruct.unpack_from( buf, position )
+            position += opStruct.size
+
+            address = values[ fields[ "object" ] ]
+            if address == 0:
+                obj = "(nil)"
             else:
-                failedOperations.append( op )
+                obj = "0x%x" % address
+            sequence = None
+            if fields.has_key( "seq" ):
+                sequence = values[ fields[ "seq" ] ]
+            timestamp = None
+            if fields.has_key( "time" ):
+                timestamp = values[ fields[ "time" ] ]
+                if inSeconds.has_key( "time" ):
+                    timestamp = int( round( timestamp * 1e9 ) )
+            clocks = values[ fields[ "clocks" ] ]
+            if inSeconds.has_key( "clocks" ):
+                clocks = int( round( clocks * 1e9 ) )
+            yield ( binaryOperationNames[ values[ fields[ "op" ] ] ], obj,
+                    str( values[ fields[ "thread" ] ] ),
+                    values[ fields[ "ret" ] ], clocks,
+                    stacks[ values[ fields[ "stack" ] ] ], sequence,
+                    timestamp )
             continue
 
-        raise Exception( "Unrecognised log file line: '" + line + "'." )
+        if recordType in [ "E", "L" ]:
+            if position + lengthStruct.size > size:
+                raise Exception( "Truncated binary log file record" )
+            length = lengthStruct.unpack_from( buf, position )[ 0 ]
+            position += lengthStruct.size
+            text = buf[ position : position + length ]
+            position += length
+            if recordType == "E":
+                addEnvironment( environment, text.strip() )
+                continue
+
+            # Layout: space separated name:struct format code pairs
+            # The older libmi.so wrote the times as the double seconds
+            codes = byteOrder
+            fields = {}
+            inSeconds = {}
+            for item in text.split():
+                name, code = item.split( ":" )
+                fields[ name ] = len( fields )
+                codes += code
+                if code == "d":
+                    inSeconds[ name ] = True
+            for name in [ "op", "ret", "object", "thread", "clocks", "stack" ]:
+                if not fields.has_key( name ):
+                    raise Exception( "Binary log file layout does not " \
+                                     "have the '" + name + "' field" )
+            opStruct = struct.Struct( codes )
+            continue
+
+        if recordType in [ "F", "S" ]:
+            if position + pairStruct.size > size:
+                raise Exception( "Truncated binary log file record" )
+            itemID, length = pairStruct.unpack_from( buf, position )
+            position += pairStruct.size
+            if recordType == "F":
+                frames[ itemID ] = buf[ position : position + length ]
+                position += length
+                continue
 
-    f.close()
+            frameIDs = struct.unpack_from( byteOrder + str( length ) + "I",
+                                           buf, position )
+            position += length * lengthStruct.size
+            stacks[ itemID ] = "".join( [ "Bt:  " + frames[ frameID ] + "\n"
+                                          for frameID in frameIDs ] )
+            continue
+
+        raise Exception( "Unrecognised binary log file record type '" + \
+                         recordType + "' at position " + str( position - 1 ) )
+    return
+
+
+def isBinaryLog( buf ):
+    """ True if the buffer holds a binary format log """
+    return buf[ 0 : len( binaryMagic ) ] == binaryMagic
+
+
+def mapLogFile( f ):
+    """ provides a read only memory map of the whole file
+        or an empty string for an empty file """
+    if os.fstat( f.fileno() ).st_size == 0:
+        return ""
+    return mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+
+
+# Compressed logs (see micompress.hpp). libmi.so writes independently
+# compressed blocks of whole records: the gzip members have the 'MI' extra
+# subfield with the member size, the zstd and lz4 frames are preceded by a
+# skippable frame with the frame size. The logs compressed otherwise are
+# read as well but not in parallel.
+gzipMagic = "\x1f\x8b"
+zstdMagic = "\x28\xb5\x2f\xfd"
+lz4Magic = "\x04\x22\x4d\x18"
+blockSizeMagic = "\x5d\x2a\x4d\x18"
+decompressCommands = { "zstd" : [ "zstd", "-d", "-c", "-q" ],
+                       "lz4"  : [ "lz4", "-d", "-c", "-q" ] }
+compressedReadSize = 1024 * 1024
+readAheadSize = 1024 * 1024
+
+
+def getCompression( header ):
+    """ provides the log compression by the first bytes of the file:
+        'gzip', 'zstd', 'lz4' or None """
+    if header.startswith( gzipMagic ):
+        return "gzip"
+    # The zstd and lz4 skippable frames come before the compressed ones
+    while len( header ) >= 8 and header[ 0 ] >= "\x50" and \
+          header[ 0 ] <= "\x5f" and header[ 1 : 4 ] == "\x2a\x4d\x18":
+        header = header[ 8 + struct.unpack( "<I", header[ 4 : 8 ] )[ 0 ] : ]
+    if header.startswith( zstdMagic ):
+        return "zstd"
+    if header.startswith( lz4Magic ):
+        return "lz4"
+    return None
+
+
+def getLogBlocks( f, compression ):
+    """ provides the list of the compressed blocks positions
+        or None if the log is not written in the libmi.so blocks """
+
+    f.seek( 0, 2 )
+    size = f.tell()
+    blocks = []
+    position = 0
+    while position < size:
+        f.seek( position )
+        header = f.read( 20 )
+        if compression == "gzip":
+            # The fixed header, XLEN and the 'MI' subfield first
+            if len( header ) < 20 or not header.startswith( gzipMagic ) or \
+               ord( header[ 3 ] ) & 4 == 0 or header[ 12 : 16 ] != "MI\x04\x00":
+                return None
+            blockSize = struct.unpack( "<I", header[ 16 : 20 ] )[ 0 ]
+        else:
+            if len( header ) < 12 or header[ 0 : 8 ] != blockSizeMagic + \
+                                                       "\x04\x00\x00\x00":
+                return None
+            blockSize = 12 + struct.unpack( "<I", header[ 8 : 12 ] )[ 0 ]
+        blocks.append( position )
+        position += blockSize
+    return blocks
+
+
+def feedProcess( stream, f, start, end ):
+    """ writes the file byte range to the decompressing process """
+    try:
+        f.seek( start )
+        while end == -1 or f.tell() < end:
+            size = compressedReadSize
+            if end != -1:
+                size = min( size, end - f.tell() )
+            data = f.read( size )
+            if data == "":
+                break
+            stream.write( data )
+    except IOError:
+        pass        # the process has exited
+    finally:
+        stream.close()
+    return
+
+
+def decompressLog( logFileName, compression, start = 0, end = -1 ):
+    """ generates the decompressed pieces of the log file byte range
+        (-1 - up to the end). gzip is decompressed in process, zstd and
+        lz4 via the command line tools """
+
+    f = open( logFileName, "rb" )
+    try:
+        if compression == "gzip":
+            f.seek( start )
+            decompressor = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+            while end == -1 or f.tell() < end:
+                size = compressedReadSize
+                if end != -1:
+                    size = min( size, end - f.tell() )
+                data = f.read( size )
+                if data == "":
+                    break
+                # The log is a sequence of gzip members
+                while data != "":
+                    piece = decompressor.decompress( data )
+                    data = decompressor.unused_data
+                    if data != "":
+                        decompressor = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+                    if piece != "":
+                        yield piece
+            piece = decompressor.flush()
+            if piece != "":
+                yield piece
+            return
+
+        try:
+            process = subprocess.Popen( decompressCommands[ compression ],
+                                        stdin = subprocess.PIPE,
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.PIPE )
+        except OSError:
+            raise Exception( "The " + decompressCommands[ compression ][ 0 ] + \
+                             " command is required to read the " + \
+                             compression + " compressed log files" )
+        feeder = threading.Thread( target = feedProcess,
+                                   args = ( process.stdin, f, start, end ) )
+        feeder.start()
+        finished = False
+        try:
+            while True:
+                piece = process.stdout.read( readAheadSize )
+                if piece == "":
+                    break
+                yield piece
+            finished = True
+        finally:
+            # The reader could stop before the end
+            process.stdout.close()
+            if not finished and process.poll() is None:
+                process.terminate()
+            feeder.join()
+            message = process.stderr.read().strip()
+            returnCode = process.wait()
+        if returnCode != 0:
+            raise Exception( "Cannot decompress the log file '" + \
+                             logFileName + "' with " + \
+                             decompressCommands[ compression ][ 0 ] + \
+                             ": " + message )
+    finally:
+        f.close()
+    return
+
+
+def getReadAheadLimit( size, pieces ):
+    """ provides the buffer position the records are parsed up to before
+        the buffer is refilled from the decompressed pieces """
+    if pieces is None:
+        return size
+    return size - readAheadSize
+
+
+def readAhead( buf, position, pieces ):
+    """ provides the not processed part of the buffer joined with the next
+        decompressed pieces, so more than readAheadSize bytes are left
+        after the limit (see getReadAheadLimit()) unless the log ends.
+        The pieces are None when they are over """
+    parts = [ buf[ position : ] ]
+    size = len( parts[ 0 ] )
+    while size <= 2 * readAheadSize:
+        piece = next( pieces, None )
+        if piece is None:
+            return "".join( parts ), None
+        parts.append( piece )
+        size += len( piece )
+    return "".join( parts ), pieces
+
+
+def readLog( logFileName, environment, start = 0, end = -1,
+             backtraces = True ):
+    """ generates the records of the log file byte range (-1 - up to the
+        end). The compressed logs are decompressed on the fly. The text
+        log backtraces are copied only if required """
+
+    f = open( logFileName, "rb" )
+    compression = getCompression( f.read( 64 ) )
+    buf = ""
+    try:
+        if compression is not None:
+            pieces = decompressLog( logFileName, compression, start, end )
+            data, pieces = readAhead( "", 0, pieces )
+            if isBinaryLog( data ):
+                records = readBinaryLogRecords( data, environment, pieces )
+            else:
+                records = readLogRecords( data, environment, pieces = pieces,
+                                          backtraces = backtraces )
+        else:
+            buf = mapLogFile( f )
+            if isBinaryLog( buf ):
+                records = readBinaryLogRecords( buf, environment )
+            else:
+                records = readLogRecords( buf, environment, start, end,
+                                          backtraces = backtraces )
+        for record in records:
+            yield record
+    finally:
+        if buf != "":
+            buf.close()
+        f.close()
+    return
+
+
+def getLogFormat( logFileName ):
+    """ provides ( compression or None, True if the log is binary ) """
+    f = open( logFileName, "rb" )
+    try:
+        compression = getCompression( f.read( 64 ) )
+    finally:
+        f.close()
+    if compression is None:
+        f = open( logFileName, "rb" )
+        header = f.read( len( binaryMagic ) )
+        f.close()
+    else:
+        pieces = decompressLog( logFileName, compression )
+        header = next( pieces, "" )
+        pieces.close()
+    return compression, isBinaryLog( header )
+
+
+def parseLogFile( logFileName, environment, mutexLegend, threadLegend,
+                  backtraces = True ):
+    """ reads and parses log file; generates the operations one by one.
+        The operations have no backtraces if they are not required """
+
+    # The short names are given in the order of the records in the file
+    merger = SequenceMerger( environment )
+    for record in readLog( logFileName, environment,
+                           backtraces = backtraces ):
+        getMutexName( mutexLegend, record[1] )
+        getThreadName( threadLegend, record[2] )
+        for item in merger.push( record[6], record, record[7], record[4] ):
+            yield buildOperation( item, mutexLegend, threadLegend )
+    for item in merger.finish():
+        yield buildOperation( item, mutexLegend, threadLegend )
+    return
+
+
+# The libmi.so per thread buffers flush interval Env: statement. A buffered
+# record reaches the log within about two flush intervals; the window
+# doubles it for the scheduling delays
+flushIntervalRegexp = re.compile( r"^buffer flush interval: (\d+) ns$" )
+reorderWindowFactor = 4
+
+
+def getReorderWindow( environment ):
+    """ provides the nanoseconds a buffered record could come late for or
+        None if the log does not tell the buffers flush interval """
+    for item in environment:
+        match = flushIntervalRegexp.match( item.string )
+        if match:
+            return int( match.group( 1 ) ) * reorderWindowFactor
+    return None
+
+
+class SequenceMerger:
+    """ Restores the order of the records written via the per thread buffers.
+        The records of each thread come in order, so the threads streams are
+        merged on the fly: a record is released as soon as all the records
+        with smaller sequence numbers are released. The records without a
+        sequence number are released as they come.
+        A missing record is waited for up to the reorder window: once a
+        record which ended later than the window after the first waiting
+        one is read, the missing one is lost or late, so the waiting ones are
+        released. The memory is bounded by the records of the window. The
+        records which come after that are released as they come """
+
+    def __init__( self, environment = None ):
+        self.pending = []       # min-heap of ( sequence number, number,
+                                #               end time, item )
+        self.expected = 0       # the next sequence number to release
+        self.count = 0
+        self.environment = environment  # tells the reorder window
+        self.window = None      # nanoseconds, None - wait for all records
+        self.latest = 0         # the latest record end time
+        self.late = 0           # the records came after the window
+
+    def push( self, sequence, item, time = None, clocks = 0 ):
+        """ provides the list of the items which can be released.
+            The record timestamp and clocks tell when it ended """
+
+        if sequence is None:
+            return [ item ]
+        if self.environment is not None:
+            self.window = getReorderWindow( self.environment )
+            self.environment = None
+        end = None
+        if time is not None:
+            end = time + clocks
+            self.latest = max( self.latest, end )
+        if sequence < self.expected:
+            self.late += 1
+            return [ item ]
+        if sequence == self.expected and not self.pending:
+            self.expected = sequence + 1
+            return [ item ]
+
+        heapq.heappush( self.pending, ( sequence, self.count, end, item ) )
+        self.count += 1
+        released = []
+        while self.pending:
+            sequence, number, end, item = self.pending[ 0 ]
+            if sequence > self.expected and \
+               ( self.window is None or end is None or
+                 self.latest - end <= self.window ):
+                break
+            heapq.heappop( self.pending )
+            self.expected = sequence + 1
+            released.append( item )
+        return released
+
+    def finish( self ):
+        """ provides the rest of the items in order. There are gaps in the
+            sequence numbers if the application has not finished properly """
+        released = []
+        while self.pending:
+            released.append( heapq.heappop( self.pending )[ 3 ] )
+        if self.late > 0:
+            print >> sys.stderr, "WARNING: " + str( self.late ) + \
+                  " buffered records came later than the reorder window " \
+                  "and are analysed out of order"
+        return released
+
+
+def buildOperation( record, mutexLegend, threadLegend ):
+    """ Creates an operation from the parsed log file record """
+
+    op = Op( record[0], record[1], record[2], record[3], record[4], record[7] )
+    if record[5]:
+        op.backtrace = frameTable.getBlockStackID( record[5] )
+    op.shortObj = getMutexName( mutexLegend, op.object )
+    op.shortThread = getThreadName( threadLegend, op.thread )
+    return op
+
+
+def findRecordStart( f, position ):
+    """ provides the position of the first record starting
+        at the given position or after it """
+
+    if position == 0:
+        return 0
+    f.seek( position - 1 )
+    f.readline()            # the rest of the line
+    position = f.tell()
+    while True:
+        line = f.readline()
+        if not line or not line.startswith( "Bt: " ):
+            return position
+        position += len( line )
+
+
+def splitLogFile( logFileName, jobs ):
+    """ splits the log file into byte ranges at the records boundaries """
+
+    size = os.path.getsize( logFileName )
+    chunkSize = max( min( size / jobs, 32 * 1024 * 1024 ), 1024 * 1024 )
+
+    f = open( logFileName, "rb" )
+    starts = [ 0 ]
+    compression = getCompression( f.read( 64 ) )
+    if compression is not None:
+        # The compressed blocks hold whole records
+        for start in getLogBlocks( f, compression ) or []:
+            if start >= starts[ -1 ] + chunkSize:
+                starts.append( start )
+        f.close()
+    else:
+        position = chunkSize
+        while position < size:
+            start = findRecordStart( f, position )
+            if start >= size:
+                break
+            if start > starts[ -1 ]:
+                starts.append( start )
+            position = max( start, position ) + chunkSize
+        f.close()
+
+    ranges = []
+    for index in range( 0, len( starts ) ):
+        if index == len( starts ) - 1:
+            ranges.append( ( starts[ index ], size ) )
+        else:
+            ranges.append( ( starts[ index ], starts[ index + 1 ] ) )
+    return ranges
+
+
+def parseLogChunk( task ):
+    """ Parses a byte range of a log file in a worker process. The mutexes,
+        threads and backtraces are interned per chunk and the records refer
+        to them by the index. The per operation statistics which do not
+        depend on the other chunks are collected here.
+        Provides the chunk environment, the mutexes, threads and backtrace
+        blocks in order of appearance, the compact records, the indexes of
+        the chunk most time consuming records, the chunk time statistics and
+        the chunk lock and trylock contention profile (if required) """
+
+    logFileName, start, end, tcoLimit, percentiles, contention = task
+
+    environment = []
+    records = []
+    mutexes = {}            # object -> index
+    threads = {}            # thread -> index
+    blocks = { "": 0 }      # Bt: lines block -> index, 0 - no backtrace
+    latencies = None
+    if percentiles:
+        latencies = LatencyStatistics()
+    profile = None
+    if contention:
+        profile = ContentionProfile()
+
+    for operation, obj, thread, ret, clocks, block, sequence, timestamp \
+            in readLog( logFileName, environment, start, end ):
+        mutex = mutexes.setdefault( obj, len( mutexes ) )
+        threadIndex = threads.setdefault( thread, len( threads ) )
+        blockIndex = blocks.setdefault( block or "", len( blocks ) )
+        records.append( ( intern( operation ), mutex, threadIndex, ret,
+                          clocks, blockIndex, sequence, timestamp ) )
+
+        if latencies is not None:
+            latencies.addValue( obj, thread, clocks )
+        if profile is not None and \
+           ( operation == "lock" or operation == "trylock" ):
+            # The chunk profile is keyed by the objects, the threads and
+            # the blocks; they are renamed when the chunk is merged
+            op = Op( operation, obj, thread, ret, clocks )
+            op.shortThread = op.thread
+            profile.getProfile( profile.mutexes, op.object ).addAcquisition( op )
+            if blockIndex != 0:
+                profile.getProfile( profile.sites,
+                                    ( op.object, blockIndex ) ).addAcquisition( op )
+
+    # nlargest() is stable so the equally consuming records
+    # stay in the order of appearance
+    consuming = heapq.nlargest( max( tcoLimit, 0 ),
+                                [ index for index in range( len(records) )
+                                  if records[ index ][ 4 ] > 0.0 ],
+                                key = lambda index: records[ index ][ 4 ] )
+    return environment, getInterned( mutexes ), getInterned( threads ), \
+           getInterned( blocks ), records, sorted( consuming ), latencies, \
+           profile
+
+
+def getInterned( indexes ):
+    """ provides the keys of the key -> index dictionary in the index order """
+    keys = [ None ] * len( indexes )
+    for key, index in indexes.iteritems():
+        keys[ index ] = key
+    return keys
+
+
+def parseLogFileParallel( logFileName, environment, mutexLegend, threadLegend,
+                          failedOperations, mostConsumingOps, latencies,
+                          jobs, sections, profile = None ):
+    """ parses the log file chunks in a pool of processes. The chunks results
+        are merged in the file order so the short names are the same as
+        for a single process parsing. Generates the successfull operations """
+
+    compression, binary = getLogFormat( logFileName )
+    if compression is not None and not binary:
+        f = open( logFileName, "rb" )
+        blocks = getLogBlocks( f, compression )
+        f.close()
+    if binary or ( compression is not None and blocks is None ):
+        # The binary records refer to the frames and stacks defined earlier
+        # in the file and are decoded in bulk quickly anyway. The logs
+        # compressed as a whole can only be decompressed sequentially.
+        for op in filterOperations( parseLogFile( logFileName, environment,
+                                                  mutexLegend, threadLegend ),
+                                    failedOperations, mostConsumingOps,
+                                    latencies, sections, profile ):
+            yield op
+        return
+
+    # The most consuming operations, the latencies and the acquisitions
+    # are collected by the chunks; the critical sections span the chunks
+    for op in mergeLogChunks( logFileName, environment, mutexLegend,
+                              threadLegend, mostConsumingOps, latencies,
+                              profile, jobs ):
+        hold = sections.addOperation( op )
+        if profile is not None:
+            profile.addHold( hold )
+        if op.ret == 0:
+            yield op
+        else:
+            failedOperations.append( op )
+    return
+
+
+def mergeLogChunks( logFileName, environment, mutexLegend, threadLegend,
+                    mostConsumingOps, latencies, profile, jobs ):
+    """ parses the log file chunks in a pool of processes and generates
+        all the operations in order """
+
+    tasks = []
+    for start, end in splitLogFile( logFileName, jobs ):
+        tasks.append( ( logFileName, start, end, mostConsumingOps.limit,
+                        latencies is not None, profile is not None ) )
+
+    merger = SequenceMerger( environment )
+    pool = multiprocessing.Pool( jobs )
+    try:
+        # Limit the number of the parsed chunks waiting for the merge
+        pending = []
+        taskIndex = 0
+        while taskIndex < len( tasks ) or pending:
+            while taskIndex < len( tasks ) and len( pending ) < 2 * jobs:
+                pending.append( pool.apply_async( parseLogChunk,
+                                                  ( tasks[ taskIndex ], ) ) )
+                taskIndex += 1
+
+            chunkEnvironment, mutexes, threads, blocks, records, consuming, \
+                chunkLatencies, chunkProfile = pending.pop( 0 ).get()
+
+            for item in chunkEnvironment:
+                addEnvironment( environment, item.string )
+            mutexNames = [ getMutexName( mutexLegend, mutex )
+                           for mutex in mutexes ]
+            threadNames = [ getThreadName( threadLegend, thread )
+                            for thread in threads ]
+            stackIDs = [ frameTable.getBlockStackID( block )
+                         for block in blocks ]
+            if latencies is not None:
+                latencies.merge( chunkLatencies, mutexLegend, threadLegend )
+            if profile is not None:
+                # The chunk call sites are keyed by the blocks
+                siteFrames = []
+                for stackID in stackIDs:
+                    siteFrames.append( None )
+                    if stackID != 0:
+                        siteFrames[ -1 ] = frameTable.stacks[ stackID ][ 0 ]
+                profile.merge( chunkProfile, mutexLegend, threadLegend,
+                               siteFrames )
+
+            operations = []
+            for operation, mutex, thread, ret, clocks, block, sequence, \
+                    timestamp in records:
+                op = Op( operation, mutexes[ mutex ], threads[ thread ], ret,
+                         clocks, timestamp )
+                op.backtrace = stackIDs[ block ]
+                op.shortObj = mutexNames[ mutex ]
+                op.shortThread = threadNames[ thread ]
+                operations.append( op )
+            for index in consuming:
+                mostConsumingOps.addOperation( operations[ index ] )
+
+            for index in range( 0, len( operations ) ):
+                for op in merger.push( records[ index ][ 6 ],
+                                       operations[ index ],
+                                       records[ index ][ 7 ],
+                                       records[ index ][ 4 ] ):
+                    yield op
+
+        for op in merger.finish():
+            yield op
+    finally:
+        pool.terminate()
+        pool.join()
+    return
+
+
+class LockClasses:
+    """ Identifies the mutexes of different logs. The mutexes locked at the
+        same call stack (or at the same address if there are no stacks) of
+        the same application are the same lock class and so are all the
+        call stacks a mutex of a log is locked at. Two mutexes of the same
+        log are never of the same class """
+
+    def __init__( self ):
+        self.parents = {}       # key -> parent key
+        self.members = {}       # root key -> { log index -> mZZZ }
+
+    def find( self, key ):
+        """ provides the class root key """
+        root = self.parents.setdefault( key, key )
+        while self.parents[ root ] != root:
+            root = self.parents[ root ]
+        while key != root:
+            parent = self.parents[ key ]
+            self.parents[ key ] = root
+            key = parent
+        return root
+
+    def addMutex( self, index, shortObj ):
+        """ provides the key of a mutex of a log """
+        key = ( "mutex", index, shortObj )
+        if not self.parents.has_key( key ):
+            self.parents[ key ] = key
+            self.members[ key ] = { index : shortObj }
+        return key
+
+    def union( self, first, second ):
+        """ Puts both keys to the same class unless two different mutexes
+            of a log would be of the same class then """
+        first = self.find( first )
+        second = self.find( second )
+        if first == second:
+            return
+        firstMembers = self.members.get( first, {} )
+        secondMembers = self.members.get( second, {} )
+        for index, shortObj in secondMembers.iteritems():
+            if firstMembers.get( index, shortObj ) != shortObj:
+                return
+        self.parents[ second ] = first
+        firstMembers.update( secondMembers )
+        self.members[ first ] = firstMembers
+        if self.members.has_key( second ):
+            del self.members[ second ]
+        return
+
+
+def getApplication( environment ):
+    """ provides the application name from the log environment """
+    for item in environment:
+        if item.string.startswith( "application: " ):
+            return item.string[ len( "application: " ): ]
+    return "unknown"
+
+
+def getLogFileNames( args ):
+    """ provides the log files given as files, directories (their *.log
+        files are taken) or shell patterns """
+
+    names = []
+    for arg in args:
+        if os.path.isdir( arg ):
+            found = sorted( glob.glob( os.path.join( arg, "*.log" ) ) )
+        elif os.path.exists( arg ):
+            found = [ arg ]
+        else:
+            found = sorted( glob.glob( arg ) )
+            if len( found ) == 0:
+                found = [ arg ]     # reported as not found
+        for name in found:
+            if not name in names:
+                names.append( name )
+    return names
+
+
+def parseLogOfMany( task ):
+    """ Parses a log file of many in a worker process: as a single log but
+        the messages are memorised only. Provides the parsed log content """
+
+    logFileName, options = task
+
+    global frameTable
+    global phaseStatistics
+    global reportWriter
+    frameTable = FrameTable()
+    setFindingsCount( 0, 0 )
+    phaseStatistics = None
+    reportWriter = None
+    if options.jsonFile is not None:
+        reportWriter = ReportWriter( open( os.devnull, "w" ) )
+    options.jobs = 1
+
+    stderr = sys.stderr
+    sys.stderr = open( os.devnull, "w" )
+    try:
+        content = None
+        if options.useCache:
+            content = loadParsedLog( logFileName, options )
+        if content is None:
+            content = parseLog( logFileName, options, True )
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    return content
+
+
+def getLogOperations( content ):
+    """ provides the operations of the parsed log content which are
+        reported; each operation is provided once """
+
+    operations = {}
+    for threadChains in content[ "chains" ].values():
+        for chain in threadChains:
+            for op in chain:
+                operations[ id( op ) ] = op
+    for op in content[ "failedOperations" ]:
+        operations[ id( op ) ] = op
+    for op in content[ "mostConsumingOps" ].getOperations():
+        operations[ id( op ) ] = op
+    for duration, lockOp, unlockOp in content[ "sections" ].longest.getOperations():
+        operations[ id( lockOp ) ] = lockOp
+        operations[ id( unlockOp ) ] = unlockOp
+    return operations.values()
+
+
+def mergeParsedLogs( logFileNames, contents, options ):
+    """ Merges the parsed logs contents into one with the threads of all
+        the logs and the mutexes of the same lock class (see LockClasses)
+        of different logs being one mutex. Prints the logs findings """
+
+    # The stacks are registered in this process frames table
+    maps = [ frameTable.addState( content[ "frames" ] ) for content in contents ]
+
+    # The call stacks locking more than one mutex in a log (e.g. a lock
+    # helper) identify nothing
+    classes = LockClasses()
+    sites = []
+    ambiguous = {}
+    for index in range( 0, len( contents ) ):
+        application = getApplication( contents[ index ][ "environment" ] )
+        stackMap = maps[ index ][ 1 ]
+        logSites = {}
+        for threadChains in contents[ index ][ "chains" ].values():
+            for chain in threadChains:
+                for op in chain:
+                    if op.backtrace == 0:
+                        site = ( application, op.object )
+                    else:
+                        site = ( application, stackMap[ op.backtrace ] )
+                    mutexes = logSites.setdefault( site, {} )
+                    mutexes[ op.shortObj ] = True
+                    if len( mutexes ) > 1:
+                        ambiguous[ site ] = True
+        sites.append( logSites )
+    for index in range( 0, len( contents ) ):
+        for site, mutexes in sites[ index ].iteritems():
+            if ambiguous.has_key( site ):
+                continue
+            classes.union( classes.addMutex( index, mutexes.keys()[ 0 ] ),
+                           site )
+
+    # Global names in the order of the logs
+    mutexLegend = {}        # description -> mZZZ
+    threadLegend = {}       # description -> tZZZ
+    classNames = {}         # class root -> [ mZZZ, description ]
+    mutexNames = []         # log index -> { log mZZZ -> mZZZ }
+    threadNames = []        # log index -> { log tZZZ -> tZZZ }
+    for index in range( 0, len( contents ) ):
+        content = contents[ index ]
+        logMutexes = dict( [ ( name, address ) for address, name
+                             in content[ "mutexLegend" ].iteritems() ] )
+        names = {}
+        for name in sorted( logMutexes.keys(), compareLegendName ):
+            root = classes.find( classes.addMutex( index, name ) )
+            if not classNames.has_key( root ):
+                classNames[ root ] = [ "m" + str( len( classNames ) ), [] ]
+            classNames[ root ][ 1 ].append( "log " + str( index ) + " " +
+                                            name + " " + logMutexes[ name ] )
+            names[ name ] = classNames[ root ][ 0 ]
+        mutexNames.append( names )
+
+        logThreads = dict( [ ( name, address ) for address, name
+                             in content[ "threadLegend" ].iteritems() ] )
+        names = {}
+        for name in sorted( logThreads.keys(), compareLegendName ):
+            names[ name ] = "t" + str( len( threadLegend ) )
+            threadLegend[ "log " + str( index ) + " " + name + " " +
+                          logThreads[ name ] ] = names[ name ]
+        threadNames.append( names )
+    for name, descriptions in classNames.values():
+        mutexLegend[ ", ".join( descriptions ) ] = name
+
+    # The per log findings are printed as they are
+    mostConsumingOps = MostConsumingOperations( options.tcoLimit )
+    sections = CriticalSections( options.tcoLimit )
+    latencies = None
+    if options.percentiles:
+        latencies = LatencyStatistics()
+    profile = None
+    if options.contention:
+        profile = ContentionProfile()
+    failedOperations = []
+    chains = {}
+    chainsIndex = {}
+    operationsCount = 0
+    estimatedOps = 0
+    warnings = 0
+    errors = 0
+    for index in range( 0, len( contents ) ):
+        content = contents[ index ]
+        frameMap, stackMap = maps[ index ]
+        print "Log file " + str( index ) + ": " + logFileNames[ index ]
+        for item in content[ "environment" ]:
+            print "    " + item.string
+        printSamplingNote( content[ "environment" ], "    " )
+        sys.stdout.flush()
+        sys.stderr.write( content[ "messages" ] )
+        printRepeatedFindings( content[ "findings" ], index )
+        if reportWriter is not None:
+            reportWriter.write( { "type"        : "log",
+                                  "index"       : index,
+                                  "file"        : logFileNames[ index ],
+                                  "environment" : [ item.string for item
+                                                    in content[ "environment" ] ] } )
+            reportWriter.writeLogRecords( content[ "records" ][ 0 ], index,
+                                          mutexNames[ index ],
+                                          threadNames[ index ], stackMap )
+
+        for op in getLogOperations( content ):
+            op.shortObj = mutexNames[ index ][ op.shortObj ]
+            op.shortThread = threadNames[ index ][ op.shortThread ]
+            op.backtrace = stackMap[ op.backtrace ]
+
+        failedOperations.extend( content[ "failedOperations" ] )
+        for op in content[ "mostConsumingOps" ].getOperations():
+            mostConsumingOps.addOperation( op )
+        for item in content[ "sections" ].longest.getOperations():
+            sections.longest.addItem( item[ 0 ], item )
+        if latencies is not None:
+            latencies.merge( content[ "latencies" ], mutexNames[ index ],
+                             threadNames[ index ] )
+        if profile is not None:
+            profile.merge( content[ "profile" ], mutexNames[ index ],
+                           threadNames[ index ], frameMap )
+
+        # A mutex class is locked in a chain once
+        for shortThread in sorted( content[ "chains" ].keys(),
+                                   compareLegendName ):
+            for chain in content[ "chains" ][ shortThread ]:
+                locked = {}
+                classChain = []
+                for op in chain:
+                    if not locked.has_key( op.shortObj ):
+                        locked[ op.shortObj ] = True
+                        classChain.append( op )
+                if len( classChain ) > 1:
+                    addChain( chains, chainsIndex, classChain )
+
+        operationsCount += content[ "operationsCount" ]
+        estimatedOps += content[ "estimatedOps" ]
+        warnings += content[ "warningsCount" ]
+        errors += content[ "errorsCount" ]
+
+    # The cross logs findings are numbered after the logs ones
+    setFindingsCount( warnings, errors )
+    return { "environment"      : [],
+             "failedOperations" : failedOperations,
+             "mutexLegend"      : mutexLegend,
+             "threadLegend"     : threadLegend,
+             "chains"           : chains,
+             "mostConsumingOps" : mostConsumingOps,
+             "latencies"        : latencies,
+             "profile"          : profile,
+             "sections"         : sections,
+             "operationsCount"  : operationsCount,
+             "estimatedOps"     : estimatedOps }
+
+
+def processLogFiles( logFileNames, options ):
+    """ Analyses many log files together: the logs are parsed in a pool of
+        processes (the caches are used), the results are merged and the
+        lock order is analysed across the logs """
+
+    frameTable.symbolizer = Symbolizer( options.symbolsCache,
+                                        [ item for item in
+                                          options.symbolsPath.split( ":" )
+                                          if item ], options.symbolize )
+
+    startPhase( "parse" )
+    pool = multiprocessing.Pool( max( min( options.jobs,
+                                           len( logFileNames ) ), 1 ) )
+    try:
+        contents = pool.map( parseLogOfMany,
+                             [ ( logFileName, options )
+                               for logFileName in logFileNames ] )
+    finally:
+        pool.terminate()
+        pool.join()
+    stopPhase( "parse" )
+
+    startPhase( "merge" )
+    content = mergeParsedLogs( logFileNames, contents, options )
+    stopPhase( "merge" )
+    setCount( "logs", len( logFileNames ) )
+    return printReport( content, options )
+
+
+cacheVersion = 11
+cacheHashBlocks = 16            # log file blocks in the cache key hash
+cacheHashBlockSize = 64 * 1024
+
+
+def getCacheFileName( logFileName ):
+    """ provides the name of the sidecar cache of the log file """
+    return logFileName + ".statmi-cache"
+
+
+def getLogFileStat( logFileName ):
+    """ provides the log file path, size and modification time """
+    info = os.stat( logFileName )
+    return ( os.path.abspath( logFileName ), info.st_size, info.st_mtime )
+
+
+def getLogFileHash( logFileName ):
+    """ provides the hash of a few log file blocks spread over the file
+        and of its tail. With the size and the modification time it tells
+        a rewritten log without reading the whole file """
+    size = os.path.getsize( logFileName )
+    step = max( size / cacheHashBlocks, cacheHashBlockSize )
+    positions = range( 0, size, step ) + \
+                [ max( size - cacheHashBlockSize, 0 ) ]
+
+    digest = hashlib.md5()
+    f = open( logFileName, "rb" )
+    try:
+        for position in positions:
+            f.seek( position )
+            digest.update( f.read( cacheHashBlockSize ) )
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+class LogFollower:
+    """ Follows a growing text log file like tail -f. The per thread chains,
+        the lock order graph and the timing are kept between the reads so
+        the problems are reported as soon as they appear in the log """
+
+    def __init__( self, logFileName, ignoreUnknown, tcoLimit ):
+        self.logFileName = os.path.abspath( logFileName )
+        self.offset = 0             # the log file position processed so far
+        self.size = 0               # the log file size at the last read
+        self.head = ""              # the log file beginning to detect rotation
+        self.environment = []
+        self.mutexLegend = {}
+        self.threadLegend = {}
+        self.chains = {}
+        self.failedOperations = []
+        self.graph = LockOrderGraph()
+        self.collector = ChainsCollector( self.chains, ignoreUnknown,
+                                          self.graph )
+        self.mostConsumingOps = MostConsumingOperations( tcoLimit )
+        self.mostConsuming = []
+        self.sections = CriticalSections( tcoLimit )
+        self.longestSections = []
+        self.merger = SequenceMerger( self.environment )
+        self.reportedCycles = {}    # sorted cycle mutexes -> True
+        self.frames = ( [], [ () ] )
+        self.warningsCount = 0
+        self.errorsCount = 0
+
+    def read( self, flushTail ):
+        """ processes the records appended to the log since the last read.
+            The last record could still be incomplete (its Bt: lines are
+            not written yet) so it is processed only if flushTail is True
+            and the log has no stack traces. Otherwise it waits for the
+            next record. Returns True if anything is processed """
+
+        f = open( self.logFileName, "rb" )
+        try:
+            f.seek( 0, 2 )
+            size = f.tell()
+            f.seek( 0 )
+            head = f.read( min( size, 4096 ) )
+            if size < self.offset or not head.startswith( self.head ):
+                raise Exception( "The log file '" + self.logFileName + \
+                                 "' is truncated or replaced" )
+            if size == self.offset:
+                return False
+            # Something is appended since the last read
+            if size != self.size or self.hasStackTraces():
+                flushTail = False
+            self.size = size
+            f.seek( self.offset )
+            data = f.read( size - self.offset )
+        finally:
+            f.close()
+
+        if data.startswith( binaryMagic ):
+            raise Exception( "The binary log files cannot be followed" )
+        if getCompression( head ) is not None:
+            raise Exception( "The compressed log files cannot be followed" )
+
+        if not flushTail:
+            # Up to the beginning of the last Op: or Env: statement
+            end = max( data.rfind( "\nOp: " ), data.rfind( "\nEnv: " ) ) + 1
+            if end == 0:
+                return False
+            data = data[ : end ]
+        elif not data.endswith( "\n" ):
+            return False
+
+        if len( self.head ) < 4096:
+            self.head = head[ : self.offset + len( data ) ]
+        self.offset += len( data )
+
+        envCount = len( self.environment )
+        for record in readLogRecords( data, self.environment ):
+            getMutexName( self.mutexLegend, record[1] )
+            getThreadName( self.threadLegend, record[2] )
+            for item in self.merger.push( record[6], record, record[7],
+                                          record[4] ):
+                self.addOperation( buildOperation( item, self.mutexLegend,
+                                                   self.threadLegend ) )
+
+        for item in self.environment[ envCount : ]:
+            print "Execution environment: " + item.string
+        printSamplingNote( self.environment[ envCount : ] )
+        self.checkMostConsuming()
+        self.checkLongestSections()
+        self.checkLockOrderCycles()
+        sys.stdout.flush()
+        return True
+
+    def hasStackTraces( self ):
+        """ True if the operations are followed by the Bt: lines """
+        for item in self.environment:
+            if item.string.startswith( "print stack trace" ):
+                return True
+        return False
+
+    def addOperation( self, op ):
+        """ Processes a single operation and reports the new lock order
+            problems it introduces """
+
+        if op.clocks > 0.0:
+            self.mostConsumingOps.addOperation( op )
+        self.sections.addOperation( op )
+        if op.ret != 0:
+            self.failedOperations.append( op )
+            print "Failed operation:"
+            print op.getPrepended( "    " )
+            return
+
+        self.collector.addOperation( op )
+        for first, second, shortThread in self.collector.newEdges:
+            self.checkOppositeEdges( first, second, shortThread )
+        self.collector.newEdges = []
+        return
+
+    def checkOppositeEdges( self, first, second, shortThread ):
+        """ Reports the other threads which lock the mutexes of a new
+            lock order edge in the opposite order """
+
+        if not self.graph.hasEdge( second, first ):
+            return
+        forward = self.graph.edges[ first ][ second ]
+        backward = self.graph.edges[ second ][ first ]
+        for otherThread in sorted( backward.keys(), compareLegendName ):
+            if otherThread == shortThread:
+                continue
+            firstSample = forward[ shortThread ]
+            secondSample = backward[ otherThread ]
+            if compareLegendName( shortThread, otherThread ) > 0:
+                firstSample, secondSample = secondSample, firstSample
+            printWrongLockOrderError( firstSample[0], secondSample[0],
+                                      firstSample[1:], secondSample[1:] )
+        return
+
+    def checkMostConsuming( self ):
+        """ Reports the operations which entered the most consuming ones """
+
+        mostConsuming = self.mostConsumingOps.getOperations()
+        ranks = getNewRanks( self.mostConsuming, mostConsuming )
+        self.mostConsuming = mostConsuming
+        if len( ranks ) == 0:
+            return
+        print "New most time consuming operations:"
+        for rank in ranks:
+            print "    Rank " + str( rank + 1 ) + ":"
+            print mostConsuming[ rank ].getPrepended( "        " )
+        if reportWriter is not None:
+            reportWriter.writeMostConsuming( mostConsuming, ranks )
+        return
+
+    def checkLongestSections( self ):
+        """ Reports the critical sections which entered the longest ones """
+
+        longest = self.sections.longest.getOperations()
+        ranks = getNewRanks( self.longestSections, longest )
+        self.longestSections = longest
+        if len( ranks ) == 0:
+            return
+        print "New longest critical sections:"
+        for rank in ranks:
+            duration, lockOp, unlockOp = longest[ rank ]
+            print "    Rank " + str( rank + 1 ) + ", held for " + \
+                  formatSeconds( duration ) + " seconds:"
+            print lockOp.getPrepended( "        " )
+            print unlockOp.getPrepended( "        " )
+        if reportWriter is not None:
+            reportWriter.writeLongestSections( longest, ranks )
+        return
+
+    def printSummary( self ):
+        """ Prints the most consuming operations and the longest critical
+            sections seen so far """
+
+        if len( self.mostConsuming ) > 0:
+            print "The most time consuming operations:"
+            for item in self.mostConsuming:
+                print item.getPrepended( "    " )
+        self.sections.printLongest( len( self.longestSections ) )
+        return
+
+    def checkLockOrderCycles( self ):
+        """ Reports the new lock order cycles of three or more mutexes """
+
+        for component in self.graph.getStronglyConnectedComponents():
+            cycle = self.graph.findCycle( component )
+            if cycle is None:
+                continue
+            key = tuple( sorted( [ item[1].shortObj for item in cycle ],
+                                 compareLegendName ) )
+            if self.reportedCycles.has_key( key ):
+                continue
+            self.reportedCycles[ key ] = True
+            printLockOrderCycleError( cycle )
+        return
+
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        state[ "frames" ] = frameTable.getState()
+        state[ "warningsCount" ] = warningsCount
+        state[ "errorsCount" ] = errorsCount
+        state[ "findings" ] = findings
+        return state
+
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
+        frameTable.setState( self.frames )
+        for item in self.environment:
+            if item.string.startswith( "module: " ):
+                frameTable.addModule( item.string )
+        setFindingsCount( self.warningsCount, self.errorsCount,
+                          self.findings )
+        return
+
+
+def followLogFile( logFileName, options ):
+    """ Follows the log file until interrupted. The state is saved in the
+        checkpoint file (if given) after each read so that the next run
+        continues from the position where the previous one stopped """
+
+    follower = None
+    if options.checkpoint is not None:
+        follower = readStateFile( options.checkpoint )
+        if follower is not None and \
+           follower.logFileName != os.path.abspath( logFileName ):
+            follower = None
+        if follower is not None:
+            print "Continuing from position " + str( follower.offset ) + \
+                  " of the log file"
+    if follower is None:
+        follower = LogFollower( logFileName, options.ignoreUnknown,
+                                options.tcoLimit )
+
+    print "Following log file '" + logFileName + "' (Ctrl+C to stop)..."
+    sys.stdout.flush()
+    idle = False
+    try:
+        while True:
+            if follower.read( idle ):
+                idle = False
+                if reportWriter is not None:
+                    reportWriter.flush()
+                if options.checkpoint is not None:
+                    writeStateFile( options.checkpoint, follower )
+                continue
+            # The last record is complete if nothing is appended for a while
+            idle = True
+            time.sleep( options.interval )
+    except KeyboardInterrupt:
+        pass
+    follower.printSummary()
+    return 0
+
+
+def getNewRanks( previous, current ):
+    """ provides the ranks of the current items which are not among
+        the previous ones. The items are compared by identity """
+
+    known = set( [ id( item ) for item in previous ] )
+    return [ rank for rank in range( 0, len( current ) )
+             if not id( current[ rank ] ) in known ]
+
+
+def readStateFile( fileName ):
+    """ provides the content of a cache or checkpoint file or None if the
+        file does not exist or cannot be read """
+
+    if not os.path.exists( fileName ):
+        return None
+    try:
+        f = open( fileName, "rb" )
+        try:
+            return cPickle.loads( zlib.decompress( f.read() ) )
+        finally:
+            f.close()
+    except Exception:
+        return None
+
+
+def writeStateFile( fileName, content ):
+    """ writes a cache or checkpoint file, the old file is replaced
+        atomically. Returns False if the file cannot be written """
+
+    tempFileName = fileName + "." + str( os.getpid() )
+    try:
+        f = open( tempFileName, "wb" )
+        try:
+            f.write( zlib.compress( cPickle.dumps( content, 2 ), 1 ) )
+        finally:
+            f.close()
+        os.rename( tempFileName, fileName )
+    except Exception:
+        if os.path.exists( tempFileName ):
+            os.unlink( tempFileName )
+        return False
+    return True
+
+
+def loadParsedLog( logFileName, options ):
+    """ provides the parsed log content from the sidecar cache or None if
+        there is no valid cache for the log file and the options """
+
+    content = readStateFile( getCacheFileName( logFileName ) )
+    if content is None:
+        return None
+
+    if content.get( "version" ) != cacheVersion or \
+       content[ "stat" ] != getLogFileStat( logFileName ) or \
+       content[ "ignoreUnknown" ] != options.ignoreUnknown or \
+       content[ "symbolize" ] != options.symbolize or \
+       content[ "findingsLimit" ] != findingsLimit or \
+       content[ "tcoLimit" ] < options.tcoLimit or \
+       ( options.percentiles and content[ "latencies" ] is None ) or \
+       ( options.contention and content[ "profile" ] is None ) or \
+       ( options.jsonFile is not None and content[ "records" ] is None ):
+        return None
+    # The size and the time could be preserved while the content changed
+    if content[ "hash" ] != getLogFileHash( logFileName ):
+        return None
+    return content
+
+
+def saveParsedLog( logFileName, content ):
+    """ writes the parsed log content to the sidecar cache.
+        The cache is an optimisation so a failure is not fatal """
+
+    cacheFileName = getCacheFileName( logFileName )
+    if not writeStateFile( cacheFileName, content ):
+        print >> sys.stderr, "Cannot write cache file '" + \
+                             cacheFileName + "'"
+    return
+
+
+class StreamRecorder:
+    """ Passes the written text to the stream and memorises it """
+
+    def __init__( self, stream ):
+        self.stream = stream
+        self.parts = []
+
+    def write( self, text ):
+        self.stream.write( text )
+        self.parts.append( text )
+        return
+
+    def flush( self ):
+        self.stream.flush()
+        return
+
+    def getText( self ):
+        return "".join( self.parts )
+
+
+class ReportWriter:
+    """ Writes the findings and the statistics as soon as they appear, one
+        JSON record per line (NDJSON). The operations refer to the
+        backtraces by the stack ID; a stack record is written before the
+        first record which refers to it """
+
+    def __init__( self, stream ):
+        self.stream = stream
+        self.stacks = { 0 : True }  # stack IDs written so far
+
+    def write( self, record ):
+        """ Writes a single record """
+        self.stream.write( json.dumps( record, separators = ( ",", ":" ) ) +
+                           "\n" )
+        return
+
+    def flush( self ):
+        self.stream.flush()
+        return
+
+    def close( self ):
+        """ Flushes the records, closes the stream unless it is stdout """
+        if self.stream is sys.__stdout__:
+            self.stream.flush()
+        else:
+            self.stream.close()
+        return
+
+    def getState( self ):
+        """ provides the records written to a StreamRecorder stream and the
+            stacks written so far to be written again from the cache """
+        return ( self.stream.getText(), self.stacks )
+
+    def setState( self, state ):
+        """ writes the records memorised by getState() """
+        text, stacks = state
+        self.stream.write( text )
+        self.stacks = stacks
+        return
+
+    def writeStack( self, stackID ):
+        """ Writes the stack record if it is not written yet """
+        if not self.stacks.has_key( stackID ):
+            self.stacks[ stackID ] = True
+            self.write( { "type"   : "stack",
+                          "id"     : stackID,
+                          "frames" : frameTable.getStack( stackID ) } )
+        return
+
+    def getOperation( self, op ):
+        """ provides the operation record """
+        self.writeStack( op.backtrace )
+        return { "op"       : op.operation,
+                 "mutex"    : op.shortObj,
+                 "thread"   : op.shortThread,
+                 "ret"      : op.ret,
+                 "clocks"   : op.clocks,
+                 "time"     : op.time,
+                 "stack"    : op.backtrace }
+
+    def getChain( self, chain ):
+        """ provides the list of the operations records """
+        return [ self.getOperation( op ) for op in chain ]
+
+    def writeLogRecords( self, text, index, mutexNames, threadNames, stackMap ):
+        """ Writes the records of a log of many parsed separately: the
+            mutexes, the threads and the stacks are renamed and the log
+            index is added """
+        for line in text.splitlines():
+            record = json.loads( line )
+            if record[ "type" ] == "stack":
+                continue
+            self.renameRecord( record, mutexNames, threadNames, stackMap )
+            record[ "log" ] = index
+            self.write( record )
+        return
+
+    def renameRecord( self, record, mutexNames, threadNames, stackMap ):
+        """ Renames the mutexes, the threads and the stacks of the record
+            and of the nested ones """
+        for key, value in record.iteritems():
+            if isinstance( value, dict ):
+                self.renameRecord( value, mutexNames, threadNames, stackMap )
+            elif isinstance( value, list ):
+                for index in range( 0, len( value ) ):
+                    if isinstance( value[ index ], dict ):
+                        self.renameRecord( value[ index ], mutexNames,
+                                           threadNames, stackMap )
+                    elif isinstance( value[ index ], list ):
+                        for item in value[ index ]:
+                            self.renameRecord( item, mutexNames,
+                                               threadNames, stackMap )
+                    elif key == "mutexes":
+                        value[ index ] = mutexNames[ value[ index ] ]
+                    elif key == "threads":
+                        value[ index ] = threadNames[ value[ index ] ]
+            elif key == "mutex":
+                record[ key ] = mutexNames[ value ]
+            elif key == "thread":
+                record[ key ] = threadNames[ value ]
+            elif key == "stack":
+                record[ key ] = stackMap[ value ]
+                self.writeStack( record[ key ] )
+        return
+
+    def writeFinding( self, severity, kind, number, fields ):
+        """ Writes an error or a warning record of the given kind """
+        record = { "type" : severity, "kind" : kind, "number" : number }
+        record.update( fields )
+        self.write( record )
+        return
+
+    def writeMostConsuming( self, operations, ranks = None ):
+        """ Writes the most consuming operations, the most consuming first.
+            Only the given ranks are written if any """
+        if ranks is None:
+            ranks = range( 0, len( operations ) )
+        for rank in ranks:
+            self.write( { "type"      : "mostConsuming",
+                          "rank"      : rank,
+                          "operation" : self.getOperation( operations[ rank ] ) } )
+        return
+
+    def writeLongestSections( self, longest, ranks = None ):
+        """ Writes the ( duration, lock op, unlock op ) critical sections.
+            Only the given ranks are written if any """
+        if ranks is None:
+            ranks = range( 0, len( longest ) )
+        for rank in ranks:
+            duration, lockOp, unlockOp = longest[ rank ]
+            self.write( { "type"     : "criticalSection",
+                          "rank"     : rank,
+                          "duration" : duration,
+                          "lock"     : self.getOperation( lockOp ),
+                          "unlock"   : self.getOperation( unlockOp ) } )
+        return
+
+    def writeSketch( self, record, sketch ):
+        """ Writes the record with the sketch quantiles added """
+        record.update( { "count" : sketch.count,
+                         "p50"   : int( round( sketch.getQuantile( 0.5 ) ) ),
+                         "p90"   : int( round( sketch.getQuantile( 0.9 ) ) ),
+                         "p99"   : int( round( sketch.getQuantile( 0.99 ) ) ),
+                         "max"   : sketch.maximum } )
+        self.write( record )
+        return
+
+    def writeProfile( self, record, profile, scale ):
+        """ Writes the record with the contention profile values added.
+            The counts and totals are scaled by the sampling rate """
+        record.update( { "acquired"        : profile.acquisitions * scale,
+                         "failed"          : profile.failures * scale,
+                         "trylocks"        : profile.trylocks * scale,
+                         "trylockFailures" : profile.trylockFailures * scale,
+                         "waitTotal"       : profile.waitTotal * scale,
+                         "waitP99"         : int( round(
+                                                profile.wait.getQuantile( 0.99 ) ) ),
+                         "holds"           : profile.holds * scale,
+                         "holdTotal"       : profile.holdTotal * scale,
+                         "holdP99"         : int( round(
+                                                profile.hold.getQuantile( 0.99 ) ) ),
+                         "threads"         : sorted( profile.threads.keys(),
+                                                     compareLegendName ) } )
+        self.write( record )
+        return
+
+    def writeStatistics( self, environment, mutexLegend, threadLegend,
+                         operationsCount, failedOperations, mostConsumingOps,
+                         sections, latencies, profile, chains, options ):
+        """ Writes everything the text report has apart of the findings """
+
+        for item in environment:
+            self.write( { "type" : "environment", "text" : item.string } )
+        rate, threshold = getSampling( environment )[ : 2 ]
+        self.write( { "type"       : "summary",
+                      "threads"    : len( threadLegend ),
+                      "mutexes"    : len( mutexLegend ),
+                      "operations" : operationsCount,
+                      "failed"     : len( failedOperations ),
+                      "sampling"   : rate,
+                      "threshold"  : threshold } )
+        for kind, legend in [ ( "thread", threadLegend ),
+                              ( "mutex", mutexLegend ) ]:
+            names = dict( [ ( name, key ) for key, name in legend.iteritems() ] )
+            for name in sorted( names.keys(), compareLegendName ):
+                self.write( { "type" : kind, "name" : name,
+                              "id" : names[ name ] } )
+
+        for item in failedOperations:
+            self.write( { "type"      : "failed",
+                          "operation" : self.getOperation( item ) } )
+        self.writeMostConsuming( mostConsumingOps.getOperations(
+                                                    options.tcoLimit ) )
+        self.writeLongestSections( sections.longest.getOperations(
+                                                    options.tcoLimit ) )
+
+        if latencies is not None:
+            for kind, sketches in [ ( "mutex", latencies.mutexes ),
+                                    ( "thread", latencies.threads ) ]:
+                for name in sorted( sketches.keys(), compareLegendName ):
+                    self.writeSketch( { "type" : "latency", kind : name },
+                                      sketches[ name ] )
+
+        if options.contention:
+            for name in sorted( profile.mutexes.keys(), compareLegendName ):
+                self.writeProfile( { "type" : "contention", "mutex" : name,
+                                     "timed" : profile.timed },
+                                   profile.mutexes[ name ], profile.scale )
+            sites = [ ( key[ 0 ], frameTable.getFrame( key[ 1 ] ), item )
+                      for key, item in profile.sites.iteritems() ]
+            sites.sort( lambda left, right:
+                            compareLegendName( left[ 0 ], right[ 0 ] ) or
+                            cmp( left[ 1 ], right[ 1 ] ) )
+            for mutex, site, item in sites:
+                self.writeProfile( { "type"  : "contention",
+                                     "mutex" : mutex,
+                                     "site"  : site,
+                                     "timed" : profile.timed }, item,
+                                   profile.scale )
+
+        if options.verbose:
+            for shortThread in sorted( chains.keys(), compareLegendName ):
+                threadChains = chains[ shortThread ]
+                for index in range( 0, len( threadChains ) ):
+                    self.write( { "type"       : "chain",
+                                  "thread"     : shortThread,
+                                  "index"      : index,
+                                  "operations" :
+                                      self.getChain( threadChains[ index ] ) } )
+        return
+
+
+class PhaseStatistics:
+    """ Wall time, CPU time, peak memory and the items counts of the
+        analysis phases. A nested phase time is excluded from the
+        enclosing one """
+
+    def __init__( self ):
+        self.phases = {}        # name -> [ calls, wall, cpu, peak memory ]
+        self.order = []         # phase names in the order of the first start
+        self.running = []       # [ name, wall start, cpu start ], ...
+        self.counts = {}        # item name -> count
+        self.wallStart = time.time()
+        self.cpuStart = getCPUTime()
+
+    def start( self, name ):
+        """ Starts a phase, the running one is suspended """
+        wall, cpu = time.time(), getCPUTime()
+        if self.running:
+            self.account( self.running[ -1 ], wall, cpu )
+        if not self.phases.has_key( name ):
+            self.phases[ name ] = [ 0, 0.0, 0.0, 0.0 ]
+            self.order.append( name )
+        self.phases[ name ][ 0 ] += 1
+        self.running.append( [ name, wall, cpu ] )
+        return
+
+    def stop( self, name ):
+        """ Stops the phase and the nested ones, the suspended one goes on """
+        if not name in [ item[ 0 ] for item in self.running ]:
+            return
+        wall, cpu = time.time(), getCPUTime()
+        while True:
+            item = self.running.pop()
+            self.account( item, wall, cpu )
+            self.phases[ item[ 0 ] ][ 3 ] = getPeakMemory()
+            if item[ 0 ] == name:
+                break
+        if self.running:
+            self.running[ -1 ][ 1 ] = wall
+            self.running[ -1 ][ 2 ] = cpu
+        return
+
+    def account( self, item, wall, cpu ):
+        """ Adds the time since the phase item start or resume """
+        phase = self.phases[ item[ 0 ] ]
+        phase[ 1 ] += wall - item[ 1 ]
+        phase[ 2 ] += cpu - item[ 2 ]
+        return
+
+    def getReport( self, logFileName ):
+        """ provides the statistics as a JSON serializable dictionary """
+        if self.running:
+            self.stop( self.running[ 0 ][ 0 ] )
+        phases = []
+        for name in self.order:
+            calls, wall, cpu, memory = self.phases[ name ]
+            phases.append( { "name"         : name,
+                             "calls"        : calls,
+                             "wall"         : round( wall, 6 ),
+                             "cpu"          : round( cpu, 6 ),
+                             "peakMemoryMB" : round( memory, 1 ) } )
+        return { "version"      : 1,
+                 "log"          : logFileName,
+                 "wall"         : round( time.time() - self.wallStart, 6 ),
+                 "cpu"          : round( getCPUTime() - self.cpuStart, 6 ),
+                 "peakMemoryMB" : round( getPeakMemory(), 1 ),
+                 "phases"       : phases,
+                 "counts"       : self.counts }
+
+    def write( self, fileName, logFileName ):
+        """ Writes the JSON report to the file, - is for stdout """
+        text = json.dumps( self.getReport( logFileName ), indent = 4,
+                           sort_keys = True, separators = ( ",", ": " ) )
+        if fileName == "-":
+            print text
+        else:
+            output = open( fileName, "w" )
+            output.write( text + "\n" )
+            output.close()
+        return
+
+
+def getCPUTime():
+    """ provides the user and system CPU time of the process """
+    usage = resource.getrusage( resource.RUSAGE_SELF )
+    return usage.ru_utime + usage.ru_stime
+
+
+def getPeakMemory():
+    """ provides the process peak resident memory in MB """
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+
+
+def startPhase( name ):
+    """ starts the statistics phase if the statistics are collected """
+    if phaseStatistics is not None:
+        phaseStatistics.start( name )
+    return
+
+
+def stopPhase( name ):
+    """ stops the statistics phase if the statistics are collected """
+    if phaseStatistics is not None:
+        phaseStatistics.stop( name )
+    return
+
+
+def addCount( name, count ):
+    """ adds to the statistics items count if the statistics are collected """
+    if phaseStatistics is not None:
+        phaseStatistics.counts[ name ] = \
+                            phaseStatistics.counts.get( name, 0 ) + count
+    return
+
+
+def setCount( name, count ):
+    """ sets the statistics items count if the statistics are collected """
+    if phaseStatistics is not None:
+        phaseStatistics.counts[ name ] = count
+    return
+
+
+def timeOperations( operations, name, batchSize = 256 ):
+    """ Accounts the time of getting the operations to the phase.
+        The operations are taken in batches so the timing itself does not
+        cost more than the parsing """
+    operations = iter( operations )
+    while True:
+        startPhase( name )
+        try:
+            batch = []
+            for op in operations:
+                batch.append( op )
+                if len( batch ) >= batchSize:
+                    break
+        finally:
+            stopPhase( name )
+        if not batch:
+            return
+        for op in batch:
+            yield op
+
+
+def setFindingsCount( warnings, errors, signatures = None ):
+    """ sets the number of reported warnings and errors and the reported
+        findings signatures """
+    global warningsCount
+    global errorsCount
+    global findings
+
+    warningsCount = warnings
+    errorsCount = errors
+    if signatures is None:
+        signatures = {}
+    findings = signatures
+    return
+
+
+def getSites( operations ):
+    """ provides the call sites of the operations: the mutexes and the
+        stacks; the threads do not matter """
+    return tuple( [ ( op.shortObj, op.backtrace ) for op in operations ] )
+
+
+def isRepeatedFinding( signature, number ):
+    """ True if a finding of the same signature is reported already; its
+        occurrences are counted then. Otherwise the finding is memorised
+        with the given number """
+    if findings.has_key( signature ):
+        findings[ signature ][ 1 ] += 1
+        return True
+    findings[ signature ] = [ number, 1 ]
+    return False
+
+
+def printRepeatedFindings( signatures = None, log = None ):
+    """ Prints how many times the findings occurred if more than once.
+        The findings of a log of many are given with the log index """
+
+    if signatures is None:
+        signatures = findings
+    repeated = sorted( [ item for item in signatures.values()
+                         if item[ 1 ] > 1 ] )
+    if len( repeated ) == 0:
+        return
+    print >> sys.stderr, "Repeated findings (reported at the first " \
+                         "occurrence only):"
+    for number, count in repeated:
+        print >> sys.stderr, "    " + number + ": " + str( count ) + \
+                             " occurrences"
+        if reportWriter is not None:
+            record = { "type"     : "repeated",
+                       "number"   : int( number[ 1: ] ),
+                       "severity" : { "E" : "error",
+                                      "W" : "warning" }[ number[ 0 ] ],
+                       "count"    : count }
+            if log is not None:
+                record[ "log" ] = log
+            reportWriter.write( record )
     return
 
 
@@ -0,0 +1,121 @@
+#!/bin/env python
+#
+# File:   benchmi.py
+#
+# Permission to copy, use, modify, sell and distribute this software
+# is granted provided this copyright notice appears in all copies.
+# This software is provided "as is" without express or implied
+# warranty, and with no claim as to its suitability for any purpose.
+#
+
+
+"""
+benchmi - libmi.so overhead: the mutex operations rate of test-bench-elf
+natively and under mi.py
+"""
+
+import sys, os, os.path, subprocess, tempfile
+from optparse import OptionParser
+
+testDir = os.path.dirname( os.path.abspath( __file__ ) )
+miDir = os.path.dirname( testDir )
+
+
+def runProgram( command ):
+    """ runs test-bench-elf and provides its operations per second """
+
+    output = subprocess.Popen( command,
+                               stdout = subprocess.PIPE ).communicate()[ 0 ]
+    for line in output.splitlines():
+        parts = line.split()
+        if len( parts ) == 6 and parts[ 0 ] == "Operations:":
+            return float( parts[ 5 ] )
+    raise Exception( "Unexpected test-bench-elf output: " + output )
+
+
+def getRate( command, repeat ):
+    """ provides the best operations per second of a few runs """
+    return max( [ runProgram( command ) for index in range( 0, repeat ) ] )
+
+
+def benchmiMain():
+    """ The benchmark driver """
+
+    parser = OptionParser(
+    """
+    %prog [options]
+    Runs test-bench-elf (make love) natively and under mi.py with each
+    libmi.so and MI_OPTIONS value and prints the operations rate
+    """ )
+
+    parser.add_option( "-t", "--threads", dest="threads", default=4,
+                       type="int", help="number of threads (default: 4)" )
+    parser.add_option( "-n", "--iterations", dest="iterations",
+                       default=20000, type="int",
+                       help="locking sequences per thread, 6 operations " \
+                            "each (default: 20000)" )
+    parser.add_option( "-m", "--libmi", dest="libmi", action="append",
+                       default=[],
+                       help="libmi.so to measure, could be given many " \
+                            "times to compare builds (default: ../libmi.so)" )
+    parser.add_option( "-o", "--option", dest="options", action="append",
+                       default=[],
+                       help="MI_OPTIONS value, could be given many times, " \
+                            "'none' - no options (default: none, buffered, " \
+                            "addresses,buffered, stack)" )
+    parser.add_option( "-p", "--pthread", dest="pthread", default="",
+                       help="libpthread.so path for mi.py (default: found " \
+                            "by mi.py)" )
+    parser.add_option( "-r", "--repeat", dest="repeat", default=3,
+                       type="int", help="runs of each case, the best one " \
+                                        "is taken (default: 3)" )
+
+    options, args = parser.parse_args()
+    if len( args ) != 0 or options.repeat < 1:
+        sys.stdout = sys.stderr
+        parser.print_help()
+        return 1
+
+    program = os.path.join( testDir, "test-bench-elf" )
+    if not os.path.exists( program ):
+        print >> sys.stderr, program + " is not found. Run make love first."
+        return 2
+    libmiPaths = options.libmi
+    if len( libmiPaths ) == 0:
+        libmiPaths = [ os.path.join( miDir, "libmi.so" ) ]
+    miOptions = options.options
+    if len( miOptions ) == 0:
+        miOptions = [ "none", "buffered", "addresses,buffered", "stack" ]
+
+    command = [ program, str( options.threads ), str( options.iterations ) ]
+    native = getRate( command, options.repeat )
+
+    print "%-30s %-20s %14s %10s" % ( "libmi.so", "MI_OPTIONS", "Ops/sec",
+                                      "Slowdown" )
+    print "%-30s %-20s %14d %10.1f" % ( "native", "", native, 1.0 )
+    sys.stdout.flush()
+
+    logFileName = tempfile.mktemp( suffix = ".log" )
+    try:
+        for libmiPath in libmiPaths:
+            for miOption in miOptions:
+                miCommand = [ sys.executable, os.path.join( miDir, "mi.py" ),
+                              "-m", os.path.abspath( libmiPath ),
+                              "-l", logFileName ]
+                if options.pthread != "":
+                    miCommand += [ "-p", options.pthread ]
+                if miOption != "none":
+                    miCommand += [ "-o", miOption ]
+                rate = getRate( miCommand + command, options.repeat )
+                print "%-30s %-20s %14d %10.1f" % ( libmiPath, miOption, rate,
+                                                    native / rate )
+                sys.stdout.flush()
+    finally:
+        if os.path.exists( logFileName ):
+            os.unlink( logFileName )
+    return 0
+
+
+# The script execution entry point
+if __name__ == "__main__":
+    sys.exit( benchmiMain() )
@@ -0,0 +1,159 @@
+#!/bin/env python
+#
+# File:   benchstatmi.py
+#
+# Permission to copy, use, modify, sell and distribute this software
+# is granted provided this copyright notice appears in all copies.
+# This software is provided "as is" without express or implied
+# warranty, and with no claim as to its suitability for any purpose.
+#
+
+
+"""
+benchstatmi - statmi.py phases timing on synthetic logs of growing size
+"""
+
+import sys, os, os.path, time, resource, subprocess
+from optparse import OptionParser
+
+testDir = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.insert( 0, os.path.dirname( testDir ) )
+
+
+def getPeakMemory():
+    """ provides the process peak resident memory in MB """
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+
+
+class NullStream:
+    """ Swallows the statmi messages """
+    def write( self, text ):
+        return
+    def flush( self ):
+        return
+
+
+def benchmarkLog( logFileName ):
+    """ Runs the statmi phases on the log file and provides the list of
+        ( phase, seconds, items, peak memory MB ) """
+
+    import statmi
+
+    # The whole log is processed whatever the number of the findings
+    statmi.findingsLimit = 0
+    statmi.setFindingsCount( 0, 0 )
+
+    results = []
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = NullStream()
+    try:
+        # Parsing alone
+        start = time.time()
+        count = 0
+        for op in statmi.parseLogFile( logFileName, [], {}, {} ):
+            count += 1
+        results.append( ( "parseLogFile", time.time() - start, count,
+                          getPeakMemory() ) )
+
+        # Parsing and the chains collection; addChain() is timed separately
+        addChainTime = [ 0.0, 0 ]
+        addChain = statmi.addChain
+        def timedAddChain( chains, chainsIndex, chain ):
+            start = time.time()
+            try:
+                return addChain( chains, chainsIndex, chain )
+            finally:
+                addChainTime[ 0 ] += time.time() - start
+                addChainTime[ 1 ] += 1
+        statmi.addChain = timedAddChain
+
+        chains = {}
+        collector = statmi.ChainsCollector( chains, True )
+        start = time.time()
+        statmi.collectChains( ( op for op in statmi.parseLogFile(
+                                                logFileName, [], {}, {} )
+                                if op.ret == 0 ), collector )
+        total = time.time() - start
+        statmi.addChain = addChain
+        memory = getPeakMemory()
+        results.append( ( "collectChains", max( total - results[0][1], 0.0 ),
+                          collector.operationsCount, memory ) )
+        results.append( ( "addChain", addChainTime[ 0 ], addChainTime[ 1 ],
+                          memory ) )
+
+        statmi.setFindingsCount( 0, 0 )
+        start = time.time()
+        statmi.analyse( chains, False )
+        results.append( ( "analyse", time.time() - start,
+                          sum( [ len( item ) for item in chains.values() ] ),
+                          getPeakMemory() ) )
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return results
+
+
+def benchstatmiMain():
+    """ The benchmark driver """
+
+    parser = OptionParser(
+    """
+    %prog [options]
+    Generates synthetic logs (see genlog.py) and times statmi.py phases
+    """ )
+
+    parser.add_option( "--sizes", dest="sizes", default="3,4,5,6",
+                       help="comma separated powers of 10 of the number of " \
+                            "operations (default: 3,4,5,6)" )
+    parser.add_option( "--dir", dest="directory", default="/tmp",
+                       help="directory for the generated logs, they are " \
+                            "reused by the next runs (default: /tmp)" )
+    parser.add_option( "--genlog-options", dest="genlogOptions",
+                       default="-t 16 -m 64 -d 4 -b 4 -i 4",
+                       help="genlog.py options except the number of " \
+                            "operations (default: -t 16 -m 64 -d 4 -b 4 -i 4)" )
+    parser.add_option( "--log", dest="log", default=None,
+                       help="benchmark the given log file only" )
+
+    options, args = parser.parse_args()
+    if len( args ) != 0:
+        sys.stdout = sys.stderr
+        parser.print_help()
+        return 1
+
+    if options.log is not None:
+        # A single log in this process: the peak memory is of this log only
+        for phase, seconds, items, memory in benchmarkLog( options.log ):
+            print "%s %f %d %f" % ( phase, seconds, items, memory )
+        return 0
+
+    print "%10s %-14s %10s %12s %10s" % ( "Operations", "Phase", "Seconds",
+                                          "Items", "Peak MB" )
+    for power in [ int( item ) for item in options.sizes.split( "," ) ]:
+        ops = 10 ** power
+        logFileName = os.path.join( options.directory,
+                                    "genlog-1e" + str( power ) + "-" +
+                                    "".join( options.genlogOptions.split() ) +
+                                    ".log" )
+        if not os.path.exists( logFileName ):
+            subprocess.check_call( [ sys.executable,
+                                     os.path.join( testDir, "genlog.py" ),
+                                     "-n", str( ops ) ] +
+                                   options.genlogOptions.split() +
+                                   [ logFileName ] )
+
+        output = subprocess.Popen( [ sys.executable, __file__,
+                                     "--log", logFileName ],
+                                   stdout = subprocess.PIPE ).communicate()[ 0 ]
+        for line in output.splitlines():
+            phase, seconds, items, memory = line.split()
+            print "%10d %-14s %10.3f %12d %10.1f" % ( ops, phase,
+                                                      float( seconds ),
+                                                      int( items ),
+                                                      float( memory ) )
+        sys.stdout.flush()
+    return 0
+
+
+# The script execution entry point
+if __name__ == "__main__":
+    sys.exit( benchstatmiMain() )
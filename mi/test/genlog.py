@@ -0,0 +1,194 @@
+#!/bin/env python
+#
+# File:   genlog.py
+#
+# Permission to copy, use, modify, sell and distribute this software
+# is granted provided this copyright notice appears in all copies.
+# This software is provided "as is" without express or implied
+# warranty, and with no claim as to its suitability for any purpose.
+#
+
+
+"""
+genlog - deterministic synthetic mi log file generator
+"""
+
+import sys, random
+from optparse import OptionParser
+
+
+class LogGenerator:
+    """ Generates the operations of a number of threads which lock the
+        mutexes in the increasing order of their numbers, so the only lock
+        order problems are the deliberate inversions """
+
+    def __init__( self, options ):
+        self.options = options
+        self.random = random.Random( options.seed )
+        self.threads = [ str( 140000000000 + index * 4096 )
+                         for index in range( options.threads ) ]
+        self.mutexes = [ "0x%x" % ( 0x601000 + index * 64 )
+                         for index in range( options.mutexes ) ]
+        self.held = [ [] for index in range( options.threads ) ]
+        self.time = 0           # nanoseconds since the log start
+        self.count = 0          # number of the generated operations
+
+    def writeEnv( self, output ):
+        """ Writes the log header as libmi.so does """
+        output.write( "Env: application: synthetic\n" )
+        output.write( "Env: seed: " + str( self.options.seed ) + "\n" )
+        if self.options.btDepth > 0:
+            output.write( "Env: print stack trace\n" )
+        else:
+            output.write( "Env: do not print stack trace\n" )
+        output.write( "Env: timestamps: monotonic nanoseconds since the log "
+                      "start\n" )
+        output.write( "Env: clock: monotonic 1000000000 ticks per second\n" )
+        return
+
+    def writeOperation( self, output, operation, thread, mutex, retCode ):
+        """ Writes a single operation record with its backtrace """
+
+        clocks = int( self.random.expovariate( 1e-9 / self.options.clocks ) )
+        self.time += clocks + int( self.random.expovariate( 1e-9 /
+                                                            self.options.clocks ) )
+        output.write( "Op: %s Object: %s Thread: %s RetCode: %d "
+                      "Clocks: %d Time: %d\n" %
+                      ( operation, self.mutexes[ mutex ],
+                        self.threads[ thread ], retCode, clocks, self.time ) )
+
+        # A call site is one of a few places in the code where the mutex
+        # is locked, so the stacks repeat as in a real application
+        site = mutex * 4 + self.random.randint( 0, 3 )
+        for depth in range( 0, self.options.btDepth ):
+            output.write( "Bt:  ./synthetic : f%d()+0x%x\n" %
+                          ( depth, ( site * 7 + depth * 13 ) % 256 * 16 ) )
+        self.count += 1
+        return
+
+    def lock( self, output, thread, mutex ):
+        """ Locks a mutex, some of the lock attempts are failed trylocks """
+        if self.random.random() < self.options.failureRate:
+            self.writeOperation( output, "trylock", thread, mutex, 16 )
+            return
+        operation = "lock"
+        if self.random.random() < 0.2:
+            operation = "trylock"
+        self.writeOperation( output, operation, thread, mutex, 0 )
+        self.held[ thread ].append( mutex )
+        return
+
+    def unlock( self, output, thread ):
+        """ Unlocks the last locked mutex of the thread """
+        self.writeOperation( output, "unlock", thread,
+                             self.held[ thread ].pop(), 0 )
+        return
+
+    def writeInversion( self, output ):
+        """ Two threads lock a pair of mutexes in the opposite order """
+
+        first, second = sorted( self.random.sample(
+                                    range( len( self.mutexes ) ), 2 ) )
+        threads = self.random.sample( range( len( self.threads ) ), 2 )
+        for thread, mutexes in [ ( threads[ 0 ], [ first, second ] ),
+                                 ( threads[ 1 ], [ second, first ] ) ]:
+            # The threads must not hold anything to be locked again
+            while self.held[ thread ]:
+                self.unlock( output, thread )
+            for mutex in mutexes:
+                self.writeOperation( output, "lock", thread, mutex, 0 )
+            for mutex in reversed( mutexes ):
+                self.writeOperation( output, "unlock", thread, mutex, 0 )
+        return
+
+    def generate( self, output ):
+        """ Writes the whole log """
+
+        options = self.options
+        self.writeEnv( output )
+
+        inversionStep = 0
+        if options.inversions > 0:
+            inversionStep = max( options.ops / ( options.inversions + 1 ), 1 )
+        inversions = 0
+
+        while self.count < options.ops:
+            if inversionStep > 0 and inversions < options.inversions and \
+               self.count >= inversionStep * ( inversions + 1 ):
+                self.writeInversion( output )
+                inversions += 1
+                continue
+
+            thread = self.random.randint( 0, len( self.threads ) - 1 )
+            held = self.held[ thread ]
+            first = 0
+            if held:
+                first = held[ -1 ] + 1
+            if held and ( len( held ) >= options.depth or
+                          first >= len( self.mutexes ) or
+                          self.random.random() < 0.5 ):
+                self.unlock( output, thread )
+                continue
+            self.lock( output, thread,
+                       self.random.randint( first,
+                                            min( first + options.mutexes / 4,
+                                                 len( self.mutexes ) - 1 ) ) )
+
+        # No mutexes are left locked
+        for thread in range( 0, len( self.threads ) ):
+            while self.held[ thread ]:
+                self.unlock( output, thread )
+        return
+
+
+def genlogMain():
+    """ The genlog driver """
+
+    parser = OptionParser(
+    """
+    %prog [options] [fileName]
+    Generates a synthetic mi log file (stdout by default)
+    """ )
+
+    parser.add_option( "-n", "--ops", dest="ops", default=100000, type="int",
+                       help="number of operations (default: 100000)" )
+    parser.add_option( "-t", "--threads", dest="threads", default=8,
+                       type="int", help="number of threads (default: 8)" )
+    parser.add_option( "-m", "--mutexes", dest="mutexes", default=32,
+                       type="int", help="number of mutexes (default: 32)" )
+    parser.add_option( "-d", "--depth", dest="depth", default=4, type="int",
+                       help="maximum nesting depth (default: 4)" )
+    parser.add_option( "-b", "--bt-depth", dest="btDepth", default=0,
+                       type="int", help="backtrace depth, 0 - no " \
+                                        "backtraces (default: 0)" )
+    parser.add_option( "-f", "--failure-rate", dest="failureRate",
+                       default=0.01, type="float",
+                       help="failed trylocks rate (default: 0.01)" )
+    parser.add_option( "-i", "--inversions", dest="inversions", default=1,
+                       type="int", help="number of lock order inversions " \
+                                        "(default: 1)" )
+    parser.add_option( "-c", "--clocks", dest="clocks", default=0.000005,
+                       type="float", help="mean operation time " \
+                                          "(default: 0.000005)" )
+    parser.add_option( "-s", "--seed", dest="seed", default=1, type="int",
+                       help="random seed (default: 1)" )
+
+    options, args = parser.parse_args()
+    if not len( args ) in [ 0, 1 ] or options.threads < 2 or \
+       options.mutexes < 2 or options.depth < 1:
+        sys.stdout = sys.stderr
+        parser.print_help()
+        return 1
+
+    output = sys.stdout
+    if len( args ) == 1:
+        output = open( args[0], "w" )
+    LogGenerator( options ).generate( output )
+    if output is not sys.stdout:
+        output.close()
+    return 0
+
+
+# The script execution entry point
+if __name__ == "__main__":
+    sys.exit( genlogMain() )
@@ -0,0 +1,81 @@
+//
+// File:   test-bench-elf.cpp
+//
+// Permission to copy, use, modify, sell and distribute this software
+// is granted provided this copyright notice appears in all copies.
+// This software is provided "as is" without express or implied
+// warranty, and with no claim as to its suitability for any purpose.
+//
+
+// The test-ok-elf.cpp locking sequence repeated in a loop by a number of
+// threads to measure the mutex operations rate natively and under mi.
+// Usage: test-bench-elf [threads [iterations per thread]]
+
+#include <pthread.h>
+#include <stdlib.h>
+#include <time.h>
+
+#include <iostream>
+using namespace std;
+
+pthread_mutex_t     m1 = PTHREAD_MUTEX_INITIALIZER;
+pthread_mutex_t     m2 = PTHREAD_MUTEX_INITIALIZER;
+pthread_mutex_t     m3 = PTHREAD_MUTEX_INITIALIZER;
+
+static long         iterations = 100000;
+static const int    opsPerIteration = 6;
+
+
+void *  thread0( void * )
+{
+    for ( long  k = 0; k < iterations; ++k )
+    {
+        pthread_mutex_lock( &m1 );
+        pthread_mutex_lock( &m2 );
+        pthread_mutex_lock( &m3 );
+        pthread_mutex_unlock( &m3 );
+        pthread_mutex_unlock( &m2 );
+        pthread_mutex_unlock( &m1 );
+    }
+
+    return 0;
+}
+
+
+static double  now( void )
+{
+    struct timespec     t;
+    clock_gettime( CLOCK_MONOTONIC, &t );
+    return t.tv_sec + t.tv_nsec / 1e9;
+}
+
+
+int main( int  argc, char **  argv )
+{
+    int             threads( 2 );
+
+    if ( argc > 1 )     threads = atoi( argv[1] );
+    if ( argc > 2 )     iterations = atol( argv[2] );
+    if ( threads < 1 || iterations < 1 )
+    {
+        cerr << "Usage: " << argv[0] << " [threads [iterations]]" << endl;
+        return 1;
+    }
+
+    pthread_t *     t( new pthread_t[ threads ] );
+    double          start( now() );
+
+    for ( int  k = 0; k < threads; ++k )
+        pthread_create( &t[k], 0, thread0, 0 );
+    for ( int  k = 0; k < threads; ++k )
+        pthread_join( t[k], 0 );
+
+    double          seconds( now() - start );
+    long            ops( threads * iterations * opsPerIteration );
+
+    cout << "Operations: " << ops << " Seconds: " << seconds
+         << " Ops/sec: " << (long)( ops / seconds ) << endl;
+
+    delete [] t;
+    return 0;
+}